@@ -0,0 +1,436 @@
+"""
+Benchmarks for the dashboard and ingestion hot paths on synthetic data.
+
+Each case is timed (best and median of --repeat runs) and run once more under
+tracemalloc for its peak allocation. Results are printed as one JSON object
+per line, tagged with the current git commit, so runs on different commits
+can be compared directly:
+
+    python benchmarks.py --years 1 --freq h
+    python benchmarks.py --years 10 --freq 5min --cases load_taxi_count filter_data --out bench.jsonl
+
+The dashboard cases call the modules that back streamlit.py's functions
+(filter_data -> count_cube, taxigraph -> series_store, the animation ->
+monthly_rollup, create_folium_choropleth -> geometry_cache + folium);
+convert_data is DataProcessor.convert_data's labelling via district_index,
+flow_matching the snapshot-to-snapshot matching of flows.py and live_update
+one snapshot added by live.py.
+
+The *_legacy cases are the implementations those modules replaced (pandas
+over the full frame, the geopandas sjoin labelling), run on the same
+synthetic data, so each pair gives the before/after numbers in one run:
+
+    python benchmarks.py --cases load_taxi_count load_taxi_count_legacy filter_data filter_data_legacy
+"""
+import datetime as dt
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+import shared_dataset
+import synthetic
+import taxi_store
+from count_cube import CountCube
+from downsample import downsample_frame
+from district_index import DistrictIndex
+from queries import impact_matrix
+from flows import chunk_flows
+from geometry_cache import GeometryCache
+from live import LiveFeed, STEP
+from monthly_rollup import MonthlyRollup
+from series_store import SeriesStore
+from time_pyramid import TimePyramid
+
+CASES = {}
+
+
+def case(fn):
+    CASES[fn.__name__] = fn
+    return fn
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+class Context:
+    # synthetic inputs shared by the cases, built lazily
+    def __init__(self, years, freq, n_snapshots, n_taxis):
+        self.years, self.freq = years, freq
+        self.n_snapshots, self.n_taxis = n_snapshots, n_taxis
+        self.tmp = tempfile.mkdtemp(prefix='cim-bench-')
+        self._cache = {}
+
+    def get(self, name, build):
+        if name not in self._cache:
+            self._cache[name] = build()
+        return self._cache[name]
+
+    @property
+    def full_data(self):
+        return self.get('full_data', lambda: synthetic.synthetic_counts(years=self.years, freq=self.freq))
+
+    @property
+    def store_dir(self):
+        def build():
+            df = self.full_data
+            years = df.index.year
+            for year in np.unique(years):
+                part = df[years == year]
+                taxi_store.write_partition(part.reset_index(), int(year), self.tmp, part=0)
+            return self.tmp
+        return self.get('store_dir', build)
+
+    @property
+    def csv_dir(self):
+        # full_data as the processed_taxi_count.{year}.csv files the dashboard used to read
+        def build():
+            out = os.path.join(self.tmp, 'csv')
+            os.makedirs(out)
+            df = self.full_data
+            for year in np.unique(df.index.year):
+                part = df[df.index.year == year]
+                pd.DataFrame({'region': part.region.astype(str).values, 'taxi_count': part.taxi_count.values},
+                             index=pd.Index(part.index.strftime('%Y%m%d%H%M%S').astype(np.int64), name='filename')
+                             ).to_csv(os.path.join(out, f'processed_taxi_count.{year}.csv'))
+            return out
+        return self.get('csv_dir', build)
+
+    @property
+    def legacy_data(self):
+        # full_data as the dashboard used to load it from the csv files: region as plain strings
+        def build():
+            df = self.full_data.copy()
+            df['region'] = df.region.astype(str).astype(object)
+            return df
+        return self.get('legacy_data', build)
+
+    @property
+    def cube(self):
+        return self.get('cube', lambda: CountCube.from_frame(self.full_data))
+
+    @property
+    def query_dates(self):
+        start = self.full_data.index[0].date()
+        return start, start + dt.timedelta(days=max(1, 180 * self.years))
+
+    def close(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+
+@case
+def load_taxi_count(ctx):
+    store_dir = ctx.store_dir
+    return lambda: taxi_store.load_taxi_count(store_dir=store_dir, csv_dir=ctx.tmp, years=range(1900, 2200),
+                                              drop_noisy=False)
+
+
+def legacy_load_taxi_count(csv_dir, years):
+    # streamlit.load_taxi_count before taxi_store: every year's csv read whole, noisy periods dropped by a set scan
+    year_dfs = [pd.read_csv(os.path.join(csv_dir, f'processed_taxi_count.{year}.csv'), index_col=0) for year in years]
+    df = pd.concat(year_dfs, axis=0)
+    df = df.reset_index().set_index('filename')
+    idx = set(df.index)
+    idx_to_dt_map = {x: dt.datetime.strptime(str(x), "%Y%m%d%H%M%S") for x in idx}
+    idx_to_drop = [i for i in idx if (i < 20160916130000) or ((i >= 20171016110000) & (i <= 20171129090000))]
+    df.drop(idx_to_drop, axis=0, inplace=True)
+    df.index = df.index.map(idx_to_dt_map)
+    return df
+
+
+@case
+def load_taxi_count_legacy(ctx):
+    csv_dir = ctx.csv_dir
+    years = [int(y) for y in np.unique(ctx.full_data.index.year)]
+    return lambda: legacy_load_taxi_count(csv_dir, years)
+
+
+@case
+def build_count_cube(ctx):
+    full_data = ctx.full_data
+    return lambda: CountCube.from_frame(full_data)
+
+
+@case
+def attach_shared_dataset(ctx):
+    # what a new server process pays to get the cube and series store
+    full_data = ctx.full_data
+    shared_dir = ctx.get('shared_dir', lambda: shared_dataset.attach('bench', ctx.tmp + '/shared',
+                                                                     load=lambda: full_data).path)
+
+    def run():
+        shared = shared_dataset.SharedDataset(shared_dir)
+        return shared.cube, shared.series_store
+    return run
+
+
+@case
+def build_shared_dataset(ctx):
+    # what the first process on a new host pays before attach_shared_dataset: rows, cube, series and pyramid
+    full_data = ctx.full_data
+    return lambda: shared_dataset.write(tempfile.mkdtemp(dir=ctx.tmp), full_data)
+
+
+@case
+def filter_data(ctx):
+    cube = ctx.cube
+    base, analysis = ctx.query_dates
+    return lambda: cube.filter(base, analysis, 20, 10, 'Days')
+
+
+def legacy_filter_data(full_data, baseline_date_start, analysis_date_start, hour_of_day, days):
+    # streamlit.filter_data before count_cube: a copy of each window of the full frame, grouped by region
+    def window(start, cap):
+        t0 = dt.datetime(start.year, start.month, start.day) + dt.timedelta(hours=hour_of_day)
+        data = full_data.loc[t0:min(t0 + dt.timedelta(days=days), cap)].copy()
+        data['hour'] = data.index.hour.astype(int)
+        data = data[data['hour'] == hour_of_day].drop('hour', axis=1)
+        return data.groupby('region').mean().round().reset_index()
+    return window(baseline_date_start, dt.datetime(2020, 4, 1)), window(analysis_date_start, dt.datetime(2021, 10, 1))
+
+
+@case
+def filter_data_legacy(ctx):
+    full_data = ctx.legacy_data
+    base, analysis = ctx.query_dates
+    return lambda: legacy_filter_data(full_data, base, analysis, 20, 10)
+
+
+@case
+def impact_matrix_all_hours(ctx):
+    # impact ranking for 24 hours x 6 window lengths; the cube's running sums are built on the first run
+    cube = ctx.cube
+    base, analysis = ctx.query_dates
+    return lambda: impact_matrix(cube, base, analysis, [1, 3, 7, 10, 14, 30], 'Days')
+
+
+@case
+def build_series_store(ctx):
+    full_data = ctx.full_data
+    return lambda: SeriesStore.from_frame(full_data)
+
+
+@case
+def taxigraph(ctx):
+    store = ctx.get('series_store', lambda: SeriesStore.from_frame(ctx.full_data))
+    region = store.regions[0]
+    start = ctx.query_dates[0]
+    end = ctx.full_data.index[-1].to_pydatetime()
+    return lambda: store.rolling(region, 20, start, end, window=90)
+
+
+def legacy_taxigraph(full_data, region, hour, startdate, enddate):
+    # streamlit.taxigraph before series_store: copy, filter and roll the full frame per query
+    basedata = full_data.copy()
+    basedata = basedata.loc[str(startdate):str(enddate)]
+    basedata = basedata[basedata.index.hour == hour]
+    if region != "All":
+        basedata = basedata.loc[basedata.region == region]
+    basedata = basedata.reset_index()
+    basedata['rolling_average'] = basedata.taxi_count.rolling(90).mean()
+    return basedata
+
+
+@case
+def taxigraph_legacy(ctx):
+    full_data = ctx.legacy_data
+    region = sorted(full_data.region.unique())[0]
+    start = ctx.query_dates[0]
+    end = full_data.index[-1].to_pydatetime()
+    return lambda: legacy_taxigraph(full_data, region, 20, start, end)
+
+
+@case
+def taxigraph_downsampled(ctx):
+    # the chart's rows: the rolling series reduced to 800 points per trace
+    store = ctx.get('series_store', lambda: SeriesStore.from_frame(ctx.full_data))
+    region = store.regions[0]
+    start = ctx.query_dates[0]
+    end = ctx.full_data.index[-1].to_pydatetime()
+    return lambda: downsample_frame(store.rolling(region, 20, start, end, window=90), 'filename',
+                                    ['taxi_count', 'rolling_average'], 800)
+
+
+@case
+def timeseries(ctx):
+    # a year of weekly stats for every district, answered from the pyramid's weekly level
+    pyramid = ctx.get('pyramid', lambda: TimePyramid.from_frame(ctx.full_data))
+    start = pyramid.t0.astype('datetime64[D]')
+    return lambda: pyramid.query(start, start + np.timedelta64(52 * 7, 'D'), 'W')
+
+
+@case
+def animation(ctx):
+    rollup = ctx.get('rollup', lambda: MonthlyRollup(CountCube.from_frame(ctx.full_data)))
+    start = ctx.query_dates[0]
+    end = ctx.full_data.index[-1].to_pydatetime()
+    return lambda: rollup.frame(20, start, end)
+
+
+@case
+def animation_legacy(ctx):
+    # the animated chart's frame before monthly_rollup: every district's rolling series, summed per month
+    full_data = ctx.legacy_data
+    start = ctx.query_dates[0]
+    end = full_data.index[-1].to_pydatetime()
+
+    def run():
+        data = legacy_taxigraph(full_data, "All", 20, start, end).drop(columns=["rolling_average"])
+        date = data.filename
+        data = data.groupby([data.region.rename("District"), date.dt.year.rename("year"),
+                             date.dt.month.rename("month")]).agg({'taxi_count': "sum"}).reset_index()
+        data["Date"] = data["year"].astype(str) + "-" + data["month"].astype(str)
+        return data.drop(columns=["year", "month"])
+    return run
+
+
+@case
+def create_folium_choropleth(ctx):
+    import folium
+    import pandas as pd
+
+    geometry_cache = ctx.get('geometry_cache', GeometryCache.from_geojson)
+    baseline, _ = ctx.cube.filter(*ctx.query_dates, 20, 10, 'Days')
+
+    def run():
+        counts = dict(zip(baseline.region.astype(str), baseline.taxi_count))
+        names = {d: d + " Taxis: {:.0f}".format(counts[d]) for d in counts}
+        data = pd.DataFrame({'region': list(names.values()), 'taxi_count': list(counts.values())})
+        m = folium.Map(location=[1.3572, 103.8207], zoom_start=11)
+        choropleth = folium.Choropleth(geo_data=geometry_cache.feature_collection({d: {'name': n} for d, n in names.items()}),
+                                       data=data, columns=["region", "taxi_count"], key_on="properties.name",
+                                       fill_color="YlOrRd").add_to(m)
+        choropleth.geojson.add_child(folium.GeoJsonTooltip(fields=["name"], aliases=['District']))
+        return m.get_root().render()
+    return run
+
+
+@case
+def convert_data(ctx):
+    index = ctx.get('district_index', DistrictIndex.from_geojson)
+    snapshots = ctx.get('snapshots', lambda: synthetic.synthetic_snapshots(ctx.n_snapshots, ctx.n_taxis, index))
+
+    def run():
+        codes, offsets = index.label_snapshots(snapshots)
+        return index.count(codes, offsets)
+    return run
+
+
+@case
+def convert_data_legacy(ctx):
+    # DataProcessor.convert_data before district_index: each API response read into geopandas and sjoined
+    import geopandas as gpd
+    from district_index import COUNTRY_GEO
+    from stub_server import feature_collection
+
+    with open(COUNTRY_GEO) as f:
+        country_gdf = gpd.GeoDataFrame.from_features(json.load(f))
+    index = ctx.get('district_index', DistrictIndex.from_geojson)
+    snapshots = ctx.get('snapshots', lambda: synthetic.synthetic_snapshots(ctx.n_snapshots, ctx.n_taxis, index))
+    responses = [feature_collection('2019-01-01T00:00:00', lon, lat) for lon, lat in snapshots]
+
+    def run():
+        counts = []
+        for data_json in responses:
+            gdf = gpd.GeoDataFrame.from_features(data_json["features"])
+            points_gdf = gdf.geometry.explode(index_parts=False).to_frame()
+            joined_gdf = gpd.sjoin(points_gdf, country_gdf, how='left', predicate="within")
+            counts.append(joined_gdf.name.value_counts())
+        return counts
+    return run
+
+
+@case
+def flow_matching(ctx):
+    # taxis matched between consecutive snapshots and summed into district flows, see flows.py
+    index = ctx.get('district_index', DistrictIndex.from_geojson)
+    snapshots = ctx.get('snapshots', lambda: synthetic.synthetic_snapshots(ctx.n_snapshots, ctx.n_taxis, index))
+    stamps = np.datetime64('2019-01-01T00:00') + np.arange(len(snapshots)) * np.timedelta64(5, 'm')
+    return lambda: chunk_flows(index, stamps, snapshots)
+
+
+@case
+def live_update(ctx):
+    # one new snapshot labelled and appended to the cube, rollup, series store and pyramid by live.py
+    index = ctx.get('district_index', DistrictIndex.from_geojson)
+    snapshots = ctx.get('snapshots', lambda: synthetic.synthetic_snapshots(ctx.n_snapshots, ctx.n_taxis, index))
+    full_data = ctx.full_data
+    feed = LiveFeed(MonthlyRollup(CountCube.from_frame(full_data)), SeriesStore.from_frame(full_data),
+                    pyramid=TimePyramid.from_frame(full_data))
+    slot = [full_data.index[-1].to_pydatetime()]
+
+    def run():
+        slot[0] += STEP
+        feed.apply(slot, snapshots[:1])
+    return run
+
+
+def measure(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t0)
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return min(times), statistics.median(times), peak
+
+
+def run(cases=None, years=1, freq='h', n_snapshots=12, n_taxis=5000, repeat=5, out=None):
+    ctx = Context(years, freq, n_snapshots, n_taxis)
+    commit = git_commit()
+    results = []
+    try:
+        for name in cases or CASES:
+            t0 = time.perf_counter()
+            fn = CASES[name](ctx)
+            setup = time.perf_counter() - t0
+            best, median, peak = measure(fn, repeat)
+            result = {
+                'case': name, 'commit': commit, 'years': years, 'freq': freq,
+                'rows': len(ctx.full_data) if 'full_data' in ctx._cache else None,
+                'n_snapshots': n_snapshots if name in ('convert_data', 'convert_data_legacy', 'flow_matching') else None,
+                'best_s': round(best, 6), 'median_s': round(median, 6), 'peak_mb': round(peak / 2 ** 20, 3),
+                'setup_s': round(setup, 3),
+            }
+            print(json.dumps(result))
+            sys.stdout.flush()
+            results.append(result)
+    finally:
+        ctx.close()
+    if out:
+        with open(out, 'a') as f:
+            for r in results:
+                f.write(json.dumps(r) + '\n')
+    return results
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmark the dashboard and ingestion hot paths")
+    parser.add_argument('--cases', nargs='*', choices=sorted(CASES), default=None)
+    parser.add_argument('--years', type=int, default=1, help="span of the synthetic counts")
+    parser.add_argument('--freq', default='h', help="snapshot frequency of the synthetic counts, e.g. h or 5min")
+    parser.add_argument('--snapshots', type=int, default=12, help="raw snapshots labelled by convert_data")
+    parser.add_argument('--taxis', type=int, default=5000, help="taxis per raw snapshot")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--out', default=None, help="append results to this JSON lines file")
+    args = parser.parse_args()
+
+    run(args.cases, args.years, args.freq, args.snapshots, args.taxis, args.repeat, args.out)
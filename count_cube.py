@@ -0,0 +1,199 @@
+"""
+Dense region x day x hour cube of the processed taxi counts.
+
+Built once from the frame returned by load_taxi_count(). Cells with no
+snapshot have a zero in `counts`, which doubles as the missing-hour mask, so
+window means are sums over slices divided by the number of snapshots seen.
+window_means() answers many windows at once from running sums over the days.
+"""
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+from taxi_store import region_codes, region_names
+
+DAY = np.timedelta64(1, 'D')
+ANALYSIS_END = datetime(2021, 10, 1)  # end of the data the dashboard was built on
+
+
+def add_at(target, flat, weights=None):
+    """
+    np.add.at(target.ravel(), flat, weights) for a contiguous target. Large
+    batches (a full build) go through one bincount over the whole array,
+    which is many times faster than add.at; small appends stay with add.at.
+    """
+    if len(flat) * 8 < target.size:
+        np.add.at(target.reshape(-1), flat, 1 if weights is None else weights)
+    else:
+        target += np.bincount(flat, weights=weights, minlength=target.size).reshape(target.shape).astype(
+            target.dtype, copy=False)
+
+
+def get_time_delta(time_period, time_frequency):
+    p = int(time_period)
+    if time_frequency.lower() == 'hours':
+        return timedelta(hours=p)
+    elif time_frequency.lower() == 'days':
+        return timedelta(days=p)
+    elif time_frequency.lower() == 'weeks':
+        return timedelta(weeks=p)
+
+
+def date_to_datetime(t):
+    return datetime(t.year, t.month, t.day)
+
+
+def windows(baseline_date_start, analysis_date_start, hour_of_day, time_period, time_frequency,
+            analysis_end=ANALYSIS_END):
+    # ((from, to), (from, to)) of the baseline and analysis windows, as the original pandas filter_data
+    delta = get_time_delta(time_period, time_frequency)
+
+    baseline_from = date_to_datetime(baseline_date_start) + timedelta(hours=int(hour_of_day))
+    baseline_to = baseline_from + delta
+    if baseline_to >= datetime(2020, 4, 1):
+        baseline_to = datetime(2020, 4, 1)
+
+    analysis_from = date_to_datetime(analysis_date_start) + timedelta(hours=int(hour_of_day))
+    analysis_to = analysis_from + delta
+    if analysis_to >= analysis_end:
+        analysis_to = analysis_end
+    return (baseline_from, baseline_to), (analysis_from, analysis_to)
+
+
+class CountCube:
+    # analysis windows end here at the latest; live.py moves it forward on its cube as snapshots arrive
+    analysis_end = ANALYSIS_END
+
+    def __init__(self, regions, day0, sums, counts):
+        self.regions = np.asarray(regions, dtype=object)
+        self.day0 = np.datetime64(day0, 'D')
+        self.sums = sums  # float64 [region, day, hour], sum of taxi_count
+        self.counts = counts  # uint16 [region, day, hour], snapshots seen
+        self.region_index = {r: i for i, r in enumerate(self.regions)}
+        self._cumsums = None
+
+    @classmethod
+    def from_frame(cls, full_data):
+        regions = np.array(region_names(full_data.region), dtype=object)
+        days = full_data.index.values.astype('datetime64[D]')
+        day0 = days.min() if len(days) else np.datetime64('2016-01-01')
+        n_days = int((days.max() - day0) // DAY) + 1 if len(days) else 0
+
+        cube = cls(regions, day0, np.zeros((len(regions), n_days, 24), dtype=np.float64),
+                   np.zeros((len(regions), n_days, 24), dtype=np.uint16))
+        cube._add(full_data)
+        return cube
+
+    def _add(self, frame):
+        ts = frame.index.values.astype('datetime64[h]')
+        days = ts.astype('datetime64[D]')
+        codes = region_codes(frame.region, self.regions)
+        day_idx = ((days - self.day0) // DAY).astype(np.int64)
+        hour_idx = (ts - days).astype(np.int64)
+        flat = (codes * self.n_days + day_idx) * 24 + hour_idx
+        add_at(self.sums, flat, frame.taxi_count.values.astype(np.float64))
+        add_at(self.counts, flat)
+        self._cumsums = None
+
+    def append(self, frame, slack_days=31):
+        """
+        Add new rows (same layout as full_data) to the cube, growing it for new
+        regions or days. Growing forward reserves `slack_days` empty days, so
+        appending live data does not reallocate on every snapshot.
+        """
+        if not len(frame):
+            return
+        new_regions = sorted(set(region_names(frame.region)) - set(self.region_index))
+        days = frame.index.values.astype('datetime64[D]')
+        first = min(days.min(), self.day0)
+        last = int((days.max() - first) // DAY) + 1
+        shift = int((self.day0 - first) // DAY)
+        n_days = max(self.n_days + shift, last)
+        if new_regions or n_days > self.n_days + shift or shift:
+            if n_days > self.n_days + shift:
+                n_days += slack_days
+            # regions stay sorted, like the groupby('region') output filter_data used to return
+            regions = sorted(list(self.regions) + new_regions)
+            old_rows = [regions.index(r) for r in self.regions]
+            shape = (len(regions), n_days, 24)
+            sums, counts = np.zeros(shape, dtype=self.sums.dtype), np.zeros(shape, dtype=self.counts.dtype)
+            sums[old_rows, shift:shift + self.n_days] = self.sums
+            counts[old_rows, shift:shift + self.n_days] = self.counts
+            self.__init__(regions, first, sums, counts)
+        elif not (self.sums.flags.writeable and self.counts.flags.writeable):
+            # read-only (e.g. memory-mapped, see shared_dataset.py) cube: copy before writing
+            self.sums, self.counts = np.array(self.sums), np.array(self.counts)
+        self._add(frame)
+
+    @property
+    def n_days(self):
+        return self.sums.shape[1]
+
+    @property
+    def present(self):
+        # [day, hour] mask of hours with at least one snapshot
+        return self.counts.any(axis=0)
+
+    def day_range(self, start, end, hour):
+        """
+        Days d (as cube indices) whose snapshot at `hour` lies in [start, end],
+        clipped to the cube. Returns a (lo, hi) half-open pair.
+        """
+        offset = self.day0.astype('datetime64[s]') + np.timedelta64(int(hour), 'h')
+        s = (np.datetime64(start, 's') - offset).astype(np.int64)
+        e = (np.datetime64(end, 's') - offset).astype(np.int64)
+        lo = -(-s // 86400)  # ceil
+        hi = e // 86400 + 1
+        lo, hi = max(int(lo), 0), min(int(hi), self.n_days)
+        return lo, max(lo, hi)
+
+    def window_mean(self, start, end, hour):
+        """
+        Per-region mean of taxi_count over the snapshots taken at `hour` within
+        [start, end], rounded, as a frame with columns region, taxi_count.
+        Regions without any snapshot in the window are left out.
+        """
+        lo, hi = self.day_range(start, end, hour)
+        h = int(hour)
+        s = self.sums[:, lo:hi, h].sum(axis=1)
+        n = self.counts[:, lo:hi, h].sum(axis=1)
+        seen = n > 0
+        return pd.DataFrame({'region': self.regions[seen],
+                             'taxi_count': np.round(s[seen] / n[seen])})
+
+    def cumsums(self):
+        # (sums, counts) summed over the days, with a leading zero day: [region, day + 1, hour]
+        if self._cumsums is None:
+            shape = (len(self.regions), 1, 24)
+            self._cumsums = (np.concatenate([np.zeros(shape), np.cumsum(self.sums, axis=1)], axis=1),
+                             np.concatenate([np.zeros(shape, dtype=np.int64),
+                                             np.cumsum(self.counts, axis=1, dtype=np.int64)], axis=1))
+        return self._cumsums
+
+    def window_means(self, windows):
+        """
+        window_mean() of many (start, end, hour) windows at once, as a float
+        [region, window] array, NaN where a region has no snapshot.
+        """
+        bounds = np.array([self.day_range(start, end, hour) for start, end, hour in windows],
+                          dtype=np.int64).reshape(-1, 2)
+        hours = np.array([int(hour) for _, _, hour in windows], dtype=np.int64)
+        cs, cn = self.cumsums()
+        s = cs[:, bounds[:, 1], hours] - cs[:, bounds[:, 0], hours]
+        n = cn[:, bounds[:, 1], hours] - cn[:, bounds[:, 0], hours]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(n > 0, np.round(s / n), np.nan)
+
+    def windows(self, baseline_date_start, analysis_date_start, hour_of_day, time_period, time_frequency):
+        # windows() capped at this cube's analysis_end
+        return windows(baseline_date_start, analysis_date_start, hour_of_day, time_period, time_frequency,
+                       self.analysis_end)
+
+    def filter(self, baseline_date_start, analysis_date_start, hour_of_day, time_period, time_frequency):
+        # same windows as the original pandas filter_data in streamlit.py
+        (baseline_from, baseline_to), (analysis_from, analysis_to) = self.windows(
+            baseline_date_start, analysis_date_start, hour_of_day, time_period, time_frequency)
+        baseline_data = self.window_mean(baseline_from, baseline_to, hour_of_day)
+        analysis_data = self.window_mean(analysis_from, analysis_to, hour_of_day)
+        return baseline_data, analysis_data
@@ -0,0 +1,241 @@
+"""
+Snapshot coverage and quality index.
+
+One uint8 of flags per 5-minute slot since ORIGIN:
+
+    PRESENT     counts for the snapshot are in the store
+    EMPTY       the snapshot was fetched but held no taxis
+    EXCLUDED    inside an exclusion window of the rules file
+    ANOMALOUS   present, but its taxi total breaks the anomaly rule
+
+A slot with no flag has no snapshot at all. Hourly data (the processed CSVs)
+only fills the slots on the hour. ingest.py marks the slots it writes, and
+`python coverage_index.py` rebuilds the index from the Parquet store. Exclusion windows
+and the anomaly rule live in exclusions.json, not in code. The taxi total of
+each snapshot is kept next to the flags (coverage.totals.npy), and both rules
+are applied whenever the index is loaded, so editing the file takes effect
+without a rebuild. taxi_store.load_taxi_count() drops excluded and anomalous rows
+through drop_mask(), and gaps()/summary() report missing data for any range
+without touching the store.
+"""
+import json
+import os
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+COVERAGE = './data/analysis/coverage.npy'
+RULES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'exclusions.json')
+ORIGIN = np.datetime64('2016-01-01T00:00', 'm')
+STEP = np.timedelta64(5, 'm')
+
+PRESENT = 1
+EMPTY = 2
+EXCLUDED = 4
+ANOMALOUS = 8
+DROP = EXCLUDED | ANOMALOUS
+FLAG_NAMES = {'present': PRESENT, 'empty': EMPTY, 'excluded': EXCLUDED, 'anomalous': ANOMALOUS}
+
+
+def load_rules(fname=RULES):
+    """
+    {'exclude': [(lo, hi)], 'min_taxis': int}. Windows are inclusive
+    datetimes, None for an open end; min_taxis flags snapshots whose total is
+    below it as anomalous.
+    """
+    with open(fname) as f:
+        rules = json.load(f)
+    parse = lambda v: None if v is None else datetime.fromisoformat(v)
+    return {
+        'exclude': [(parse(w.get('start')), parse(w.get('end'))) for w in rules.get('exclude', [])],
+        'min_taxis': int(rules.get('anomaly', {}).get('min_taxis', 0)),
+    }
+
+
+def totals_path(fname):
+    """The per-slot taxi totals saved next to a coverage file."""
+    return (fname[:-4] if fname.endswith('.npy') else fname) + '.totals.npy'
+
+
+def excluded_mask(index, windows):
+    """Vectorized mask of the times in `index` inside any (lo, hi) window, bounds inclusive."""
+    t = np.asarray(index, dtype='datetime64[ns]')
+    mask = np.zeros(len(t), dtype=bool)
+    for lo, hi in windows:
+        m = np.ones(len(t), dtype=bool)
+        if lo is not None:
+            m &= t >= np.datetime64(lo, 'ns')
+        if hi is not None:
+            m &= t <= np.datetime64(hi, 'ns')
+        mask |= m
+    return mask
+
+
+def slots(times):
+    """Slot index of each time (datetime64 array or yyyymmddHHMMSS ints)."""
+    times = np.asarray(times)
+    if np.issubdtype(times.dtype, np.integer):
+        times = pd.to_datetime(times.astype(np.int64).astype(str), format="%Y%m%d%H%M%S").values
+    return ((times.astype('datetime64[m]') - ORIGIN) // STEP).astype(np.int64)
+
+
+class Coverage:
+    def __init__(self, flags=None, rules=None, totals=None):
+        self.flags = np.zeros(0, dtype=np.uint8) if flags is None else flags
+        # taxis per slot, -1 where unknown (EMPTY slots, or an index saved before totals were kept)
+        self.totals = np.full(len(self.flags), -1, dtype=np.int32) if totals is None else totals
+        if len(self.totals) < len(self.flags):
+            self.totals = np.r_[self.totals, np.full(len(self.flags) - len(self.totals), -1, dtype=np.int32)]
+        self.rules = rules if rules is not None else {'exclude': [], 'min_taxis': 0}
+        self.apply_rules()
+
+    @classmethod
+    def load(cls, fname=COVERAGE, rules_file=RULES):
+        flags = np.load(fname) if os.path.exists(fname) else None
+        totals = np.load(totals_path(fname)) if flags is not None and os.path.exists(totals_path(fname)) else None
+        return cls(flags, load_rules(rules_file) if os.path.exists(rules_file) else None, totals)
+
+    def save(self, fname=COVERAGE):
+        os.makedirs(os.path.dirname(fname) or '.', exist_ok=True)
+        # totals first: a reader never sees flags newer than the totals they were marked with
+        for path, a in ((totals_path(fname), self.totals), (fname, self.flags)):
+            tmp = path + '.tmp.npy'
+            np.save(tmp, a)
+            os.replace(tmp, path)
+
+    def _reserve(self, n):
+        if n > len(self.flags):
+            size = max(n, len(self.flags) + 105_120)  # a year of slots at a time
+            grown = np.zeros(size, dtype=np.uint8)
+            grown[:len(self.flags)] = self.flags
+            totals = np.full(size, -1, dtype=np.int32)
+            totals[:len(self.totals)] = self.totals
+            self.flags, self.totals = grown, totals
+            self.apply_rules()
+
+    def times(self, lo=0, hi=None):
+        hi = len(self.flags) if hi is None else hi
+        return ORIGIN + np.arange(lo, hi) * STEP
+
+    def apply_rules(self):
+        # EXCLUDED and ANOMALOUS bits always follow the current rules; slots
+        # without a stored total keep the ANOMALOUS bit they were saved with
+        known = self.totals >= 0
+        self.flags[known] &= ~np.uint8(ANOMALOUS)
+        if self.rules['min_taxis']:
+            self.flags[known & (self.flags & PRESENT > 0) & (self.totals < self.rules['min_taxis'])] |= ANOMALOUS
+        self.flags &= ~np.uint8(EXCLUDED)
+        for lo, hi in self.rules['exclude']:
+            a = 0 if lo is None else max(int(slots(np.array([np.datetime64(lo)]))[0]), 0)
+            if hi is None:
+                b = len(self.flags)
+            else:
+                hi = np.datetime64(hi, 'm')
+                b = min(int((hi - ORIGIN) // STEP) + 1, len(self.flags))
+            if a < b:
+                self.flags[a:b] |= EXCLUDED
+
+    def mark(self, times, flag, totals=None):
+        """
+        Set `flag` on the slots of `times`. With totals (taxis per snapshot),
+        they are stored and PRESENT snapshots below the anomaly rule are
+        flagged ANOMALOUS too.
+        """
+        idx = slots(times)
+        keep = idx >= 0
+        idx = idx[keep]
+        if not len(idx):
+            return
+        self._reserve(int(idx.max()) + 1)
+        self.flags[idx] |= flag
+        if totals is not None:
+            # re-marking a snapshot re-evaluates the rule
+            totals = np.asarray(totals)[keep]
+            self.totals[idx] = totals
+            self.flags[idx] &= ~np.uint8(ANOMALOUS)
+            if self.rules['min_taxis']:
+                self.flags[idx[(self.flags[idx] & PRESENT > 0) & (totals < self.rules['min_taxis'])]] |= ANOMALOUS
+
+    def mark_counts(self, stamps, counts):
+        # per-(snapshot, district) rows as ingest writes them: PRESENT plus the anomaly check
+        uniq, inverse = np.unique(stamps, return_inverse=True)
+        self.mark(uniq, PRESENT, np.bincount(inverse, weights=counts))
+
+    def at(self, index):
+        """Flags of the slots of the times in index (0 beyond the covered range)."""
+        idx = slots(np.asarray(index, dtype='datetime64[ns]'))
+        ok = (idx >= 0) & (idx < len(self.flags))
+        out = np.zeros(len(idx), dtype=np.uint8)
+        out[ok] = self.flags[idx[ok]]
+        return out
+
+    def drop_mask(self, index):
+        """Rows of a frame indexed by snapshot time to leave out: excluded by the rules or anomalous."""
+        return excluded_mask(index, self.rules['exclude']) | (self.at(index) & ANOMALOUS > 0)
+
+    def _range(self, start, end, step):
+        # slot indices in [start, end], every `step` from start
+        lo = int(slots(np.array([np.datetime64(pd.Timestamp(start).to_datetime64())]))[0])
+        hi = int(slots(np.array([np.datetime64(pd.Timestamp(end).to_datetime64())]))[0])
+        every = int(pd.Timedelta(step) // pd.Timedelta(STEP))
+        idx = np.arange(lo, hi + 1, every)
+        return idx[idx >= 0]
+
+    def summary(self, start, end, step='1h'):
+        """
+        Slots every `step` in [start, end] by state: expected, present, empty,
+        excluded, anomalous, missing and usable (present and not dropped).
+        """
+        idx = self._range(start, end, step)
+        f = np.zeros(len(idx), dtype=np.uint8)
+        ok = idx < len(self.flags)
+        f[ok] = self.flags[idx[ok]]
+        out = {'expected': len(idx)}
+        out.update({name: int(((f & flag) > 0).sum()) for name, flag in FLAG_NAMES.items()})
+        out['missing'] = int((f & (PRESENT | EMPTY) == 0).sum())
+        out['usable'] = int(((f & PRESENT > 0) & (f & DROP == 0)).sum())
+        return out
+
+    def gaps(self, start, end, step='1h', min_length=1):
+        """
+        [(first, last, n_slots)] runs of at least min_length missing slots
+        (no PRESENT or EMPTY flag) every `step` in [start, end].
+        """
+        idx = self._range(start, end, step)
+        f = np.zeros(len(idx), dtype=np.uint8)
+        ok = idx < len(self.flags)
+        f[ok] = self.flags[idx[ok]]
+        missing = np.r_[False, (f & (PRESENT | EMPTY)) == 0, False].astype(np.int8)
+        edges = np.flatnonzero(np.diff(missing))
+        runs = edges.reshape(-1, 2)
+        times = ORIGIN + idx * STEP
+        return [(times[a].astype(datetime), times[b - 1].astype(datetime), int(b - a))
+                for a, b in runs if b - a >= min_length]
+
+
+def from_store(store_dir=None, rules_file=RULES, years=None):
+    """Coverage of the Parquet store (only `years` if given), flagging anomalies by the rules file."""
+    import taxi_store
+
+    cov = Coverage(rules=load_rules(rules_file) if os.path.exists(rules_file) else None)
+    df = taxi_store.load_taxi_count(years=years or taxi_store.YEARS, store_dir=store_dir or taxi_store.STORE_DIR,
+                                    drop_noisy=False)
+    cov.mark_counts(df.index.values, df.taxi_count.values)
+    return cov
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Rebuild the coverage index from the Parquet store")
+    parser.add_argument('--store-dir', default=None)
+    parser.add_argument('--out', default=COVERAGE)
+    args = parser.parse_args()
+
+    coverage = from_store(args.store_dir)
+    coverage.save(args.out)
+    times = coverage.times()
+    present = times[(coverage.flags & PRESENT) > 0]
+    if len(present):
+        print(coverage.summary(present[0].astype(datetime), present[-1].astype(datetime)))
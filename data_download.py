@@ -1,38 +1,210 @@
 import requests
 import json
+import os
+import random
+import threading
+import time
 import numpy as np
 import pandas as pd
 
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
 from tqdm import tqdm
-from os.path import exists
-
-
-def multiproc(n_proc):
-    pass
-
-
-def download_data(start, end, freq='5Min'):
-    date_range = pd.date_range(start='2018-01-01', end='2019-10-01', freq='5Min')
-    for _dt in tqdm(date_range):
-        _dt = str(_dt).replace(' ', 'T')
-        dt_int = _dt.replace('-', '').replace('T', '').replace(':', '')
-        year = _dt[:4]
-        fname = f"data/{year}/{dt_int}.json"
-        if exists(fname):
-            continue
-        
-        dt_url = _dt.replace(':', '%3A')
-        url = f"https://api.data.gov.sg/v1/transport/taxi-availability?date_time={dt_url}"
-        
+
+from district_index import snapshot_coordinates
+from snapshot_archive import write_archive, day_path
+
+API_URL = "https://api.data.gov.sg/v1/transport/taxi-availability"
+MANIFEST = "data/manifest.tsv"
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+class RateLimiter:
+    # token bucket shared by all download threads, `rate` requests per second
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or max(1, int(rate))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.rate:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+
+
+class Manifest:
+    """
+    Append-only record of finished timestamps (`<dt_int>\\t<status>` per line).
+    Loaded once at start, so resuming does not stat every output file.
+    """
+    def __init__(self, fname=MANIFEST):
+        self.fname = fname
+        self.status = {}
+        if os.path.exists(fname):
+            with open(fname) as f:
+                for line in f:
+                    parts = line.rstrip('\n').split('\t')
+                    if len(parts) == 2:
+                        self.status[parts[0]] = parts[1]
+        os.makedirs(os.path.dirname(fname) or '.', exist_ok=True)
+        self.lock = threading.Lock()
+        self.f = open(fname, 'a')
+
+    def done(self, dt_int):
+        return self.status.get(dt_int) == 'ok'
+
+    def record(self, dt_int, status):
+        with self.lock:
+            self.status[dt_int] = status
+            self.f.write(f"{dt_int}\t{status}\n")
+            self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+
+def make_session(pool_size):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def fetch(session, url, limiter=None, retries=5, backoff=0.5, timeout=30):
+    # GET with exponential backoff (plus jitter) on connection errors and retryable statuses
+    for attempt in range(retries + 1):
+        if limiter is not None:
+            limiter.wait()
         try:
-            resp = requests.get(url=url)
-            data = resp.json()
-        except Exception as e:
-            print(e)
-            continue
+            resp = session.get(url=url, timeout=timeout)
+            if resp.status_code not in RETRY_STATUS:
+                resp.raise_for_status()
+                return resp.json()
+            err = requests.HTTPError(f"{resp.status_code} for {url}")
+        except (requests.ConnectionError, requests.Timeout) as e:
+            err = e
+        if attempt == retries:
+            raise err
+        time.sleep(backoff * 2 ** attempt * (1 + random.random()))
+
+
+def dt_strings(_dt):
+    _dt = str(_dt).replace(' ', 'T')
+    dt_int = _dt.replace('-', '').replace('T', '').replace(':', '')
+    return _dt, dt_int
+
+
+def download_one(session, _dt, base_url, out_dir, limiter=None, retries=5, archive=False):
+    _dt, dt_int = dt_strings(_dt)
+    year = _dt[:4]
+    dt_url = _dt.replace(':', '%3A')
+    url = f"{base_url}?date_time={dt_url}"
+
+    data = fetch(session, url, limiter=limiter, retries=retries)
+
+    if archive:
+        # packed into the day archive by the caller
+        return snapshot_coordinates(data)
+    os.makedirs(f"{out_dir}/{year}", exist_ok=True)
+    with open(f"{out_dir}/{year}/{dt_int}.json", "w") as f:
+        json.dump(data, f, indent=4)
+
+
+def download_data(start, end, freq='5Min', n_workers=1, out_dir='data', base_url=API_URL, rate=None,
+                  retries=5, manifest=None, archive=False):
+    """
+    Download every snapshot in pd.date_range(start, end, freq) into
+    {out_dir}/{year}/{dt_int}.json, or with archive=True into one packed
+    {out_dir}/{year}/{YYYYMMDD}.snap file per day (see snapshot_archive.py).
+    Up to n_workers requests are in flight on one pooled session, throttled to
+    `rate` requests per second when given. Finished timestamps go to the
+    manifest ({out_dir}/manifest.tsv by default) and are skipped on the next
+    run; failures are recorded and retried. Returns the timestamps that failed.
+    """
+    date_range = pd.date_range(start=start, end=end, freq=freq)
+    own_manifest = manifest is None
+    if own_manifest:
+        manifest = Manifest(os.path.join(out_dir, 'manifest.tsv'))
+    todo = [d for d in date_range if not manifest.done(dt_strings(d)[1])]
+
+    # archive mode: snapshots are held per day until the whole day is fetched
+    remaining = defaultdict(int)
+    for d in todo:
+        remaining[dt_strings(d)[1][:8]] += 1
+    day_buffers = defaultdict(dict)
+
+    def finish_day(day):
+        snapshots = day_buffers.pop(day, {})
+        if snapshots:
+            write_archive(day_path(out_dir, day), snapshots)
+        for dt_int in snapshots:
+            manifest.record(dt_int, 'ok')
+
+    session = make_session(n_workers)
+    limiter = RateLimiter(rate) if rate else None
+    failed = []
+    try:
+        with ThreadPoolExecutor(max_workers=n_workers) as pool:
+            futures = {pool.submit(download_one, session, d, base_url, out_dir, limiter, retries, archive): d
+                       for d in todo}
+            for fut in tqdm(as_completed(futures), total=len(futures)):
+                dt_int = dt_strings(futures[fut])[1]
+                day = dt_int[:8]
+                remaining[day] -= 1
+                try:
+                    result = fut.result()
+                except Exception as e:
+                    print(dt_int, e)
+                    manifest.record(dt_int, 'failed')
+                    failed.append(dt_int)
+                else:
+                    if not archive:
+                        manifest.record(dt_int, 'ok')
+                        continue
+                    day_buffers[day][dt_int] = result
+                if archive and remaining[day] == 0:
+                    finish_day(day)
+    finally:
+        # days cut short by an error are still written, so their snapshots are not fetched again
+        for day in list(day_buffers):
+            finish_day(day)
+        session.close()
+        if own_manifest:
+            manifest.close()
+    return failed
+
+
+def multiproc(n_proc, start, end, freq='5Min', **kwargs):
+    # the downloads are I/O bound, so the n_proc workers are threads sharing one connection pool
+    return download_data(start, end, freq=freq, n_workers=n_proc, **kwargs)
 
-        with open(f"data/{year}/{dt_int}.json", "w") as f:
-            json.dump(data, f, indent=4)
 
+if __name__ == "__main__":
+    import argparse
 
+    parser = argparse.ArgumentParser(description="Bulk download taxi-availability snapshots")
+    parser.add_argument('start')
+    parser.add_argument('end')
+    parser.add_argument('--freq', default='5Min')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--rate', type=float, default=None, help="max requests per second")
+    parser.add_argument('--out-dir', default='data')
+    parser.add_argument('--url', default=API_URL)
+    parser.add_argument('--archive', action='store_true', help="pack snapshots into one file per day")
+    args = parser.parse_args()
 
+    multiproc(args.workers, args.start, args.end, freq=args.freq, out_dir=args.out_dir, base_url=args.url,
+              rate=args.rate, archive=args.archive)
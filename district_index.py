@@ -0,0 +1,163 @@
+"""
+Bulk point-in-district labelling for raw taxi positions.
+
+DistrictIndex rasterises the district polygons of region1.geojson onto a
+regular lon/lat grid once. Cells lying strictly inside one district are
+labelled directly; only points in cells crossed by a district boundary get an
+exact containment test, against the few polygons touching that cell.
+
+Labels follow gpd.sjoin(points, country_gdf, how='left', predicate="within"):
+a point on a boundary or outside every district gets -1 (NaN name in the
+sjoin result).
+"""
+import json
+
+import numpy as np
+from shapely.geometry import shape, box, MultiPolygon, Polygon
+from shapely.prepared import prep
+
+try:
+    from shapely import contains_xy
+except ImportError:  # shapely < 2.0
+    from shapely.vectorized import contains as contains_xy
+
+COUNTRY_GEO = 'data/region1.geojson'
+OUTSIDE = -1
+BOUNDARY = -2
+
+
+def polygonal(geom):
+    # GeometryCollections in region1.geojson only hold polygons, keep those parts
+    if isinstance(geom, (Polygon, MultiPolygon)):
+        return geom
+    parts = []
+    for g in getattr(geom, 'geoms', []):
+        if isinstance(g, Polygon):
+            parts.append(g)
+        elif isinstance(g, MultiPolygon):
+            parts.extend(g.geoms)
+    return MultiPolygon(parts)
+
+
+def snapshot_coordinates(data_json):
+    """lon, lat float64 arrays of every taxi in a raw taxi-availability response."""
+    coords = [c for f in data_json['features'] for c in f['geometry']['coordinates']]
+    if not coords:
+        return np.empty(0), np.empty(0)
+    arr = np.asarray(coords, dtype=np.float64)[:, :2]
+    return arr[:, 0], arr[:, 1]
+
+
+class DistrictIndex:
+    def __init__(self, names, geoms, cell_size=0.0025):
+        self.names = np.asarray(names, dtype=object)
+        self.geoms = [polygonal(g) for g in geoms]
+        self.cell_size = cell_size
+
+        bounds = np.array([g.bounds for g in self.geoms])
+        self.x0, self.y0 = bounds[:, 0].min(), bounds[:, 1].min()
+        self.nx = int(np.ceil((bounds[:, 2].max() - self.x0) / cell_size)) + 1
+        self.ny = int(np.ceil((bounds[:, 3].max() - self.y0) / cell_size)) + 1
+
+        grid = np.full((self.ny, self.nx), OUTSIDE, dtype=np.int16)
+        candidates = {}
+        for i, (g, b) in enumerate(zip(self.geoms, bounds)):
+            pg = prep(g)
+            ix0, iy0 = self._cell(b[0], b[1])
+            ix1, iy1 = self._cell(b[2], b[3])
+            for iy in range(iy0, iy1 + 1):
+                for ix in range(ix0, ix1 + 1):
+                    x, y = self.x0 + ix * cell_size, self.y0 + iy * cell_size
+                    cell = box(x, y, x + cell_size, y + cell_size)
+                    if not pg.intersects(cell):
+                        continue
+                    if grid[iy, ix] == OUTSIDE and pg.contains_properly(cell):
+                        grid[iy, ix] = i
+                        continue
+                    candidates.setdefault(iy * self.nx + ix, []).append(i)
+
+        # a cell inside one district may still be touched by a neighbour's boundary
+        for cell_id, polys in candidates.items():
+            iy, ix = divmod(cell_id, self.nx)
+            if grid[iy, ix] >= 0:
+                polys.append(int(grid[iy, ix]))
+            grid[iy, ix] = BOUNDARY
+        self.grid = grid
+
+        # CSR layout of the boundary cells' candidate polygons, in feature order
+        cells = np.array(sorted(candidates), dtype=np.int64)
+        self.boundary_cells = cells
+        lists = [sorted(set(candidates[c])) for c in cells]
+        self.cand_ptr = np.zeros(len(cells) + 1, dtype=np.int64)
+        self.cand_ptr[1:] = np.cumsum([len(l) for l in lists])
+        self.cand_ids = np.array([p for l in lists for p in l], dtype=np.int16)
+
+    @classmethod
+    def from_geojson(cls, fname=COUNTRY_GEO, **kwargs):
+        with open(fname, "rb") as f:
+            country_json = json.load(f)
+        return cls.from_feature_collection(country_json, **kwargs)
+
+    @classmethod
+    def from_feature_collection(cls, country_json, **kwargs):
+        names = [feat['properties']['name'] for feat in country_json['features']]
+        geoms = [shape(feat['geometry']) for feat in country_json['features']]
+        return cls(names, geoms, **kwargs)
+
+    def _cell(self, x, y):
+        ix = min(max(int((x - self.x0) // self.cell_size), 0), self.nx - 1)
+        iy = min(max(int((y - self.y0) // self.cell_size), 0), self.ny - 1)
+        return ix, iy
+
+    def label(self, lon, lat):
+        """int16 district code per point (index into self.names), -1 if in none."""
+        lon = np.asarray(lon, dtype=np.float64)
+        lat = np.asarray(lat, dtype=np.float64)
+        out = np.full(lon.shape, OUTSIDE, dtype=np.int16)
+
+        ix = np.floor((lon - self.x0) / self.cell_size)
+        iy = np.floor((lat - self.y0) / self.cell_size)
+        inside = (ix >= 0) & (ix < self.nx) & (iy >= 0) & (iy < self.ny)
+        pts = np.flatnonzero(inside)
+        cell_ids = iy[pts].astype(np.int64) * self.nx + ix[pts].astype(np.int64)
+        labels = self.grid.ravel()[cell_ids]
+        out[pts] = np.where(labels == BOUNDARY, OUTSIDE, labels)
+
+        # exact tests for points in boundary cells, one vectorized call per polygon
+        on_edge = labels == BOUNDARY
+        if on_edge.any():
+            edge_pts = pts[on_edge]
+            slot = np.searchsorted(self.boundary_cells, cell_ids[on_edge])
+            n_cand = self.cand_ptr[slot + 1] - self.cand_ptr[slot]
+            pair_pt = np.repeat(edge_pts, n_cand)
+            starts = np.repeat(self.cand_ptr[slot] - np.cumsum(n_cand) + n_cand, n_cand)
+            pair_poly = self.cand_ids[starts + np.arange(len(pair_pt))]
+            # later polygons are visited first so the lowest feature index wins
+            for p in np.unique(pair_poly)[::-1]:
+                sel = pair_pt[pair_poly == p]
+                hit = contains_xy(self.geoms[p], lon[sel], lat[sel])
+                out[sel[hit]] = p
+        return out
+
+    def label_snapshots(self, snapshots):
+        """
+        Label many snapshots in one call. snapshots is a sequence of (lon, lat)
+        array pairs; returns the concatenated codes and offsets such that
+        codes[offsets[i]:offsets[i + 1]] belongs to snapshot i.
+        """
+        sizes = [len(lon) for lon, _ in snapshots]
+        offsets = np.zeros(len(sizes) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(sizes)
+        if offsets[-1] == 0:
+            return np.empty(0, dtype=np.int16), offsets
+        lon = np.concatenate([np.asarray(s[0], dtype=np.float64) for s in snapshots])
+        lat = np.concatenate([np.asarray(s[1], dtype=np.float64) for s in snapshots])
+        return self.label(lon, lat), offsets
+
+    def count(self, codes, offsets):
+        """int32 [snapshot, district] taxi counts; unlabelled points are dropped."""
+        n_snap, n_dist = len(offsets) - 1, len(self.names)
+        snap = np.repeat(np.arange(n_snap), np.diff(offsets))
+        keep = codes >= 0
+        flat = snap[keep] * n_dist + codes[keep]
+        return np.bincount(flat, minlength=n_snap * n_dist).reshape(n_snap, n_dist).astype(np.int32)
@@ -0,0 +1,100 @@
+"""
+Downsampling of long time series for the charts.
+
+A line chart cannot show more than about one point per horizontal pixel, so
+sending every hourly row of several years to the browser only makes the figure
+JSON bigger and slower to draw. The selections here keep what is visible at a
+given pixel width and return row indices, so all columns of a frame stay
+aligned:
+
+    lttb_indices        Largest-Triangle-Three-Buckets: at most n points, the
+                        ones that best preserve the shape of the line
+    minmax_indices      the lowest and highest point of each of n / 2 equal
+                        time buckets, so spikes and dips survive exactly
+
+NaN values (e.g. the start of a rolling average) are not selected; the first
+and last row of every NaN run are, so the gaps still show as gaps.
+
+    downsample_frame(taxigraph_data, 'filename', ['taxi_count', 'rolling_average'], 800)
+"""
+import numpy as np
+
+METHODS = ('lttb', 'minmax')
+
+
+def _as_float(x):
+    x = np.asarray(x)
+    if np.issubdtype(x.dtype, np.datetime64):
+        return x.astype('datetime64[ns]').astype(np.int64).astype(np.float64)
+    return x.astype(np.float64)
+
+
+def lttb_indices(x, y, n_out):
+    """Indices of at most n_out points of (x, y) picked by LTTB; x ascending, y finite."""
+    x, y = _as_float(x), np.asarray(y, dtype=np.float64)
+    n = len(x)
+    if n_out >= n:
+        return np.arange(n)
+    if n_out < 3:
+        return np.array([0, n - 1][:max(n_out, 0)], dtype=np.int64)
+    out = np.empty(n_out, dtype=np.int64)
+    out[0], out[-1] = 0, n - 1
+    # n_out - 2 buckets over the inner points
+    edges = np.floor(np.linspace(1, n - 1, n_out - 1)).astype(np.int64)
+    a = 0
+    for i in range(n_out - 2):
+        lo, hi = edges[i], max(edges[i + 1], edges[i] + 1)
+        # average of the next bucket (or the last point) is the third corner
+        nlo, nhi = edges[i + 1], edges[i + 2] if i + 2 < len(edges) else n
+        cx, cy = (x[nlo:nhi].mean(), y[nlo:nhi].mean()) if nhi > nlo else (x[-1], y[-1])
+        area = np.abs((x[a] - cx) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (cy - y[a]))
+        a = lo + int(np.argmax(area))
+        out[i + 1] = a
+    return out
+
+
+def minmax_indices(x, y, n_out):
+    """Indices of the min and max of y in each of n_out // 2 equal-width x buckets, in x order."""
+    x, y = _as_float(x), np.asarray(y, dtype=np.float64)
+    n = len(x)
+    n_buckets = max(n_out // 2, 1)
+    if n <= n_out:
+        return np.arange(n)
+    span = x[-1] - x[0]
+    bucket = np.minimum(((x - x[0]) / span * n_buckets).astype(np.int64), n_buckets - 1) if span else \
+        np.zeros(n, dtype=np.int64)
+    # within each bucket the first row by value is its min, the last its max
+    order = np.lexsort((y, bucket))
+    starts = np.flatnonzero(np.r_[True, bucket[order][1:] != bucket[order][:-1]])
+    ends = np.r_[starts[1:], n] - 1
+    return np.unique(np.r_[order[starts], order[ends]])
+
+
+def select(x, y, n_out, method='lttb'):
+    """
+    Row indices of (x, y) to keep for about n_out points, skipping NaNs in y
+    but keeping the first and last row of each NaN run.
+    """
+    if method not in METHODS:
+        raise ValueError(f"method must be one of {', '.join(METHODS)}")
+    y = np.asarray(y, dtype=np.float64)
+    finite = np.flatnonzero(np.isfinite(y))
+    pick = lttb_indices if method == 'lttb' else minmax_indices
+    keep = finite[pick(np.asarray(x)[finite], y[finite], n_out)] if len(finite) else np.empty(0, dtype=np.int64)
+    nan = ~np.isfinite(y)
+    edges = np.flatnonzero(np.diff(np.r_[False, nan, False].astype(np.int8)))
+    runs = edges.reshape(-1, 2)
+    return np.unique(np.r_[keep, runs[:, 0], runs[:, 1] - 1])
+
+
+def downsample_frame(df, x, columns, n_out, method='lttb'):
+    """
+    Rows of df (sorted by column x) selected for each of `columns` at about
+    n_out points per column, as one frame; a row picked for any column keeps
+    the values of all of them. Frames already within n_out rows come back as is.
+    """
+    if len(df) <= n_out:
+        return df
+    xs = df[x].values
+    rows = np.unique(np.concatenate([select(xs, df[c].values, n_out, method) for c in columns]))
+    return df.iloc[rows].reset_index(drop=True)
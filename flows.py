@@ -0,0 +1,191 @@
+"""
+Taxi flows between districts, estimated from consecutive raw snapshots.
+
+The feed has no taxi ids, so a taxi is followed from one snapshot to the next
+by position: a taxi in snapshot i and one in snapshot i + 1 are the same when
+each is the other's nearest neighbour and they are at most max_distance
+metres apart (mutual nearest neighbours, so every taxi is matched at most
+once). Taxis without such a partner were hired or became available in between
+and are not counted.
+
+Rather than one pairwise distance matrix (~5k x 5k) per snapshot pair,
+match_chunk() puts a whole chunk of snapshots into one cKDTree, each snapshot
+on its own plane of a third axis spaced further apart than max_distance, and
+finds every forward and backward neighbour with two batched queries. Matched
+pairs are labelled with DistrictIndex and summed per hour into sparse
+origin/destination counts:
+
+    hour         datetime64[h]   hour of the earlier snapshot of each pair
+    origin       district the taxi was in
+    destination  district it was in 5 minutes later (origin itself if it stayed)
+    taxis        matched taxis over the hour's snapshot pairs
+    pairs        snapshot pairs in the hour (taxis / pairs: moves per snapshot step)
+
+    python flows.py --raw-dir data --out data/analysis/district_flows.parquet
+"""
+from datetime import timedelta
+
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+
+from district_index import DistrictIndex
+from postal_index import project
+
+FLOWS = 'data/analysis/district_flows.parquet'
+# an available taxi rarely moves further in one 5-minute step; the typical spacing of taxis is ~200 m
+MAX_DISTANCE = 1000.0
+MAX_GAP = timedelta(minutes=10)  # snapshots further apart are not matched
+
+
+def match_chunk(snapshots, max_distance=MAX_DISTANCE, linked=None, workers=-1):
+    """
+    Mutual nearest-neighbour matches between consecutive (lon, lat) snapshots,
+    in one tree. Returns (src, dst, step): src and dst index the snapshots'
+    concatenated points, src in snapshot step and dst in snapshot step + 1.
+    linked: optional bool per consecutive pair, False for pairs not to match.
+    """
+    sizes = np.array([len(lon) for lon, _ in snapshots], dtype=np.int64)
+    n = int(sizes.sum())
+    empty = np.empty(0, dtype=np.int64)
+    if len(snapshots) < 2 or not n:
+        return empty, empty, empty
+    lon = np.concatenate([np.asarray(s[0], dtype=np.float64) for s in snapshots])
+    lat = np.concatenate([np.asarray(s[1], dtype=np.float64) for s in snapshots])
+    snap = np.repeat(np.arange(len(snapshots)), sizes)
+    # each snapshot on its own plane; planes further apart than max_distance never match each other
+    sep = 4.0 * max_distance
+    points = np.column_stack([project(lon, lat), snap * sep])
+    tree = cKDTree(points, leafsize=32, balanced_tree=False)
+
+    def nearest(sel, shift):
+        out = np.full(n, -1, dtype=np.int64)
+        query = points[sel]
+        query[:, 2] += shift
+        _, i = tree.query(query, k=1, distance_upper_bound=max_distance, workers=workers)
+        out[sel] = np.where(i < n, i, -1)
+        return out
+
+    forward = nearest(snap < len(snapshots) - 1, sep)
+    backward = nearest(snap > 0, -sep)
+    src = np.flatnonzero(forward >= 0)
+    dst = forward[src]
+    mutual = backward[dst] == src
+    src, dst = src[mutual], dst[mutual]
+    step = snap[src]
+    if linked is not None:
+        keep = np.asarray(linked, dtype=bool)[step]
+        src, dst, step = src[keep], dst[keep], step[keep]
+    return src, dst, step
+
+
+def chunk_flows(index, stamps, snapshots, max_distance=MAX_DISTANCE, max_gap=MAX_GAP, workers=-1):
+    """
+    (flows, pairs) of one chunk of snapshots taken at `stamps` (ascending):
+    flows has columns hour, origin, destination (district codes) and taxis,
+    pairs has hour and pairs, the snapshot pairs matched in each hour.
+    """
+    stamps = np.asarray(stamps, dtype='datetime64[ns]')
+    linked = np.diff(stamps) <= np.timedelta64(max_gap)
+    src, dst, step = match_chunk(snapshots, max_distance, linked, workers)
+    codes, _ = index.label_snapshots(snapshots)
+    origin, destination = codes[src].astype(np.int64), codes[dst].astype(np.int64)
+    known = (origin >= 0) & (destination >= 0)
+
+    hours = stamps[:-1].astype('datetime64[h]')
+    h0 = hours.min() if len(hours) else np.datetime64('NaT', 'h')
+    hour_idx = (hours - h0).astype(np.int64)
+    nd = len(index.names)
+    flat = (hour_idx[step[known]] * nd + origin[known]) * nd + destination[known]
+    counts = np.bincount(flat, minlength=(int(hour_idx.max()) + 1) * nd * nd if len(hours) else 0)
+    nz = np.flatnonzero(counts)
+    h, rest = np.divmod(nz, nd * nd)
+    flows = pd.DataFrame({'hour': h0 + h, 'origin': rest // nd, 'destination': rest % nd, 'taxis': counts[nz]})
+    per_hour = np.bincount(hour_idx[linked], minlength=int(hour_idx.max()) + 1 if len(hours) else 0)
+    seen = np.flatnonzero(per_hour)
+    return flows, pd.DataFrame({'hour': h0 + seen, 'pairs': per_hour[seen]})
+
+
+def estimate(raw_dir='data', index=None, max_distance=MAX_DISTANCE, max_gap=MAX_GAP, chunk_snapshots=288,
+             workers=-1):
+    """
+    District flows per hour (see the module docstring) over every raw snapshot
+    under raw_dir, read and matched chunk_snapshots at a time; the last
+    snapshot of a chunk is carried into the next, so no pair is lost at the seams.
+    """
+    from ingest import list_snapshots
+    from position_bins import read_snapshot
+
+    index = index or DistrictIndex.from_geojson()
+    items = sorted(list_snapshots(raw_dir).items())
+    times = pd.to_datetime([k for k, _ in items], format="%Y%m%d%H%M%S").values
+    flows, pairs, archives, carry = [], [], {}, None
+    for lo in range(0, len(items), chunk_snapshots):
+        stamps, snapshots = ([carry[0]], [carry[1]]) if carry else ([], [])
+        for (dt_int, path), t in zip(items[lo:lo + chunk_snapshots], times[lo:lo + chunk_snapshots]):
+            try:
+                snapshots.append(read_snapshot(dt_int, path, archives))
+                stamps.append(t)
+            except Exception as e:
+                print(path, dt_int, e)
+        if len(snapshots) > 1:
+            f, p = chunk_flows(index, stamps, snapshots, max_distance, max_gap, workers)
+            flows.append(f)
+            pairs.append(p)
+        if snapshots:
+            # a copy, so the day archive can be unmapped
+            carry = (stamps[-1], tuple(np.array(a) for a in snapshots[-1]))
+        archives.clear()
+
+    names = pd.CategoricalDtype(index.names)
+    if not flows:
+        return pd.DataFrame({'hour': pd.Series([], dtype='datetime64[ns]'), 'origin': pd.Categorical([], dtype=names),
+                             'destination': pd.Categorical([], dtype=names), 'taxis': np.array([], dtype=np.int64),
+                             'pairs': np.array([], dtype=np.int64)})
+    # an hour split over two chunks appears in both
+    flows = pd.concat(flows, ignore_index=True).groupby(['hour', 'origin', 'destination'], as_index=False).taxis.sum()
+    pairs = pd.concat(pairs, ignore_index=True).groupby('hour', as_index=False).pairs.sum()
+    out = flows.merge(pairs, on='hour', how='left')
+    for col in ('origin', 'destination'):
+        out[col] = pd.Categorical.from_codes(out[col].values, dtype=names)
+    out['hour'] = out.hour.values.astype('datetime64[ns]')
+    return out
+
+
+def od_matrix(flows, start=None, end=None, hours=None):
+    """
+    District x district mean taxis moving from origin (rows) to destination
+    (columns) per snapshot step, over the hours in [start, end] and, if given,
+    only those hours of the day.
+    """
+    sel = np.ones(len(flows), dtype=bool)
+    if start is not None:
+        sel &= flows.hour.values >= np.datetime64(pd.Timestamp(start))
+    if end is not None:
+        sel &= flows.hour.values <= np.datetime64(pd.Timestamp(end))
+    if hours is not None:
+        sel &= np.isin(flows.hour.dt.hour.values, list(hours))
+    flows = flows[sel]
+    steps = flows.drop_duplicates('hour').pairs.sum()
+    matrix = flows.pivot_table(index='origin', columns='destination', values='taxis', aggfunc='sum',
+                               fill_value=0, observed=False)
+    return matrix / steps if steps else matrix.astype(np.float64)
+
+
+if __name__ == "__main__":
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser(description="Taxi flows between districts from consecutive raw snapshots")
+    parser.add_argument('--raw-dir', default='data')
+    parser.add_argument('--max-distance', type=float, default=MAX_DISTANCE, help="metres")
+    parser.add_argument('--max-gap', type=float, default=MAX_GAP.total_seconds() / 60, help="minutes")
+    parser.add_argument('--chunk', type=int, default=288, help="snapshots matched per tree")
+    parser.add_argument('--out', default=FLOWS)
+    args = parser.parse_args()
+
+    t0 = time.perf_counter()
+    out = estimate(args.raw_dir, max_distance=args.max_distance, max_gap=timedelta(minutes=args.max_gap),
+                   chunk_snapshots=args.chunk)
+    out.to_parquet(args.out, index=False)
+    print(f"{args.out}: {len(out)} rows, {time.perf_counter() - t0:.1f}s")
@@ -0,0 +1,76 @@
+"""
+Simplified, pre-serialized district geometries for the folium choropleths.
+
+GeometryCache simplifies the region1.geojson districts once per tolerance
+level and keeps each district's GeoJSON geometry as a ready JSON string. A
+render only writes the small per-district properties and splices the cached
+geometry strings into a FeatureCollection, instead of deep-copying the
+GeoDataFrame and running to_json() on the full-resolution polygons.
+
+Shared district boundaries are simplified together when shapely provides
+coverage_simplify (shapely >= 2.1), so neighbouring districts keep a common
+edge; older versions fall back to per-district topology-preserving
+simplification.
+"""
+import json
+
+import shapely
+from shapely.geometry import shape, mapping
+
+from district_index import polygonal, COUNTRY_GEO
+
+# degrees; ~0.0005 is about one pixel for Singapore in a 750px wide map at zoom 11
+TOLERANCES = (0.0, 0.0002, 0.0005, 0.001)
+DEFAULT_TOLERANCE = 0.0005
+PRECISION = 5  # decimals kept in coordinates (~1 m)
+
+
+def _round_coords(coords):
+    if not len(coords):  # empty geometry or part
+        return coords
+    if isinstance(coords[0], (float, int)):
+        return [round(coords[0], PRECISION), round(coords[1], PRECISION)]  # drops z
+    return [_round_coords(c) for c in coords]
+
+
+def geometry_json(geom):
+    g = mapping(geom)
+    return json.dumps({'type': g['type'], 'coordinates': _round_coords(g['coordinates'])}, separators=(',', ':'))
+
+
+def simplify(geoms, tolerance):
+    if tolerance <= 0:
+        return list(geoms)
+    if hasattr(shapely, 'coverage_simplify'):
+        return list(shapely.coverage_simplify(geoms, tolerance))
+    return [g.simplify(tolerance, preserve_topology=True) for g in geoms]
+
+
+class GeometryCache:
+    def __init__(self, names, geoms, tolerances=TOLERANCES):
+        self.names = list(names)
+        self.geometry = {}  # tolerance -> {name: geometry json string}
+        for tol in tolerances:
+            self.geometry[tol] = {n: geometry_json(g) for n, g in zip(self.names, simplify(geoms, tol))}
+
+    @classmethod
+    def from_geojson(cls, fname=COUNTRY_GEO, **kwargs):
+        with open(fname, "rb") as f:
+            country_json = json.load(f)
+        names = [feat['properties']['name'] for feat in country_json['features']]
+        geoms = [polygonal(shape(feat['geometry'])) for feat in country_json['features']]
+        return cls(names, geoms, **kwargs)
+
+    def feature_collection(self, properties, tolerance=DEFAULT_TOLERANCE):
+        """
+        GeoJSON FeatureCollection string for the districts in `properties`
+        ({district name: properties dict}), in feature order; districts not in
+        `properties` are left out.
+        """
+        geometry = self.geometry[tolerance]
+        features = [
+            '{"type":"Feature","properties":%s,"geometry":%s}'
+            % (json.dumps(properties[n], separators=(',', ':')), geometry[n])
+            for n in self.names if n in properties
+        ]
+        return '{"type":"FeatureCollection","features":[%s]}' % ','.join(features)
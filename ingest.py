@@ -0,0 +1,235 @@
+"""
+Parallel, checkpointed ingestion of raw taxi-availability snapshots.
+
+Reads the {raw_dir}/{year}/{dt_int}.json tree written by data_download.py,
+or its packed {YYYYMMDD}.snap day archives, labels every taxi by district on a
+process pool and appends the per-district counts to the year partitions of the
+Parquet store (taxi_store.py) in large batches. A checkpoint log keeps the timestamps already written and the ones
+that failed, so a rerun only processes new or failed inputs; each batch appends
+one line to it rather than rewriting the history. Each batch is
+written as part-ingest-{generation} files, the generation being saved with the
+checkpoint: a run that stops between writing a batch and saving the checkpoint
+leaves files of the unsaved generation, which the next run replaces instead of
+adding the same rows again. The coverage
+index (coverage_index.py) is updated with the snapshots written or found empty.
+
+    python ingest.py --raw-dir data --workers 8
+"""
+import glob
+import json
+import os
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+import coverage_index
+import taxi_store
+from district_index import DistrictIndex, snapshot_coordinates, COUNTRY_GEO
+from snapshot_archive import SnapshotArchive, list_archives, SUFFIX
+
+RAW_DIR = 'data'
+CHECKPOINT = './data/analysis/ingest_checkpoint.json'
+MIN_TIMESTAMP = 20160112150000  # earlier blobs hold no data
+
+_index = None
+
+
+class Checkpoint:
+    """
+    Ingest progress as an append-only log, one JSON line per save with the
+    timestamps written, found empty and failed since the previous one and the
+    generation of the next batch. save() appends a line, so it costs O(batch)
+    however long the history; loading replays the lines. A line cut short by
+    a crash is skipped, and its batch is redone under the same generation. A
+    checkpoint saved whole as one JSON object reads as a one-line log.
+    """
+
+    def __init__(self, fname=CHECKPOINT):
+        self.fname = fname
+        self.done, self.empty, self.failed = set(), set(), {}
+        self.generation = 0  # of the next batch written
+        self._unsaved = {'done': [], 'empty': [], 'failed': {}}
+        self._open_line = False  # the file does not end with a newline
+        if os.path.exists(fname):
+            with open(fname) as f:
+                text = f.read()
+            self._open_line = bool(text) and not text.endswith('\n')
+            for line in text.splitlines():
+                try:
+                    state = json.loads(line)
+                except ValueError:
+                    continue
+                self.done.update(state.get('done', []))
+                self.empty.update(state.get('empty', []))
+                self.failed.update(state.get('failed', {}))
+                self.generation = state.get('generation', self.generation)
+            # a failure retried successfully later on
+            self.failed = {k: v for k, v in self.failed.items() if k not in self.done}
+
+    def add(self, done=(), empty=(), failed=None):
+        """Record timestamps written, found empty or failed ({dt_int: error}), until the next save()."""
+        for k in done:
+            self.done.add(k)
+            self.failed.pop(k, None)
+        self._unsaved['done'] += list(done)
+        self.empty.update(empty)
+        self._unsaved['empty'] += list(empty)
+        if failed:
+            self.failed.update(failed)
+            self._unsaved['failed'].update(failed)
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.fname) or '.', exist_ok=True)
+        line = json.dumps({'done': sorted(self._unsaved['done']), 'empty': sorted(self._unsaved['empty']),
+                           'failed': self._unsaved['failed'], 'generation': self.generation})
+        with open(self.fname, 'a') as f:
+            f.write(('\n' if self._open_line else '') + line + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self._unsaved = {'done': [], 'empty': [], 'failed': {}}
+        self._open_line = False
+
+
+def list_snapshots(raw_dir=RAW_DIR):
+    """
+    {dt_int: path} for every raw snapshot under raw_dir/{year}/, either a json
+    file or the day archive (snapshot_archive.py) holding it. Archives win
+    over json files for the same timestamp.
+    """
+    out = {}
+    for path in glob.glob(os.path.join(raw_dir, '[0-9][0-9][0-9][0-9]', '*.json')):
+        stem = os.path.basename(path)[:-5]
+        if stem.isdigit() and int(stem) >= MIN_TIMESTAMP:
+            out[stem] = path
+    for path in list_archives(raw_dir):
+        for ts in SnapshotArchive(path).timestamps:
+            if ts >= MIN_TIMESTAMP:
+                out[str(ts)] = path
+    return out
+
+
+def _init_worker(country_geo):
+    global _index
+    _index = DistrictIndex.from_geojson(country_geo)
+
+
+def process_chunk(items):
+    """
+    Worker: label a chunk of (dt_int, path) snapshots in one index call.
+    Returns (timestamps, region codes, counts, empty dt_ints, failures).
+    """
+    snapshots, names, failed, archives = [], [], {}, {}
+    for dt_int, path in items:
+        try:
+            if path.endswith(SUFFIX):
+                if path not in archives:
+                    archives[path] = SnapshotArchive(path)
+                xy = archives[path].snapshot(archives[path].find(dt_int))
+                snapshots.append((xy[:, 0], xy[:, 1]))
+            else:
+                with open(path) as f:
+                    snapshots.append(snapshot_coordinates(json.load(f)))
+            names.append(dt_int)
+        except Exception as e:
+            failed[dt_int] = f"{type(e).__name__}: {e}"
+
+    codes, offsets = _index.label_snapshots(snapshots)
+    counts = _index.count(codes, offsets)
+    snap, region = np.nonzero(counts)
+    stamps = np.array(names, dtype=np.int64)
+    empty = [n for n, size in zip(names, np.diff(offsets)) if size == 0]
+    return stamps[snap], region.astype(np.int16), counts[snap, region].astype(np.int16), empty, failed
+
+
+def _flush(buffers, names, store_dir, generation):
+    part = f'ingest-{generation:06d}'
+    # leftovers of a run that wrote this generation but stopped before saving the checkpoint
+    for path in glob.glob(os.path.join(store_dir, 'year=*', f'part-{part}.parquet')):
+        os.remove(path)
+    for year, parts in buffers.items():
+        stamps = np.concatenate([p[0] for p in parts])
+        region = np.concatenate([p[1] for p in parts])
+        df = pd.DataFrame({'region': names[region],
+                           'taxi_count': np.concatenate([p[2] for p in parts]),
+                           'filename': stamps})
+        taxi_store.write_partition(df, year, store_dir, part=part)
+    buffers.clear()
+
+
+def run(raw_dir=RAW_DIR, store_dir=taxi_store.STORE_DIR, checkpoint=CHECKPOINT, n_workers=None,
+        chunk_size=256, batch_rows=2_000_000, country_geo=COUNTRY_GEO, retry_failed=True,
+        coverage_file=coverage_index.COVERAGE):
+    """
+    Ingest every snapshot under raw_dir not yet in the checkpoint. Returns
+    {dt_int: error} for the snapshots that failed in this run.
+    """
+    ckpt = Checkpoint(checkpoint)
+    cov = coverage_index.Coverage.load(coverage_file)
+    snapshots = list_snapshots(raw_dir)
+    todo = sorted(k for k in snapshots
+                  if k not in ckpt.done and (retry_failed or k not in ckpt.failed))
+    if not todo:
+        return {}
+
+    names = DistrictIndex.from_geojson(country_geo).names
+    chunks = [[(k, snapshots[k]) for k in todo[i:i + chunk_size]] for i in range(0, len(todo), chunk_size)]
+
+    buffers, pending, n_rows, failed = {}, set(), 0, {}
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker, initargs=(country_geo,)) as pool:
+        futures = {pool.submit(process_chunk, c): c for c in chunks}
+        for fut in tqdm(as_completed(futures), total=len(futures)):
+            chunk = futures[fut]
+            try:
+                stamps, region, counts, empty, chunk_failed = fut.result()
+            except Exception:
+                err = traceback.format_exc(limit=1).strip().splitlines()[-1]
+                chunk_failed = {k: err for k, _ in chunk}
+                stamps, region, counts, empty = np.empty(0, np.int64), np.empty(0, np.int16), np.empty(0, np.int16), []
+            failed.update(chunk_failed)
+
+            years = stamps // 10 ** 10
+            for year in np.unique(years):
+                sel = years == year
+                buffers.setdefault(int(year), []).append((stamps[sel], region[sel], counts[sel]))
+            n_rows += len(stamps)
+            pending.update(k for k, _ in chunk if k not in chunk_failed)
+            ckpt.add(empty=empty, failed=chunk_failed)
+            cov.mark_counts(stamps, counts)
+            cov.mark(np.array(empty, dtype=np.int64), coverage_index.EMPTY)
+
+            if n_rows >= batch_rows:
+                _flush(buffers, names, store_dir, ckpt.generation)
+                ckpt.generation += 1
+                ckpt.add(done=sorted(pending))
+                ckpt.save()
+                cov.save(coverage_file)
+                pending, n_rows = set(), 0
+
+    _flush(buffers, names, store_dir, ckpt.generation)
+    ckpt.generation += 1
+    ckpt.add(done=sorted(pending))
+    ckpt.save()
+    cov.save(coverage_file)
+
+    if failed:
+        print(f"{len(failed)} snapshots failed, see {checkpoint}")
+    return failed
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Ingest raw taxi snapshots into the Parquet store")
+    parser.add_argument('--raw-dir', default=RAW_DIR)
+    parser.add_argument('--store-dir', default=taxi_store.STORE_DIR)
+    parser.add_argument('--checkpoint', default=CHECKPOINT)
+    parser.add_argument('--coverage', default=coverage_index.COVERAGE)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--skip-failed', action='store_true', help="do not retry snapshots that failed before")
+    args = parser.parse_args()
+
+    run(args.raw_dir, args.store_dir, args.checkpoint, n_workers=args.workers, retry_failed=not args.skip_failed,
+        coverage_file=args.coverage)
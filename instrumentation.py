@@ -0,0 +1,210 @@
+"""
+Per-rerun timing and cache instrumentation for the Streamlit app.
+
+Each script run of streamlit.py is one rerun: begin_rerun() at the top,
+`with stage(name) as s:` around every hot step (s['rows'] / s['bytes'] record
+data sizes), end_rerun() at the bottom. Functions decorated with cached()
+instead of st.cache count cache hits and misses.
+
+end_rerun() logs the rerun as one JSON line on the "cities_in_motion.perf"
+logger, appends it to $CIM_PERF_LOG when that is set (so several server
+processes can be aggregated offline with aggregate_log()) and folds it into
+the in-process aggregate shared by all sessions. debug_panel() shows both in
+the app when debugging is enabled (?debug=1 or CIM_DEBUG=1).
+
+The first rerun of a process also records first_render_s: the time from this
+module's import (the top of the process's first script run, streamlit.py
+imports it first) to the end of that rerun, which is the cold start a user
+waits through on a new instance.
+"""
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+logger = logging.getLogger("cities_in_motion.perf")
+
+PERF_LOG = os.environ.get('CIM_PERF_LOG')
+RECENT = 512  # samples kept per stage for percentiles
+
+_local = threading.local()
+_imported = time.perf_counter()
+_first_render = None
+
+
+class Aggregate:
+    # stage timings and cache counters across all reruns of this process
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reruns = 0
+        self.stages = defaultdict(lambda: {'count': 0, 'total_s': 0.0, 'max_s': 0.0, 'rows': 0, 'bytes': 0,
+                                           'recent': deque(maxlen=RECENT)})
+        self.cache = defaultdict(lambda: {'hits': 0, 'misses': 0})
+        self.first_renders = []
+
+    def add(self, record):
+        with self.lock:
+            self.reruns += 1
+            if 'first_render_s' in record:
+                self.first_renders.append(record['first_render_s'])
+            for s in record['stages']:
+                agg = self.stages[s['name']]
+                agg['count'] += 1
+                agg['total_s'] += s['seconds']
+                agg['max_s'] = max(agg['max_s'], s['seconds'])
+                agg['rows'] += s.get('rows') or 0
+                agg['bytes'] += s.get('bytes') or 0
+                agg['recent'].append(s['seconds'])
+            for name, c in record['cache'].items():
+                self.cache[name]['hits'] += c['hits']
+                self.cache[name]['misses'] += c['misses']
+
+    def summary(self):
+        with self.lock:
+            stages = {}
+            for name, agg in self.stages.items():
+                recent = sorted(agg['recent'])
+                stages[name] = {
+                    'count': agg['count'], 'mean_s': agg['total_s'] / agg['count'], 'max_s': agg['max_s'],
+                    'p50_s': recent[len(recent) // 2], 'p95_s': recent[int(len(recent) * 0.95)],
+                    'rows': agg['rows'], 'bytes': agg['bytes'],
+                }
+            first = sorted(self.first_renders)
+            return {'reruns': self.reruns, 'stages': stages, 'cache': {k: dict(v) for k, v in self.cache.items()},
+                    'first_render': {'count': len(first), 'p50_s': first[len(first) // 2], 'max_s': first[-1]}
+                    if first else None}
+
+
+aggregate = Aggregate()
+
+
+def _current():
+    return getattr(_local, 'rerun', None)
+
+
+def begin_rerun():
+    _local.rerun = {'started': time.time(), 't0': time.perf_counter(), 'stages': [],
+                    'cache': defaultdict(lambda: {'hits': 0, 'misses': 0})}
+
+
+@contextmanager
+def stage(name, **sizes):
+    """Time a step of the current rerun; set info['rows'] / info['bytes'] inside the block."""
+    info = {'name': name}
+    info.update(sizes)
+    t0 = time.perf_counter()
+    try:
+        yield info
+    finally:
+        info['seconds'] = time.perf_counter() - t0
+        rerun = _current()
+        if rerun is not None:
+            rerun['stages'].append(info)
+
+
+def record_cache(name, hit):
+    rerun = _current()
+    if rerun is not None:
+        rerun['cache'][name]['hits' if hit else 'misses'] += 1
+    else:
+        with aggregate.lock:
+            aggregate.cache[name]['hits' if hit else 'misses'] += 1
+
+
+def cached(cache_decorator, **cache_kwargs):
+    """
+    Drop-in for `@cache_decorator(**cache_kwargs)` (e.g. st.cache) that also
+    times each call as a stage and counts a miss whenever the body runs.
+    """
+    def deco(fn):
+        @functools.wraps(fn)
+        def body(*args, **kwargs):
+            _local.calls[-1] = True  # body ran: miss
+            return fn(*args, **kwargs)
+
+        cached_fn = cache_decorator(**cache_kwargs)(body)
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            # a stack, as cached functions may call each other
+            if not hasattr(_local, 'calls'):
+                _local.calls = []
+            _local.calls.append(False)
+            try:
+                with stage(fn.__name__):
+                    out = cached_fn(*args, **kwargs)
+            finally:
+                miss = _local.calls.pop()
+            record_cache(fn.__name__, hit=not miss)
+            return out
+        return wrapper
+    return deco
+
+
+def end_rerun():
+    global _first_render
+    rerun = _current()
+    if rerun is None:
+        return None
+    _local.rerun = None
+    now = time.perf_counter()
+    record = {
+        'ts': rerun['started'],
+        'total_s': now - rerun['t0'],
+        'stages': rerun['stages'],
+        'cache': {k: dict(v) for k, v in rerun['cache'].items()},
+    }
+    with aggregate.lock:
+        first = _first_render is None
+        if first:
+            _first_render = now - _imported
+    if first:
+        record['first_render_s'] = _first_render
+    aggregate.add(record)
+    line = json.dumps(record)
+    logger.info(line)
+    if PERF_LOG:
+        with open(PERF_LOG, 'a') as f:
+            f.write(line + '\n')
+    return record
+
+
+def aggregate_log(fname=PERF_LOG):
+    # fold a CIM_PERF_LOG file (possibly written by several processes) into one summary
+    agg = Aggregate()
+    with open(fname) as f:
+        for line in f:
+            agg.add(json.loads(line))
+    return agg.summary()
+
+
+def debug_enabled(st):
+    if os.environ.get('CIM_DEBUG') == '1':
+        return True
+    try:
+        return st.experimental_get_query_params().get('debug', ['0'])[0] == '1'
+    except Exception:
+        return False
+
+
+def debug_panel(st, record):
+    """Show this rerun's stages and the process-wide aggregate in an expander."""
+    import pandas as pd
+
+    with st.expander("Performance (debug)", expanded=False):
+        st.write(f"Rerun total: {record['total_s'] * 1000:.1f} ms")
+        if _first_render is not None:
+            st.write(f"First render of this process: {_first_render:.2f} s")
+        stages = pd.DataFrame(record['stages'])
+        if len(stages):
+            stages['ms'] = (stages.pop('seconds') * 1000).round(2)
+        st.dataframe(stages)
+        st.write("Cache hits / misses this rerun", record['cache'])
+        summary = aggregate.summary()
+        st.write(f"All sessions: {summary['reruns']} reruns")
+        st.dataframe(pd.DataFrame(summary['stages']).T)
+        st.write("Cache hits / misses, all sessions", summary['cache'])
@@ -0,0 +1,292 @@
+"""
+Live incremental mode: poll the taxi-availability feed and fold every new
+snapshot into the loaded aggregates.
+
+LiveFeed asks the feed (the data.gov.sg API, or `stub_server.py --replay` as a
+local stand-in) for each 5-minute slot since its last poll, labels the taxis by
+district with DistrictIndex and appends the per-district counts to the count
+cube, the monthly rollup, the series store and, if given, the time pyramid.
+Each only touches the cells and series of the new rows, so an update costs
+O(new snapshots) and nothing is reloaded. Over a memory-mapped shared dataset
+the series store and the pyramid keep the mapped arrays and append to small
+private tails; the count cube (~25 MB for 2016-2021) is copied on the first
+update. RunningStats keeps the mean and variance of every (district, hour)
+with Welford updates, seeded from the series store's running sums.
+
+Updates are applied under `feed.lock`; readers hold it around their queries.
+`feed.version` changes with every update, so result caches keyed on it
+(result_cache.py) go stale as soon as new data lands. The counts are kept in
+memory only; with raw_dir the snapshots are also written as data_download.py
+writes them, for ingest.py to add to the parquet store later.
+
+    python stub_server.py --port 8000 --replay data
+    CIM_LIVE_URL=http://localhost:8000/v1/transport/taxi-availability streamlit run streamlit.py
+"""
+import json
+import logging
+import os
+import threading
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+import coverage_index
+from count_cube import CountCube
+from data_download import API_URL, dt_strings, fetch, make_session
+from district_index import DistrictIndex, snapshot_coordinates, COUNTRY_GEO
+from series_store import ALL
+from taxi_store import region_codes, region_names
+
+logger = logging.getLogger("cities_in_motion.live")
+
+STEP = timedelta(minutes=5)
+TZ = 'Asia/Singapore'
+
+
+def feed_now():
+    # the feed's timestamps are Singapore local time without an offset
+    return pd.Timestamp.now(tz=TZ).tz_localize(None).to_pydatetime()
+
+
+def floor_slot(t):
+    return datetime.min + (t - datetime.min) // STEP * STEP
+
+
+def snapshot_frame(stamps, counts, names):
+    """
+    Rows in the layout of taxi_store.load_taxi_count() for int [snapshot,
+    district] counts taken at `stamps`: one row per district with taxis.
+    """
+    snap, region = np.nonzero(counts)
+    return pd.DataFrame({'region': pd.Categorical.from_codes(region, categories=list(names)),
+                         'taxi_count': counts[snap, region].astype(np.int16)},
+                        index=pd.DatetimeIndex(np.asarray(stamps, dtype='datetime64[ns]')[snap], name='filename'))
+
+
+class RunningStats:
+    """
+    Mean and variance of taxi_count per (region, hour of day), updated with
+    each batch of new rows by the parallel (Chan et al.) form of Welford's
+    algorithm, so no past row is read again.
+    """
+    def __init__(self, regions=()):
+        self.regions = list(regions)
+        self.region_index = {r: i for i, r in enumerate(self.regions)}
+        self.n = np.zeros((len(self.regions), 24), dtype=np.int64)
+        self.mean = np.zeros((len(self.regions), 24))
+        self.m2 = np.zeros((len(self.regions), 24))  # sum of squared deviations from the mean
+
+    @classmethod
+    def from_series_store(cls, store):
+        # seeded from the running sums at the end of every (region, hour) series
+        stats = cls(store.regions)
+        for (region, hour), s in store.series.items():
+            if region == ALL or not s.n:
+                continue
+            i = stats.region_index[region]
+            total, squares = (float(v) for v in s.totals())
+            stats.n[i, hour] = s.n
+            stats.mean[i, hour] = total / s.n
+            stats.m2[i, hour] = max(squares - total * total / s.n, 0.0)
+        return stats
+
+    def update(self, frame):
+        """Fold rows (index: snapshot time, columns region, taxi_count) into the accumulators."""
+        if not len(frame):
+            return
+        new = [r for r in region_names(frame.region) if r not in self.region_index]
+        if new:
+            for r in new:
+                self.region_index[r] = len(self.regions)
+                self.regions.append(r)
+            grow = ((0, len(new)), (0, 0))
+            self.n, self.mean, self.m2 = (np.pad(a, grow) for a in (self.n, self.mean, self.m2))
+
+        ts = frame.index.values.astype('datetime64[h]')
+        flat = region_codes(frame.region, self.regions) * 24 + (ts - ts.astype('datetime64[D]')).astype(np.int64)
+        values = frame.taxi_count.values.astype(np.float64)
+        size = self.n.size
+        # the batch's own count, mean and squared deviations per cell (two passes over the new rows only)
+        n_b = np.bincount(flat, minlength=size).reshape(self.n.shape)
+        seen = n_b > 0
+        mean_b = np.divide(np.bincount(flat, weights=values, minlength=size).reshape(self.n.shape), n_b,
+                           out=np.zeros(self.n.shape), where=seen)
+        m2_b = np.bincount(flat, weights=(values - mean_b.reshape(-1)[flat]) ** 2, minlength=size).reshape(
+            self.n.shape)
+
+        n = self.n + n_b
+        delta = mean_b - self.mean
+        safe_n = np.maximum(n, 1)
+        self.mean = np.where(seen, self.mean + delta * n_b / safe_n, self.mean)
+        self.m2 = np.where(seen, self.m2 + m2_b + delta ** 2 * self.n * n_b / safe_n, self.m2)
+        self.n = n
+
+    def std(self):
+        # sample standard deviation, NaN below two rows
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.n > 1, np.sqrt(self.m2 / (self.n - 1)), np.nan)
+
+    def deviation(self, frame):
+        """
+        frame's rows with the mean and std of their (region, hour) so far and
+        their z-score, as a frame with columns region, taxi_count, mean, std, z.
+        """
+        ts = frame.index.values.astype('datetime64[h]')
+        codes = region_codes(frame.region, self.regions)
+        hours = (ts - ts.astype('datetime64[D]')).astype(np.int64)
+        known = codes >= 0
+        mean = np.full(len(frame), np.nan)
+        std = np.full(len(frame), np.nan)
+        mean[known] = self.mean[codes[known], hours[known]]
+        std[known] = self.std()[codes[known], hours[known]]
+        count = frame.taxi_count.values.astype(np.float64)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            z = (count - mean) / std
+        return pd.DataFrame({'region': np.asarray(frame.region.astype(str)), 'taxi_count': count,
+                             'mean': mean, 'std': std, 'z': z}, index=frame.index)
+
+
+class LiveFeed:
+    """
+    Polls `url` for new snapshots and appends them to `rollup` (and so its
+    cube), `series_store` and `pyramid` (optional, a TimePyramid). At most `backlog` slots are fetched per poll,
+    the most recent ones. A slot that fails is retried on the next poll, and
+    the later slots of that poll wait for it, so every series stays in time
+    order. With a coverage index the snapshots are marked there, and those it
+    drops (excluded or anomalous, see coverage_index.py) are not appended.
+    """
+    def __init__(self, rollup, series_store, url=API_URL, coverage=None, country_geo=COUNTRY_GEO, backlog=12,
+                 raw_dir=None, retries=2, clock=feed_now, pyramid=None):
+        self.rollup, self.series_store, self.pyramid = rollup, series_store, pyramid
+        self.url, self.coverage, self.raw_dir = url, coverage, raw_dir
+        self.backlog, self.retries, self.clock = backlog, retries, clock
+        self.index = DistrictIndex.from_geojson(country_geo)
+        self.stats = RunningStats.from_series_store(series_store)
+        self.session = make_session(1)
+        self.lock = threading.RLock()
+        self.updates = 0  # polls that added snapshots
+        self.snapshots = 0
+        self.latest = None  # time of the newest snapshot added
+        self.latest_frame = snapshot_frame([], np.zeros((0, len(self.index.names)), dtype=np.int32),
+                                           self.index.names)
+        self.next_slot = None
+        self.errors = {}  # slot -> last error
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def cube(self):
+        return self.rollup.cube
+
+    @property
+    def version(self):
+        # part of the result cache version: every update makes new query results
+        return f"live{self.updates}"
+
+    def due(self):
+        """The 5-minute slots to fetch now, oldest first."""
+        last = floor_slot(self.clock())
+        first = last - (self.backlog - 1) * STEP
+        if self.next_slot is not None:
+            first = max(first, self.next_slot)
+        return [first + i * STEP for i in range(int((last - first) // STEP) + 1)] if first <= last else []
+
+    def fetch(self, slot):
+        _dt, dt_int = dt_strings(slot)
+        data = fetch(self.session, f"{self.url}?date_time={_dt.replace(':', '%3A')}", retries=self.retries)
+        if self.raw_dir:
+            os.makedirs(f"{self.raw_dir}/{_dt[:4]}", exist_ok=True)
+            with open(f"{self.raw_dir}/{_dt[:4]}/{dt_int}.json", "w") as f:
+                json.dump(data, f)
+        return snapshot_coordinates(data)
+
+    def poll(self):
+        """Fetch and add every slot due. Returns the number of snapshots added."""
+        slots, snapshots = [], []
+        for slot in self.due():
+            try:
+                snapshots.append(self.fetch(slot))
+            except Exception as e:
+                self.errors[slot] = f"{type(e).__name__}: {e}"
+                logger.warning("live snapshot %s failed: %s", slot, self.errors[slot])
+                break
+            self.errors.pop(slot, None)
+            slots.append(slot)
+        if slots:
+            self.apply(slots, snapshots)
+        return len(slots)
+
+    def apply(self, slots, snapshots):
+        """Label the (lon, lat) snapshots taken at `slots` and append their counts."""
+        codes, offsets = self.index.label_snapshots(snapshots)
+        counts = self.index.count(codes, offsets)
+        stamps = np.array(slots, dtype='datetime64[ns]')
+        keep = np.ones(len(slots), dtype=bool)
+        with self.lock:
+            if self.coverage is not None:
+                totals = counts.sum(axis=1)
+                self.coverage.mark(stamps[totals > 0], coverage_index.PRESENT, totals[totals > 0])
+                self.coverage.mark(stamps[totals == 0], coverage_index.EMPTY)
+                keep = ~self.coverage.drop_mask(stamps)
+            frame = snapshot_frame(stamps[keep], counts[keep], self.index.names)
+            self.rollup.append(frame)  # appends to the cube too
+            self.series_store.append(frame)
+            if self.pyramid is not None:
+                self.pyramid.append(frame)
+            self.stats.update(frame)
+            if len(frame):
+                self.latest = frame.index.max().to_pydatetime()
+                self.latest_frame = frame[frame.index == frame.index.max()]
+                # analysis windows may now run up to the newest snapshot
+                self.cube.analysis_end = max(CountCube.analysis_end, self.latest + STEP)
+            self.next_slot = slots[-1] + STEP
+            self.snapshots += len(frame.index.unique())
+            self.updates += 1
+
+    def run(self, interval=60):
+        while not self._stop.is_set():
+            try:
+                self.poll()
+            except Exception:
+                logger.exception("live poll failed")
+            self._stop.wait(interval)
+
+    def start(self, interval=60):
+        """Poll every `interval` seconds on a daemon thread."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.run, args=(interval,), daemon=True, name='live-feed')
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+
+if __name__ == "__main__":
+    import argparse
+    import time
+
+    import shared_dataset
+    import taxi_store
+    from monthly_rollup import MonthlyRollup
+
+    parser = argparse.ArgumentParser(description="Poll the taxi feed and keep the district aggregates current")
+    parser.add_argument('--url', default=API_URL)
+    parser.add_argument('--interval', type=float, default=60, help="seconds between polls")
+    parser.add_argument('--raw-dir', default=None, help="also save the snapshots here for ingest.py")
+    args = parser.parse_args()
+
+    shared = shared_dataset.attach(taxi_store.dataset_version())
+    feed = LiveFeed(MonthlyRollup(shared.cube), shared.series_store, url=args.url, raw_dir=args.raw_dir,
+                    pyramid=shared.pyramid)
+    while True:
+        t0 = time.perf_counter()
+        n = feed.poll()
+        if n:
+            top = feed.stats.deviation(feed.latest_frame).sort_values('z', key=abs, ascending=False).head(5)
+            print(f"{feed.latest}: {n} snapshots in {time.perf_counter() - t0:.2f}s; largest deviations:")
+            print(top.round(2).to_string(index=False))
+        time.sleep(args.interval)
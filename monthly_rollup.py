@@ -0,0 +1,113 @@
+"""
+Materialized (region, year-month, hour) taxi count totals for the animated
+bar chart.
+
+MonthlyRollup holds the sum of taxi_count and the number of snapshots per
+region, month and hour of day. It is built from a CountCube at load time and
+updated with append() as rows arrive. A query takes whole months from the
+table and only sums the partial months at either end of the range from the
+cube's day slices.
+"""
+import numpy as np
+import pandas as pd
+
+from count_cube import DAY
+from taxi_store import region_codes
+
+
+class MonthlyRollup:
+    def __init__(self, cube):
+        self.cube = cube
+        self.regions = cube.regions
+        self.month0 = cube.day0.astype('datetime64[M]')
+        self.sums = np.zeros((0, 0, 24))
+        self.counts = np.zeros((0, 0, 24), dtype=np.uint32)
+        self._rebuild()
+
+    def _rebuild(self):
+        # month totals straight from the cube's day axis
+        cube = self.cube
+        self.regions = cube.regions
+        self.month0 = cube.day0.astype('datetime64[M]')
+        days = cube.day0 + np.arange(cube.n_days) * DAY
+        month_idx = (days.astype('datetime64[M]') - self.month0).astype(np.int64)
+        starts = np.flatnonzero(np.r_[True, np.diff(month_idx) > 0]) if len(days) else np.empty(0, dtype=np.int64)
+        if len(starts):
+            self.sums = np.add.reduceat(cube.sums, starts, axis=1)
+            self.counts = np.add.reduceat(cube.counts.astype(np.uint32), starts, axis=1)
+        else:
+            self.sums = np.zeros((len(self.regions), 0, 24))
+            self.counts = np.zeros((len(self.regions), 0, 24), dtype=np.uint32)
+
+    @property
+    def n_months(self):
+        return self.sums.shape[1]
+
+    def append(self, frame):
+        """
+        Add new rows to the cube and to the month totals. Only the cells of the
+        new rows are touched unless the cube had to grow its regions or move
+        its first day.
+        """
+        if not len(frame):
+            return
+        cube = self.cube
+        regions_before, day0_before = list(cube.regions), cube.day0
+        cube.append(frame)
+        if list(cube.regions) != regions_before or cube.day0 != day0_before:
+            self._rebuild()
+            return
+
+        ts = frame.index.values.astype('datetime64[h]')
+        months = (ts.astype('datetime64[M]') - self.month0).astype(np.int64)
+        if months.max() >= self.n_months:
+            grow = months.max() + 1 - self.n_months
+            self.sums = np.concatenate([self.sums, np.zeros((len(self.regions), grow, 24))], axis=1)
+            self.counts = np.concatenate(
+                [self.counts, np.zeros((len(self.regions), grow, 24), dtype=self.counts.dtype)], axis=1)
+        codes = region_codes(frame.region, self.regions)
+        hours = (ts - ts.astype('datetime64[D]')).astype(np.int64)
+        np.add.at(self.sums, (codes, months, hours), frame.taxi_count.values)
+        np.add.at(self.counts, (codes, months, hours), 1)
+
+    def totals(self, hour, start, end):
+        """
+        [region, month] sums and snapshot counts at `hour` over the snapshots
+        in [start, end], plus the first month as datetime64[M].
+        """
+        cube, h = self.cube, int(hour)
+        lo, hi = cube.day_range(start, end, h)
+        if lo >= hi:
+            return np.zeros((len(self.regions), 0)), np.zeros((len(self.regions), 0), dtype=np.int64), self.month0
+        day_month = lambda d: int(((cube.day0 + d * DAY).astype('datetime64[M]') - self.month0).astype(np.int64))
+        m_lo, m_hi = day_month(lo), day_month(hi - 1)
+        sums = self.sums[:, m_lo:m_hi + 1, h].copy()
+        counts = self.counts[:, m_lo:m_hi + 1, h].astype(np.int64)
+
+        # partial months at either end come from the cube's days
+        first_day = int(((self.month0 + m_lo).astype('datetime64[D]') - cube.day0) // DAY)
+        if first_day < lo:
+            sums[:, 0] -= cube.sums[:, max(first_day, 0):lo, h].sum(axis=1)
+            counts[:, 0] -= cube.counts[:, max(first_day, 0):lo, h].sum(axis=1, dtype=np.int64)
+        next_day = int(((self.month0 + m_hi + 1).astype('datetime64[D]') - cube.day0) // DAY)
+        if hi < next_day:
+            sums[:, -1] -= cube.sums[:, hi:next_day, h].sum(axis=1)
+            counts[:, -1] -= cube.counts[:, hi:next_day, h].sum(axis=1, dtype=np.int64)
+        return sums, counts, self.month0 + m_lo
+
+    def frame(self, hour, start, end):
+        """
+        Animation frames for the bar chart: one row per district and month
+        with snapshots, columns District, taxi_count, Date ("YYYY-M"), sorted
+        by district then month.
+        """
+        sums, counts, first = self.totals(hour, start, end)
+        r, m = np.nonzero(counts > 0)
+        months = first + m
+        years = months.astype('datetime64[Y]').astype(np.int64) + 1970
+        month_nums = months.astype(np.int64) % 12 + 1
+        return pd.DataFrame({
+            'District': self.regions[r],
+            'taxi_count': np.rint(sums[r, m]).astype(np.int64),
+            'Date': [f"{y}-{mo}" for y, mo in zip(years, month_nums)],
+        })
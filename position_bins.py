@@ -0,0 +1,209 @@
+"""
+Hourly taxi density on a fixed lon/lat grid, binned from the raw snapshots.
+
+Every raw position (json snapshot or day archive, as listed by
+ingest.list_snapshots) falls into one square cell of GRID, about 280 m on a
+side. For every hour the cells' taxi totals over that hour's snapshots are
+kept sparsely, together with the number of snapshots, one file per day:
+
+    {bins_dir}/{year}/{YYYYMMDD}.npz
+        hours       int64[H]        hours since the epoch, ascending
+        snapshots   uint16[H]       snapshots binned in that hour
+        offsets     int64[H + 1]    hour h is rows offsets[h]:offsets[h + 1]
+        cells       int32[nnz]      flat cell index, iy * nx + ix
+        counts      uint32[nnz]     taxis seen in the cell over the hour
+        listed      int64[]         raw snapshots of the day when it was binned
+
+A density map for any time range is then a bincount over the rows of the
+hours in range, divided by the number of snapshots: the mean number of taxis
+per cell, a few thousand cells instead of every point of every snapshot.
+
+A day is binned again when more raw snapshots are listed for it than when
+its file was written, e.g. after data_download.py has fetched the rest of
+today, so rerunning build() keeps the latest day current.
+
+    python position_bins.py --raw-dir data --bins-dir data/bins
+"""
+import glob
+import json
+import os
+from collections import defaultdict
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+from district_index import snapshot_coordinates
+from snapshot_archive import SnapshotArchive, SUFFIX
+
+BINS_DIR = './data/bins'
+# covers region1.geojson with a margin; cell size as DistrictIndex's grid
+GRID = {'x0': 103.55, 'y0': 1.13, 'cell_size': 0.0025, 'nx': 240, 'ny': 144}
+
+
+def cell_index(lon, lat, grid=GRID):
+    """Flat cell index per point, -1 outside the grid."""
+    ix = np.floor((np.asarray(lon, dtype=np.float64) - grid['x0']) / grid['cell_size'])
+    iy = np.floor((np.asarray(lat, dtype=np.float64) - grid['y0']) / grid['cell_size'])
+    inside = (ix >= 0) & (ix < grid['nx']) & (iy >= 0) & (iy < grid['ny'])
+    return np.where(inside, iy * grid['nx'] + ix, -1).astype(np.int32)
+
+
+def cell_centres(cells, grid=GRID):
+    iy, ix = np.divmod(np.asarray(cells, dtype=np.int64), grid['nx'])
+    return grid['x0'] + (ix + 0.5) * grid['cell_size'], grid['y0'] + (iy + 0.5) * grid['cell_size']
+
+
+def day_path(bins_dir, day):
+    # day: 'YYYYMMDD'
+    return os.path.join(bins_dir, day[:4], day + '.npz')
+
+
+def _dt_hours(dt_ints):
+    # yyyymmddHHMMSS ints -> hours since the epoch
+    stamps = pd.to_datetime(np.asarray(dt_ints).astype(np.int64).astype(str), format="%Y%m%d%H%M%S")
+    return stamps.values.astype('datetime64[h]').astype(np.int64)
+
+
+def bin_snapshots(dt_ints, snapshots, grid=GRID):
+    """Day file arrays (see module doc) for (lon, lat) snapshots taken at dt_ints."""
+    hours = _dt_hours(dt_ints)
+    uniq_hours, snap_hour = np.unique(hours, return_inverse=True)
+    n_snap = np.bincount(snap_hour, minlength=len(uniq_hours)).astype(np.uint16)
+
+    n_cells = grid['nx'] * grid['ny']
+    sizes = np.array([len(lon) for lon, _ in snapshots], dtype=np.int64)
+    lon = np.concatenate([s[0] for s in snapshots]) if len(snapshots) else np.empty(0)
+    lat = np.concatenate([s[1] for s in snapshots]) if len(snapshots) else np.empty(0)
+    cells = cell_index(lon, lat, grid).astype(np.int64)
+    point_hour = np.repeat(snap_hour, sizes)
+    keep = cells >= 0
+    keys, counts = np.unique(point_hour[keep] * n_cells + cells[keep], return_counts=True)
+    key_hour = keys // n_cells
+
+    offsets = np.zeros(len(uniq_hours) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(key_hour, minlength=len(uniq_hours)))
+    return {
+        'hours': uniq_hours.astype(np.int64), 'snapshots': n_snap, 'offsets': offsets,
+        'cells': (keys % n_cells).astype(np.int32), 'counts': counts.astype(np.uint32),
+    }
+
+
+def write_day(path, bins):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp = path + '.tmp.npz'
+    np.savez_compressed(tmp, **bins)
+    os.replace(tmp, path)
+    return path
+
+
+def read_day(path):
+    with np.load(path) as f:
+        return {k: f[k] for k in f.files}
+
+
+def listed_snapshots(path):
+    # raw snapshots the day file was built from; older files only have the binned ones
+    with np.load(path) as f:
+        return int(f['listed']) if 'listed' in f.files else int(f['snapshots'].sum())
+
+
+def read_snapshot(dt_int, path, archives):
+    # (lon, lat) of one snapshot from a json file or a day archive (archives: open SnapshotArchives by path)
+    if path.endswith(SUFFIX):
+        if path not in archives:
+            archives[path] = SnapshotArchive(path)
+        xy = archives[path].snapshot(archives[path].find(dt_int))
+        return xy[:, 0], xy[:, 1]
+    with open(path) as f:
+        return snapshot_coordinates(json.load(f))
+
+
+def build(raw_dir='data', bins_dir=BINS_DIR, overwrite=False):
+    """
+    Bin every day of raw snapshots under raw_dir that has no day file yet or
+    more snapshots than its file was built from (or all of them with
+    overwrite). Returns the day files written.
+    """
+    from ingest import list_snapshots
+
+    days = defaultdict(list)
+    for dt_int, path in list_snapshots(raw_dir).items():
+        days[dt_int[:8]].append((dt_int, path))
+
+    written = []
+    for day in tqdm(sorted(days)):
+        out = day_path(bins_dir, day)
+        if not overwrite and os.path.exists(out) and listed_snapshots(out) >= len(days[day]):
+            continue
+        stamps, snapshots, archives = [], [], {}
+        for dt_int, path in sorted(days[day]):
+            try:
+                snapshots.append(read_snapshot(dt_int, path, archives))
+                stamps.append(int(dt_int))
+            except Exception as e:
+                print(path, dt_int, e)
+        bins = bin_snapshots(stamps, snapshots)
+        bins['listed'] = np.int64(len(days[day]))
+        written.append(write_day(out, bins))
+    return written
+
+
+def bins_state(bins_dir=BINS_DIR):
+    """(day files, their total size, latest mtime) of a bins directory: changes whenever build() writes a day."""
+    stats = [os.stat(p) for p in glob.glob(os.path.join(bins_dir, '*', '*.npz'))]
+    return len(stats), sum(st.st_size for st in stats), max((st.st_mtime_ns for st in stats), default=0)
+
+
+class PositionBins:
+    def __init__(self, bins_dir=BINS_DIR, grid=GRID):
+        self.bins_dir = bins_dir
+        self.grid = grid
+        self.days = sorted(os.path.basename(p)[:-4] for p in glob.glob(os.path.join(bins_dir, '*', '*.npz')))
+
+    def __len__(self):
+        return len(self.days)
+
+    def totals(self, start, end, hour=None):
+        """
+        (taxi totals per cell, snapshots) over the hours in [start, end],
+        only those at `hour` of the day if given.
+        """
+        lo = np.datetime64(pd.Timestamp(start).to_datetime64(), 'h').astype(np.int64)
+        hi = np.datetime64(pd.Timestamp(end).to_datetime64(), 'h').astype(np.int64)
+        first, last = pd.Timestamp(start).strftime('%Y%m%d'), pd.Timestamp(end).strftime('%Y%m%d')
+        n_cells = self.grid['nx'] * self.grid['ny']
+        totals = np.zeros(n_cells, dtype=np.float64)
+        n_snapshots = 0
+        for day in self.days[np.searchsorted(self.days, first):np.searchsorted(self.days, last, side='right')]:
+            b = read_day(day_path(self.bins_dir, day))
+            sel = (b['hours'] >= lo) & (b['hours'] <= hi)
+            if hour is not None:
+                sel &= b['hours'] % 24 == int(hour)
+            rows = np.repeat(sel, np.diff(b['offsets']))
+            totals += np.bincount(b['cells'][rows], weights=b['counts'][rows], minlength=n_cells)
+            n_snapshots += int(b['snapshots'][sel].sum())
+        return totals, n_snapshots
+
+    def density(self, start, end, hour=None):
+        """
+        Mean taxis per snapshot in every occupied cell over [start, end], as a
+        frame with columns lon, lat (cell centre) and weight.
+        """
+        totals, n_snapshots = self.totals(start, end, hour)
+        cells = np.flatnonzero(totals)
+        lon, lat = cell_centres(cells, self.grid)
+        return pd.DataFrame({'lon': lon, 'lat': lat, 'weight': totals[cells] / max(n_snapshots, 1)})
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Bin raw taxi positions into hourly grid densities")
+    parser.add_argument('--raw-dir', default='data')
+    parser.add_argument('--bins-dir', default=BINS_DIR)
+    parser.add_argument('--overwrite', action='store_true')
+    args = parser.parse_args()
+
+    for p in build(args.raw_dir, args.bins_dir, args.overwrite):
+        print(p)
@@ -0,0 +1,149 @@
+"""
+The dashboard's queries, independent of Streamlit.
+
+compare() is the baseline/analysis window comparison (filter_data), impact()
+the most/least impacted district ranking built from it (combined_data),
+series() a district's counts with their rolling average (taxigraph, optionally
+downsampled to a chart's pixel width) and
+timeseries() sum/mean/min/max per 5-minute to weekly step from the time
+pyramid. impact_matrix() is impact() for every hour of the day and a sweep of
+window lengths at once, as one long table. animation() is the animated bar
+chart's monthly frames, from a MonthlyRollup of the cube built on first use.
+streamlit.py and query_service.py both answer from a Queries object.
+"""
+import numpy as np
+import pandas as pd
+
+from downsample import downsample_frame
+
+MAX_WINDOW = 3650
+
+
+def impact_ranking(baseline_data, analysis_data):
+    """
+    combined_data of the dashboard: District, Pre-Covid, Post Covid and
+    Delta (absolute change), most impacted first.
+    """
+    combined_data = pd.merge(baseline_data, analysis_data, on=['region'], how='outer').rename(
+        columns={'region': 'District', 'taxi_count_x': 'Pre-Covid', 'taxi_count_y': 'Post Covid'})
+    combined_data["Delta"] = abs(combined_data["Post Covid"] - combined_data["Pre-Covid"])
+    return combined_data.sort_values(by=['Delta'], ascending=False)
+
+
+def impact_matrix(cube, baseline_date_start, analysis_date_start, time_periods, time_frequency, hours=range(24)):
+    """
+    impact() of every (hour, period) pair as one frame with columns hour,
+    period, District, Pre-Covid, Post Covid, Delta and rank (1 = most
+    impacted; districts without a Delta rank last), ordered by hour, period and
+    rank. All the window means come from one vectorized lookup into the cube's
+    running sums.
+    """
+    pairs = [(int(h), int(p)) for h in hours for p in time_periods]
+    if not pairs:
+        return pd.DataFrame(columns=['hour', 'period', 'District', 'Pre-Covid', 'Post Covid', 'Delta', 'rank'])
+    baseline, analysis = [], []
+    for h, p in pairs:
+        b, a = cube.windows(baseline_date_start, analysis_date_start, h, p, time_frequency)
+        baseline.append((*b, h))
+        analysis.append((*a, h))
+    pre = cube.window_means(baseline).T  # [pair, region]
+    post = cube.window_means(analysis).T
+    delta = np.abs(post - pre)
+
+    # rank by descending Delta, NaN last, ties in region order
+    order = np.argsort(np.where(np.isnan(delta), np.inf, -delta), axis=1, kind='stable')
+    rank = np.empty_like(order)
+    np.put_along_axis(rank, order, np.arange(1, delta.shape[1] + 1), axis=1)
+
+    # regions seen in neither window are left out, like the outer merge of impact_ranking
+    pair, region = np.nonzero(~(np.isnan(pre) & np.isnan(post)))
+    pairs = np.array(pairs, dtype=np.int64)
+    out = pd.DataFrame({
+        'hour': pairs[pair, 0], 'period': pairs[pair, 1], 'District': np.asarray(cube.regions)[region],
+        'Pre-Covid': pre[pair, region], 'Post Covid': post[pair, region], 'Delta': delta[pair, region],
+        'rank': rank[pair, region],
+    })
+    # ranks were counted over every region; renumber without the ones left out
+    out = out.sort_values(['hour', 'period', 'rank'], kind='stable', ignore_index=True)
+    out['rank'] = out.groupby(['hour', 'period']).cumcount() + 1
+    return out
+
+
+class Queries:
+    def __init__(self, cube, series_store, pyramid=None):
+        self.cube = cube
+        self.series_store = series_store
+        self.pyramid = pyramid
+        self._rollup = None
+
+    @classmethod
+    def from_shared(cls, version=None):
+        # the memory-mapped dataset of shared_dataset.py, for the current store by default
+        import shared_dataset
+        import taxi_store
+
+        shared = shared_dataset.attach(version or taxi_store.dataset_version())
+        return cls(shared.cube, shared.series_store, shared.pyramid)
+
+    def compare(self, baseline_date_start, analysis_date_start, hour_of_day, time_period, time_frequency):
+        """(baseline_data, analysis_data): per-district mean counts in each window."""
+        return self.cube.filter(baseline_date_start, analysis_date_start, hour_of_day, time_period, time_frequency)
+
+    def impact(self, baseline_date_start, analysis_date_start, hour_of_day, time_period, time_frequency):
+        return impact_ranking(*self.compare(baseline_date_start, analysis_date_start, hour_of_day, time_period,
+                                            time_frequency))
+
+    def series(self, region, hour, startdate, enddate, window=90, width=None):
+        """taxigraph rows with their rolling average, downsampled to about `width` points if given."""
+        if not 1 <= int(window) <= MAX_WINDOW:
+            raise ValueError(f"window must be between 1 and {MAX_WINDOW}")
+        data = self.series_store.rolling(region, int(hour), startdate, enddate, window=int(window))
+        if width is None:
+            return data
+        return downsample_frame(data, 'filename', ['taxi_count', 'rolling_average'], int(width))
+
+    def timeseries(self, region, start, end, step='h'):
+        """Stats per `step` of region (None for every region) in [start, end), see TimePyramid.query."""
+        if self.pyramid is None:
+            raise ValueError("no time pyramid loaded")
+        return self.pyramid.query(start, end, step, regions=None if region is None else [region])
+
+    def animation(self, hour, start, end):
+        """Monthly totals per district at `hour` in [start, end], see MonthlyRollup.frame."""
+        if self._rollup is None:
+            from monthly_rollup import MonthlyRollup
+
+            self._rollup = MonthlyRollup(self.cube)
+        return self._rollup.frame(int(hour), start, end)
+
+    def impact_matrix(self, baseline_date_start, analysis_date_start, time_periods, time_frequency,
+                      hours=range(24)):
+        return impact_matrix(self.cube, baseline_date_start, analysis_date_start, time_periods, time_frequency,
+                             hours)
+
+    @property
+    def regions(self):
+        return [str(r) for r in np.asarray(self.cube.regions)]
+
+
+if __name__ == "__main__":
+    import argparse
+    import datetime as dt
+
+    parser = argparse.ArgumentParser(description="Export the impact ranking of every hour and window length")
+    parser.add_argument('--baseline', required=True, type=dt.date.fromisoformat)
+    parser.add_argument('--analysis', required=True, type=dt.date.fromisoformat)
+    parser.add_argument('--periods', default='1,7,30', help="window lengths, e.g. 1,7,30 or 1-14")
+    parser.add_argument('--unit', default='Days', choices=['Hours', 'Days', 'Weeks'])
+    parser.add_argument('--out', default='impact_matrix.csv', help=".csv or .parquet")
+    args = parser.parse_args()
+
+    from query_service import parse_periods
+
+    matrix = Queries.from_shared().impact_matrix(args.baseline, args.analysis, parse_periods(args.periods),
+                                                 args.unit)
+    if args.out.endswith('.parquet'):
+        matrix.to_parquet(args.out, index=False)
+    else:
+        matrix.to_csv(args.out, index=False)
+    print(f"{args.out}: {len(matrix)} rows")
@@ -0,0 +1,437 @@
+"""
+Headless JSON API over the dashboard's queries (see queries.py).
+
+    GET  /compare?baseline=2019-01-07&analysis=2020-06-01&hour=20&period=10&unit=Days
+    GET  /impact?<same parameters>
+    GET  /impact_matrix?baseline=2019-01-07&analysis=2020-06-01&periods=1,7,30&unit=Days&hours=0-23
+    GET  /series?region=ANG MO KIO&hour=20&start=2019-01-07&end=2021-10-16T13:00:00&window=90&width=800
+    GET  /timeseries?region=ANG MO KIO&start=2020-03-30&end=2020-04-06&step=15min
+    GET  /animation?hour=20&start=2019-01-07&end=2021-10-16T13:00:00
+    POST /batch   {"queries": [{"query": "compare", "params": {...}}, ...]}
+    GET  /regions
+    GET  /health  (includes the dataset version)
+
+Frames come back column-oriented, {"columns": {name: [values]}}, with NaN
+as null and times as ISO strings; /compare returns {"baseline": frame,
+"analysis": frame}. Dates without a time keep their whole-day meaning, as in
+the app. Responses are cached by query and parameters in a ResultCache keyed
+on the dataset version, and a batch answers every query in one round trip,
+each from the same cache. The server is a ThreadingHTTPServer, one thread per
+connection, over the shared memory-mapped dataset, so several server
+processes on a host share one copy of the data. watch_version() re-checks
+the dataset version every RELOAD_INTERVAL seconds; when new data has landed
+it attaches that version's dataset and drops the cached responses.
+
+    python query_service.py --port 8501
+    CIM_QUERY_URL=http://localhost:8501 streamlit run streamlit.py
+
+QueryClient is the matching client; its methods return the same frames as
+the Queries methods.
+"""
+import datetime as dt
+import json
+import logging
+import math
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlencode, urlparse, parse_qs
+
+import numpy as np
+import pandas as pd
+import requests
+from requests.adapters import HTTPAdapter
+
+from result_cache import ResultCache
+
+logger = logging.getLogger("cities_in_motion.query_service")
+
+MAX_BATCH = 256
+MAX_PERIODS = 64
+MAX_WIDTH = 10000  # points of a downsampled series
+TIME_UNITS = ('Hours', 'Days', 'Weeks')
+RELOAD_INTERVAL = 60  # seconds between dataset version checks
+# what bad parameter values raise, in the parsers or in the query itself (e.g. an out-of-range period)
+BAD_PARAMS = (ValueError, OverflowError, TypeError)
+
+
+def parse_when(value):
+    # 'YYYY-MM-DD' stays a date (whole day), anything with a time becomes a datetime
+    value = str(value)
+    if len(value) == 10:
+        return dt.date.fromisoformat(value)
+    return dt.datetime.fromisoformat(value.replace(' ', 'T'))
+
+
+def parse_unit(value):
+    for unit in TIME_UNITS:
+        if unit.lower() == str(value).lower():
+            return unit
+    raise ValueError(f"unit must be one of {', '.join(TIME_UNITS)}")
+
+
+def parse_step(value):
+    value = str(value)
+    try:
+        pd.Timedelta(value if value[:1].isdigit() else '1' + value)
+    except ValueError:
+        raise ValueError(f"not a time step: {value}")
+    return value
+
+
+def parse_width(value):
+    width = int(value)
+    if not 3 <= width <= MAX_WIDTH:
+        raise ValueError(f"width must be between 3 and {MAX_WIDTH}")
+    return width
+
+
+def parse_hour(value):
+    hour = int(value)
+    if not 0 <= hour <= 23:
+        raise ValueError("hour must be between 0 and 23")
+    return hour
+
+
+def _int_list(value):
+    # '1,7,30' or '0-23' (or a mix) -> [int]
+    out = []
+    for part in str(value).split(','):
+        lo, sep, hi = part.strip().partition('-')
+        out += list(range(int(lo), int(hi) + 1)) if sep else [int(lo)]
+    return out
+
+
+def parse_periods(value):
+    periods = _int_list(value)
+    if not 1 <= len(periods) <= MAX_PERIODS or min(periods) < 1:
+        raise ValueError(f"periods must be 1 to {MAX_PERIODS} positive integers")
+    return periods
+
+
+def parse_hours(value):
+    return [parse_hour(h) for h in _int_list(value)]
+
+
+# query -> (Queries method, [(param, parser, default)]); default None means required, '' optional (None)
+WINDOW_PARAMS = [('baseline', parse_when, None), ('analysis', parse_when, None), ('hour', parse_hour, None),
+                 ('period', int, None), ('unit', parse_unit, 'Days')]
+QUERIES = {
+    'compare': ('compare', WINDOW_PARAMS),
+    'impact': ('impact', WINDOW_PARAMS),
+    'impact_matrix': ('impact_matrix', [('baseline', parse_when, None), ('analysis', parse_when, None),
+                                        ('periods', parse_periods, None), ('unit', parse_unit, 'Days'),
+                                        ('hours', parse_hours, list(range(24)))]),
+    'series': ('series', [('region', str, None), ('hour', parse_hour, None), ('start', parse_when, None),
+                          ('end', parse_when, None), ('window', int, 90), ('width', parse_width, '')]),
+    'timeseries': ('timeseries', [('region', str, ''), ('start', parse_when, None), ('end', parse_when, None),
+                                  ('step', parse_step, 'h')]),
+    'animation': ('animation', [('hour', parse_hour, None), ('start', parse_when, None), ('end', parse_when, None)]),
+}
+
+
+def parse_params(query, params):
+    """Positional arguments of the Queries method for `query`, from string-ish params."""
+    if query not in QUERIES:
+        raise KeyError(query)
+    _, spec = QUERIES[query]
+    args = []
+    for name, parse, default in spec:
+        if name in params and params[name] not in (None, ''):
+            try:
+                args.append(parse(params[name]))
+            except BAD_PARAMS as e:
+                raise ValueError(f"{name}: {e}")
+        elif default == '':
+            args.append(None)  # optional, no value
+        elif default is not None:
+            args.append(default)
+        else:
+            raise ValueError(f"missing parameter {name}")
+    return args
+
+
+def _json_value(v):
+    if isinstance(v, float) and math.isnan(v):
+        return None
+    return v
+
+
+def frame_to_json(df):
+    columns = {}
+    for name in df.columns:
+        col = df[name]
+        if pd.api.types.is_datetime64_any_dtype(col.dtype):
+            values = np.datetime_as_string(col.values.astype('datetime64[s]')).tolist()
+        else:
+            values = [_json_value(v) for v in col.astype(object).tolist()]
+        columns[str(name)] = values
+    return {'columns': columns}
+
+
+def frame_from_json(obj, times=()):
+    df = pd.DataFrame(obj['columns'])
+    for name in times:
+        if name in df:
+            df[name] = pd.to_datetime(df[name])
+    return df
+
+
+def encode_result(query, result):
+    if query == 'compare':
+        baseline_data, analysis_data = result
+        return {'baseline': frame_to_json(baseline_data), 'analysis': frame_to_json(analysis_data)}
+    return frame_to_json(result)
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    # set on the server instance: queries, cache, version
+    protocol_version = 'HTTP/1.1'  # keep-alive, so clients reuse connections
+    disable_nagle_algorithm = True  # headers and body go out as separate writes
+
+    def _send(self, status, body):
+        body = body if isinstance(body, bytes) else json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def answer(self, query, params):
+        """JSON bytes of one query, from the response cache when possible."""
+        args = parse_params(query, params)
+        cache = self.server.cache
+        key = cache.key(query, args)
+        hit, body = cache.get(key)
+        if not hit:
+            method = getattr(self.server.queries, QUERIES[query][0])
+            body = json.dumps(encode_result(query, method(*args))).encode()
+            cache.put(key, body)
+        return body
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = url.path.strip('/')
+        if query == 'health':
+            self._send(200, {'status': 'ok', 'version': self.server.version, 'cache': self.server.cache.stats()})
+            return
+        if query == 'regions':
+            self._send(200, {'regions': self.server.queries.regions})
+            return
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+        try:
+            self._send(200, self.answer(query, params))
+        except KeyError:
+            self._send(404, {'error': f"unknown query {query!r}"})
+        except BAD_PARAMS as e:
+            self._send(400, {'error': str(e)})
+        except Exception as e:
+            self._send(500, {'error': f"{type(e).__name__}: {e}"})
+
+    def do_POST(self):
+        if urlparse(self.path).path.strip('/') != 'batch':
+            self._send(404, {'error': "POST is only supported on /batch"})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            body = json.loads(self.rfile.read(length) or b'{}')
+            queries = body.get('queries', []) if isinstance(body, dict) else None
+            if not isinstance(queries, list) or not all(isinstance(q, dict) for q in queries):
+                raise ValueError('expected {"queries": [{"query": ..., "params": {...}}, ...]}')
+            if len(queries) > MAX_BATCH:
+                raise ValueError(f"at most {MAX_BATCH} queries per batch")
+        except ValueError as e:
+            self._send(400, {'error': str(e)})
+            return
+        parts = []
+        for q in queries:
+            # one failing query does not fail the batch
+            try:
+                params = q.get('params') or {}
+                if not isinstance(params, dict):
+                    raise ValueError("params must be an object")
+                parts.append(self.answer(q.get('query'), params))
+            except KeyError:
+                parts.append(json.dumps({'error': f"unknown query {q.get('query')!r}"}).encode())
+            except BAD_PARAMS as e:
+                parts.append(json.dumps({'error': str(e)}).encode())
+            except Exception as e:
+                parts.append(json.dumps({'error': f"{type(e).__name__}: {e}"}).encode())
+        self._send(200, b'{"results":[' + b','.join(parts) + b']}')
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(queries, port=0, host='127.0.0.1', version=None, cache_bytes=128 * 2 ** 20):
+    """
+    Start the service on a background thread. Returns the server; its base
+    URL is `endpoint(server)`, stop it with server.shutdown().
+    """
+    server = ThreadingHTTPServer((host, port), QueryHandler)
+    server.daemon_threads = True
+    server.queries, server.version = queries, version
+    server.cache = ResultCache(max_bytes=cache_bytes, spill_dir=None, version=version)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def reload_if_changed(server, current_version, load):
+    """
+    Swap in load(version) (a Queries) when current_version() differs from the
+    server's, dropping the cached responses. Returns whether it did.
+    """
+    version = current_version()
+    if version == server.version:
+        return False
+    # build before swapping: requests keep being answered from the old data meanwhile
+    queries = load(version)
+    server.queries, server.version = queries, version
+    server.cache.set_version(version)
+    return True
+
+
+def watch_version(server, current_version, load, interval=RELOAD_INTERVAL):
+    """
+    Call reload_if_changed() every `interval` seconds on a background thread,
+    for as long as the process runs. Returns the thread.
+    """
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                if reload_if_changed(server, current_version, load):
+                    logger.info("serving dataset version %s", server.version)
+            except Exception:
+                logger.exception("dataset reload failed; still serving version %s", server.version)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
+
+
+def endpoint(server):
+    host, port = server.server_address[:2]
+    return f"http://{host}:{port}"
+
+
+class QueryClient:
+    """Client of the query service, returning the same frames as Queries."""
+
+    def __init__(self, base_url, pool_size=4, timeout=30):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    @staticmethod
+    def window_params(baseline_date_start, analysis_date_start, hour_of_day, time_period, time_frequency):
+        return {'baseline': baseline_date_start.isoformat(), 'analysis': analysis_date_start.isoformat(),
+                'hour': int(hour_of_day), 'period': int(time_period), 'unit': time_frequency}
+
+    @staticmethod
+    def impact_matrix_params(baseline_date_start, analysis_date_start, time_periods, time_frequency,
+                             hours=range(24)):
+        return {'baseline': baseline_date_start.isoformat(), 'analysis': analysis_date_start.isoformat(),
+                'periods': ','.join(str(int(p)) for p in time_periods), 'unit': time_frequency,
+                'hours': ','.join(str(int(h)) for h in hours)}
+
+    @staticmethod
+    def series_params(region, hour, startdate, enddate, window=90, width=None):
+        params = {'region': region, 'hour': int(hour), 'start': startdate.isoformat(), 'end': enddate.isoformat(),
+                  'window': int(window)}
+        if width is not None:
+            params['width'] = int(width)
+        return params
+
+    @staticmethod
+    def timeseries_params(region, start, end, step='h'):
+        return {'region': region or '', 'start': start.isoformat(), 'end': end.isoformat(), 'step': step}
+
+    @staticmethod
+    def animation_params(hour, start, end):
+        return {'hour': int(hour), 'start': start.isoformat(), 'end': end.isoformat()}
+
+    @staticmethod
+    def decode(query, obj):
+        if 'error' in obj:
+            raise ValueError(obj['error'])
+        if query == 'compare':
+            return frame_from_json(obj['baseline']), frame_from_json(obj['analysis'])
+        return frame_from_json(obj, times=('filename', 'time'))
+
+    def _get(self, query, params):
+        resp = self.session.get(f"{self.base_url}/{query}?{urlencode(params)}", timeout=self.timeout)
+        if resp.status_code == 400:
+            raise ValueError(resp.json()['error'])
+        resp.raise_for_status()
+        return self.decode(query, resp.json())
+
+    def compare(self, *args):
+        return self._get('compare', self.window_params(*args))
+
+    def impact(self, *args):
+        return self._get('impact', self.window_params(*args))
+
+    def impact_matrix(self, *args, **kwargs):
+        return self._get('impact_matrix', self.impact_matrix_params(*args, **kwargs))
+
+    def series(self, *args, **kwargs):
+        return self._get('series', self.series_params(*args, **kwargs))
+
+    def timeseries(self, *args, **kwargs):
+        return self._get('timeseries', self.timeseries_params(*args, **kwargs))
+
+    def animation(self, *args):
+        return self._get('animation', self.animation_params(*args))
+
+    def regions(self):
+        resp = self.session.get(f"{self.base_url}/regions", timeout=self.timeout)
+        resp.raise_for_status()
+        return resp.json()['regions']
+
+    def version(self):
+        """The dataset version the service is answering from."""
+        resp = self.session.get(f"{self.base_url}/health", timeout=self.timeout)
+        resp.raise_for_status()
+        return resp.json()['version']
+
+    def batch(self, queries):
+        """
+        Run [(query, params)] in one request, params as from window_params()
+        or series_params(). Returns the decoded results in order; a failed
+        query comes back as its ValueError rather than raising.
+        """
+        body = {'queries': [{'query': q, 'params': p} for q, p in queries]}
+        resp = self.session.post(f"{self.base_url}/batch", json=body, timeout=self.timeout)
+        resp.raise_for_status()
+        out = []
+        for (q, _), obj in zip(queries, resp.json()['results']):
+            try:
+                out.append(self.decode(q, obj))
+            except ValueError as e:
+                out.append(e)
+        return out
+
+
+if __name__ == "__main__":
+    import argparse
+
+    import taxi_store
+    from queries import Queries
+
+    parser = argparse.ArgumentParser(description="JSON API over the dashboard queries")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8501)
+    parser.add_argument('--cache-mb', type=float, default=128)
+    parser.add_argument('--reload-interval', type=float, default=RELOAD_INTERVAL,
+                        help="seconds between checks for a new dataset version")
+    args = parser.parse_args()
+
+    version = taxi_store.dataset_version()
+    srv = serve(Queries.from_shared(version), args.port, args.host, version, int(args.cache_mb * 2 ** 20))
+    watch_version(srv, taxi_store.dataset_version, Queries.from_shared, args.reload_interval)
+    print(f"serving on {endpoint(srv)}")
+    threading.Event().wait()
@@ -0,0 +1,281 @@
+"""
+Parameter-keyed result cache for the dashboard queries.
+
+st.cache keys a call on a hash of all of its arguments, so passing full_data
+to filter_data or taxigraph hashes millions of rows on every rerun, and
+persist=True keeps every result on disk for good. ResultCache keys a call on
+the function name, the query parameters (arguments listed in `ignore`, such as
+full_data, are left out) and a dataset version instead:
+
+    results = ResultCache(max_bytes=256 * 2 ** 20, spill_dir='data/cache')
+    results.set_version(taxi_store.dataset_version())
+
+    @results.memoize(ignore=('full_data',))
+    def filter_data(full_data, baseline_date_start, ...):
+        ...
+
+Entries are evicted least recently used first once their estimated size goes
+over max_bytes. With a spill_dir, evicted entries are written there as
+zlib-compressed pickles (bounded by max_spill_bytes) and promoted back to
+memory on their next hit. The spill directory records the version its
+files were computed for, so a restarted process setting the same version
+picks them up again. set_version() with a new version drops everything, in
+memory and, unless the spill directory is already at that version, on
+disk; invalidate() always does. Hits and misses are counted on the
+instrumentation of the current rerun.
+
+When callers sharing one cache see different versions at the same time (the
+dashboard's sessions, one drawing from a partial dataset while another has
+the full one), each call passes its own: memoize(version=...) takes a
+function returning the version of the current call, which is put in the key
+instead of the cache's. set_version() then only needs the version all of
+them share, e.g. the dataset's.
+"""
+import functools
+import glob
+import hashlib
+import inspect
+import json
+import os
+import pickle
+import threading
+import zlib
+from collections import OrderedDict
+from datetime import date, datetime, time, timedelta
+
+import numpy as np
+import pandas as pd
+
+from instrumentation import record_cache, stage
+
+MAX_BYTES = int(float(os.environ.get('CIM_RESULT_CACHE_MB', 256)) * 2 ** 20)
+SPILL_DIR = os.environ.get('CIM_RESULT_CACHE_DIR')  # no spill unless set
+MAX_SPILL_BYTES = int(float(os.environ.get('CIM_RESULT_CACHE_SPILL_MB', 1024)) * 2 ** 20)
+SUFFIX = '.pkl.z'
+VERSION_FILE = 'VERSION'  # in the spill directory: the cache version its files belong to
+
+
+def key_part(value):
+    # JSON-able, stable form of a query parameter
+    if isinstance(value, (datetime, date, time, pd.Timestamp)):
+        return value.isoformat()
+    if isinstance(value, timedelta):
+        return value.total_seconds()
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (list, tuple)):
+        return [key_part(v) for v in value]
+    if isinstance(value, dict):
+        return {str(k): key_part(v) for k, v in sorted(value.items())}
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    raise TypeError(f"cannot use {type(value).__name__} as a result cache key; pass it in `ignore`")
+
+
+def sizeof(value):
+    """Rough in-memory size of a cached result in bytes."""
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        usage = value.memory_usage(index=True, deep=True)
+        return int(usage.sum()) if isinstance(value, pd.DataFrame) else int(usage)
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (list, tuple)):
+        return sum(sizeof(v) for v in value) + 8 * len(value)
+    if isinstance(value, (str, bytes)):
+        return len(value)
+    try:
+        return len(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+    except Exception:
+        return 0
+
+
+def rows(value):
+    # result rows for the instrumentation stage, None for non-tabular results
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return len(value)
+    if isinstance(value, (list, tuple)) and value and all(isinstance(v, (pd.DataFrame, pd.Series)) for v in value):
+        return sum(len(v) for v in value)
+    return None
+
+
+class ResultCache:
+    def __init__(self, max_bytes=MAX_BYTES, spill_dir=SPILL_DIR, max_spill_bytes=MAX_SPILL_BYTES, version=None):
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.max_spill_bytes = max_spill_bytes
+        self.version = version
+        self.lock = threading.RLock()
+        self._entries = OrderedDict()  # key -> (value, nbytes), least recently used first
+        self._spilled = OrderedDict()  # key digest -> (path, file size), oldest first
+        self.nbytes = 0
+        self.spill_bytes = 0
+        self.hits = self.misses = self.spill_hits = self.evictions = 0
+        self.spill_version = None
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+            # files left by an earlier process, kept while the version stays the one they were computed for
+            for path in sorted(glob.glob(os.path.join(spill_dir, '*' + SUFFIX)), key=os.path.getmtime):
+                self._spilled[os.path.basename(path)[:-len(SUFFIX)]] = (path, os.path.getsize(path))
+                self.spill_bytes += os.path.getsize(path)
+            version_path = os.path.join(spill_dir, VERSION_FILE)
+            if os.path.exists(version_path):
+                with open(version_path) as f:
+                    self.spill_version = json.load(f)
+            if version is not None:
+                self._set_spill_version(version)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def key(self, name, args, version=None):
+        # version: the call's own, instead of the cache's
+        version = self.version if version is None else version
+        return json.dumps([name, key_part(version), key_part(args)], separators=(',', ':'))
+
+    def set_version(self, version):
+        """
+        Use `version` for new keys, dropping all entries when it changed; spilled
+        ones survive when they were written for `version` (by an earlier process).
+        """
+        with self.lock:
+            if version != self.version:
+                self._entries.clear()
+                self.nbytes = 0
+                self.version = version
+                self._set_spill_version(version)
+
+    def _set_spill_version(self, version):
+        if not self.spill_dir or key_part(version) == self.spill_version:
+            return
+        self._drop_spilled()
+        tmp_path = os.path.join(self.spill_dir, VERSION_FILE + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(key_part(version), f)
+        os.replace(tmp_path, os.path.join(self.spill_dir, VERSION_FILE))
+        self.spill_version = key_part(version)
+
+    def invalidate(self):
+        with self.lock:
+            self._entries.clear()
+            self.nbytes = 0
+            self._drop_spilled()
+
+    def _drop_spilled(self):
+        with self.lock:
+            for path, _ in self._spilled.values():
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            self._spilled.clear()
+            self.spill_bytes = 0
+
+    def get(self, key):
+        """(True, value) on a hit, from memory or the spill directory, else (False, None)."""
+        with self.lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return True, self._entries[key][0]
+            value = self._unspill(key)
+            if value is not None:
+                self.hits += 1
+                self.spill_hits += 1
+                self.put(key, value[0])
+                return True, value[0]
+            self.misses += 1
+            return False, None
+
+    def put(self, key, value):
+        nbytes = sizeof(value)
+        with self.lock:
+            if key in self._entries:
+                self.nbytes -= self._entries.pop(key)[1]
+            self._entries[key] = (value, nbytes)
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes and len(self._entries) > 1:
+                old_key, (old_value, old_nbytes) = self._entries.popitem(last=False)
+                self.nbytes -= old_nbytes
+                self.evictions += 1
+                self._spill(old_key, old_value)
+
+    def _digest(self, key):
+        return hashlib.sha1(key.encode()).hexdigest()
+
+    def _spill(self, key, value):
+        if not self.spill_dir:
+            return
+        try:
+            blob = zlib.compress(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL), 1)
+        except Exception:
+            return  # not picklable, just drop it
+        if len(blob) > self.max_spill_bytes:
+            return
+        digest = self._digest(key)
+        path = os.path.join(self.spill_dir, digest + SUFFIX)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(blob)
+        os.replace(tmp_path, path)
+        if digest in self._spilled:
+            self.spill_bytes -= self._spilled.pop(digest)[1]
+        self._spilled[digest] = (path, len(blob))
+        self.spill_bytes += len(blob)
+        while self.spill_bytes > self.max_spill_bytes:
+            _, (old_path, size) = self._spilled.popitem(last=False)
+            self.spill_bytes -= size
+            try:
+                os.remove(old_path)
+            except OSError:
+                pass
+
+    def _unspill(self, key):
+        # (value,) for a spilled key, removing its file, else None
+        digest = self._digest(key)
+        if digest not in self._spilled:
+            return None
+        path, size = self._spilled.pop(digest)
+        self.spill_bytes -= size
+        try:
+            with open(path, 'rb') as f:
+                value = pickle.loads(zlib.decompress(f.read()))
+            os.remove(path)
+        except (OSError, zlib.error, pickle.UnpicklingError, EOFError):
+            return None
+        return (value,)
+
+    def memoize(self, name=None, ignore=(), version=None):
+        """
+        Cache a function's results by its call parameters, minus those named in
+        `ignore`, and the current version: version() at call time if given,
+        else the cache's. Each call is timed as an instrumentation stage and
+        counted as a hit or a miss.
+        """
+        def deco(fn):
+            cache_name = name or fn.__name__
+            signature = inspect.signature(fn)
+
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                bound = signature.bind(*args, **kwargs)
+                bound.apply_defaults()
+                params = {k: v for k, v in bound.arguments.items() if k not in ignore}
+                key = self.key(cache_name, params, None if version is None else version())
+                with stage(cache_name) as info:
+                    hit, value = self.get(key)
+                    if not hit:
+                        value = fn(*args, **kwargs)
+                        self.put(key, value)
+                    info['rows'] = rows(value)
+                record_cache(cache_name, hit)
+                return value
+            wrapper.cache = self
+            return wrapper
+        return deco
+
+    def stats(self):
+        with self.lock:
+            return {'version': self.version, 'entries': len(self._entries), 'mb': round(self.nbytes / 2 ** 20, 3),
+                    'max_mb': round(self.max_bytes / 2 ** 20, 3), 'spilled': len(self._spilled),
+                    'spill_mb': round(self.spill_bytes / 2 ** 20, 3), 'hits': self.hits, 'misses': self.misses,
+                    'spill_hits': self.spill_hits, 'evictions': self.evictions}
@@ -0,0 +1,232 @@
+"""
+Per-(region, hour) taxi count series with rolling statistics.
+
+Every series keeps its timestamps, counts and running sums of counts and
+squared counts. A query finds its date range with a binary search and derives
+rolling means/stds for any window from differences of the running sums, so it
+never copies the dataset. New rows are appended to a private tail of the
+affected series only; a store over a memory-mapped shared dataset keeps its
+mapped arrays as the series' heads and never copies or writes them.
+"""
+import datetime as dt
+
+import numpy as np
+import pandas as pd
+
+from taxi_store import region_codes, region_names
+
+ALL = "All"
+
+
+class _Series:
+    """
+    One series as a read-only head, e.g. memory-mapped by shared_dataset.py,
+    and a private tail that appends go to. The tail's running sums continue
+    from the head's last ones, so the head is never copied or written.
+    """
+    COLUMNS = ('times', 'codes', 'counts')
+    DTYPES = {'times': 'datetime64[ns]', 'codes': np.int16, 'counts': np.int64}
+    MIN_TAIL = 64  # rows a tail starts with
+
+    def __init__(self, capacity=1024):
+        self.head = {name: np.empty(0, dtype=dtype) for name, dtype in self.DTYPES.items()}
+        # running sums with a leading zero: cs[i] = counts[:i].sum(), offset by cs[0] over a packed store
+        self.head['cs'] = np.zeros(1, dtype=np.int64)
+        self.head['cs2'] = np.zeros(1, dtype=np.int64)
+        self.n_head = 0
+        self.n = 0
+        self._new_tail(capacity, 0, 0)
+
+    def _new_tail(self, capacity, cs0, cs20):
+        # tail['cs'][j] is cs[n_head + j]
+        self.tail = {name: np.empty(capacity, dtype=dtype) for name, dtype in self.DTYPES.items()}
+        self.tail['cs'] = np.zeros(capacity + 1, dtype=np.int64)
+        self.tail['cs2'] = np.zeros(capacity + 1, dtype=np.int64)
+        self.tail['cs'][0], self.tail['cs2'][0] = cs0, cs20
+
+    @classmethod
+    def wrap(cls, times, codes, counts, cs, cs2):
+        # series over existing (e.g. memory-mapped) arrays, kept as its head; cs/cs2 have one more element than times
+        s = cls(0)
+        s.head = {'times': times, 'codes': codes, 'counts': counts, 'cs': cs, 'cs2': cs2}
+        s.n_head = s.n = len(times)
+        s._new_tail(0, cs[s.n], cs2[s.n])
+        return s
+
+    def column(self, name, lo, hi):
+        """Rows lo:hi of 'times', 'codes' or 'counts': a view unless the range spans head and tail."""
+        nh = self.n_head
+        if hi <= nh:
+            return self.head[name][lo:hi]
+        if lo >= nh:
+            return self.tail[name][lo - nh:hi - nh]
+        return np.concatenate([self.head[name][lo:], self.tail[name][:hi - nh]])
+
+    def running(self, name, idx):
+        """Running sums 'cs' or 'cs2' at positions idx (0 to n)."""
+        idx = np.asarray(idx, dtype=np.int64)
+        in_head = idx <= self.n_head
+        out = np.empty(idx.shape, dtype=np.int64)
+        out[in_head] = self.head[name][idx[in_head]]
+        out[~in_head] = self.tail[name][idx[~in_head] - self.n_head]
+        return out
+
+    def totals(self):
+        # (sum of counts, sum of squared counts) over the whole series
+        return tuple(int(self.running(name, self.n) - self.running(name, 0)) for name in ('cs', 'cs2'))
+
+    def searchsorted(self, value, side='left'):
+        # head times all precede the tail's
+        i = int(np.searchsorted(self.head['times'], value, side=side))
+        if i == self.n_head:
+            i += int(np.searchsorted(self.tail['times'][:self.n - self.n_head], value, side=side))
+        return i
+
+    def _reserve(self, n):
+        used = self.n - self.n_head
+        if n - self.n_head <= len(self.tail['times']):
+            return
+        cap = max(n - self.n_head, 2 * len(self.tail['times']), self.MIN_TAIL)
+        old = self.tail
+        self._new_tail(cap, 0, 0)
+        for name in self.COLUMNS:
+            self.tail[name][:used] = old[name][:used]
+        for name in ('cs', 'cs2'):
+            self.tail[name][:used + 1] = old[name][:used + 1]
+
+    def append(self, times, codes, counts):
+        if not len(times):
+            return
+        if self.n and times[0] < self.column('times', self.n - 1, self.n)[0]:
+            # out-of-order data: merge and rebuild this series, all of it in the tail
+            times = np.concatenate([self.column('times', 0, self.n), times])
+            codes = np.concatenate([self.column('codes', 0, self.n), codes])
+            counts = np.concatenate([self.column('counts', 0, self.n), counts])
+            order = np.argsort(times, kind='stable')
+            times, codes, counts = times[order], codes[order], counts[order]
+            self.__init__(len(times))
+        lo, hi = self.n - self.n_head, self.n - self.n_head + len(times)
+        self._reserve(self.n + len(times))
+        tail = self.tail
+        tail['times'][lo:hi] = times
+        tail['codes'][lo:hi] = codes
+        tail['counts'][lo:hi] = counts
+        tail['cs'][lo + 1:hi + 1] = tail['cs'][lo] + np.cumsum(counts)
+        tail['cs2'][lo + 1:hi + 1] = tail['cs2'][lo] + np.cumsum(np.asarray(counts, dtype=np.int64) ** 2)
+        self.n += len(times)
+
+
+def _view(a):
+    # read-only view so callers cannot write through to the store
+    v = a.view()
+    v.flags.writeable = False
+    return v
+
+
+def _bounds(startdate, enddate):
+    # same range as full_data.loc[str(startdate):str(enddate)]: dates cover the whole day
+    start = pd.Timestamp(str(startdate))
+    end = pd.Timestamp(str(enddate))
+    if not isinstance(enddate, dt.datetime) and isinstance(enddate, dt.date):
+        end = end + pd.Timedelta(days=1) - pd.Timedelta(1, 'ns')
+    return np.datetime64(start.to_datetime64(), 'ns'), np.datetime64(end.to_datetime64(), 'ns')
+
+
+class SeriesStore:
+    def __init__(self, regions=()):
+        self.regions = list(regions)
+        self.region_index = {r: i for i, r in enumerate(self.regions)}
+        self.series = {}  # (region or ALL, hour) -> _Series
+
+    @classmethod
+    def from_frame(cls, full_data):
+        store = cls(region_names(full_data.region))
+        store.append(full_data)
+        return store
+
+    def append(self, frame):
+        """Add rows (index: snapshot time, columns region, taxi_count) to the tail of each series."""
+        if not len(frame):
+            return
+        for r in sorted(set(region_names(frame.region)) - set(self.region_index)):
+            self.region_index[r] = len(self.regions)
+            self.regions.append(r)
+        codes = region_codes(frame.region, self.regions).astype(np.int16)
+        times = frame.index.values.astype('datetime64[ns]')
+        counts = frame.taxi_count.values.astype(np.int64)
+        order = np.argsort(times, kind='stable')
+        times, codes, counts = times[order], codes[order], counts[order]
+        hours = ((times - times.astype('datetime64[D]')) // np.timedelta64(1, 'h')).astype(np.int64)
+
+        for h in np.unique(hours):
+            in_hour = hours == h
+            t, c, n = times[in_hour], codes[in_hour], counts[in_hour]
+            self.series.setdefault((ALL, int(h)), _Series()).append(t, c, n)
+            for code in np.unique(c):
+                sel = c == code
+                key = (self.regions[code], int(h))
+                self.series.setdefault(key, _Series()).append(t[sel], c[sel], n[sel])
+
+    def packed(self):
+        """
+        Every series back to back, in key order: (keys, offsets, arrays) where
+        series keys[i] is rows offsets[i]:offsets[i + 1] of arrays['times'],
+        ['codes'] and ['counts'], and arrays['cs'] / ['cs2'] are running sums
+        over all rows with a leading zero.
+        """
+        keys = sorted(self.series, key=lambda k: (k[0] != ALL, str(k[0]), k[1]))
+        parts = [self.series[k] for k in keys]
+        offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([s.n for s in parts])
+        arrays = {name: np.concatenate([s.column(name, 0, s.n) for s in parts]) if parts
+                  else np.empty(0, dtype=dtype)
+                  for name, dtype in _Series.DTYPES.items()}
+        for name, values in (('cs', arrays['counts']), ('cs2', arrays['counts'] ** 2)):
+            arrays[name] = np.zeros(len(values) + 1, dtype=np.int64)
+            np.cumsum(values, out=arrays[name][1:])
+        return keys, offsets, arrays
+
+    @classmethod
+    def from_packed(cls, regions, keys, offsets, arrays):
+        """Store over the arrays of packed(), without copying them."""
+        store = cls(regions)
+        for i, key in enumerate(keys):
+            lo, hi = int(offsets[i]), int(offsets[i + 1])
+            store.series[key] = _Series.wrap(arrays['times'][lo:hi], arrays['codes'][lo:hi],
+                                             arrays['counts'][lo:hi], arrays['cs'][lo:hi + 1],
+                                             arrays['cs2'][lo:hi + 1])
+        return store
+
+    def rolling(self, region, hour, startdate, enddate, window=90, std=False):
+        """
+        Rows of `region` ("All" for every region) at `hour` between startdate
+        and enddate, with the rolling mean (and std) of taxi_count over the
+        last `window` rows of that range, as taxigraph() returns them.
+        """
+        s = self.series.get((region, int(hour)))
+        if s is None:
+            s = _Series(0)
+        start, end = _bounds(startdate, enddate)
+        lo = s.searchsorted(start, side='left')
+        hi = max(lo, s.searchsorted(end, side='right'))
+
+        n = hi - lo
+        mean = np.full(n, np.nan)
+        if n >= window:
+            idx = np.arange(lo + window, hi + 1)
+            sums = s.running('cs', idx) - s.running('cs', idx - window)
+            mean[window - 1:] = sums / window
+        data = {
+            'filename': _view(s.column('times', lo, hi)),
+            'region': pd.Categorical.from_codes(s.column('codes', lo, hi), categories=self.regions),
+            'taxi_count': _view(s.column('counts', lo, hi)),
+            'rolling_average': mean,
+        }
+        if std:
+            sd = np.full(n, np.nan)
+            if n >= window and window > 1:
+                sq = s.running('cs2', idx) - s.running('cs2', idx - window)
+                var = (sq - sums.astype(np.float64) ** 2 / window) / (window - 1)
+                sd[window - 1:] = np.sqrt(np.maximum(var, 0))
+            data['rolling_std'] = sd
+        return pd.DataFrame(data, copy=False)
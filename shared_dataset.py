@@ -0,0 +1,194 @@
+"""
+Read-only, memory-mapped copy of the processed counts and their aggregates,
+shared by every session and server process on a host.
+
+One directory per dataset version (taxi_store.dataset_version()):
+
+    data/analysis/shared/{version}/
+        meta.json                       regions, day0, series keys, row count
+        rows.filename.npy               datetime64[ns]  full_data index
+        rows.region.npy                 int16           codes into regions
+        rows.taxi_count.npy             int16
+        cube.sums.npy / cube.counts.npy                 CountCube arrays
+        series.{times,codes,counts,cs,cs2,offsets}.npy  SeriesStore.packed()
+        pyramid.{level}.{sum,count,min,max}.npy         TimePyramid levels
+
+The first process to need a version builds it (under a lock file per version,
+written to a temporary directory and renamed into place); every other process
+attaches with np.load(mmap_mode='r'), which takes milliseconds and shares the
+pages through the OS page cache instead of holding a private copy. The arrays
+are read-only: CountCube and SeriesStore copy what they touch before appending.
+
+For a quick first start, attach_years() builds a small dataset of only the
+years a query needs ({version}-{years}), while attach_in_background() builds
+the full one on a thread.
+
+    python shared_dataset.py            # build the current version ahead of time
+"""
+import fcntl
+import json
+import os
+import shutil
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import taxi_store
+from count_cube import CountCube
+from series_store import SeriesStore
+from time_pyramid import TimePyramid
+
+SHARED_DIR = './data/analysis/shared'
+FORMAT = 2
+
+
+def version_dir(version, shared_dir=SHARED_DIR):
+    # the format is part of the name, so a layout change builds a fresh directory
+    return os.path.join(shared_dir, f'{version}.f{FORMAT}')
+
+
+def _save(out_dir, name, array):
+    np.save(os.path.join(out_dir, name + '.npy'), np.ascontiguousarray(array))
+
+
+def _load(in_dir, name):
+    # plain read-only ndarray view of the mapping, so results don't carry the memmap subclass around
+    return np.load(os.path.join(in_dir, name + '.npy'), mmap_mode='r').view(np.ndarray)
+
+
+def write(out_dir, full_data, cube=None, series_store=None, pyramid=None):
+    """Write full_data and its cube, series store and time pyramid as a shared dataset directory."""
+    cube = cube if cube is not None else CountCube.from_frame(full_data)
+    series_store = series_store if series_store is not None else SeriesStore.from_frame(full_data)
+    pyramid = pyramid if pyramid is not None else TimePyramid.from_frame(full_data)
+    os.makedirs(out_dir, exist_ok=True)
+
+    regions = [str(r) for r in cube.regions]
+    _save(out_dir, 'rows.filename', full_data.index.values.astype('datetime64[ns]'))
+    _save(out_dir, 'rows.region', taxi_store.region_codes(full_data.region, regions).astype(np.int16))
+    _save(out_dir, 'rows.taxi_count', full_data.taxi_count.values.astype(np.int16))
+    _save(out_dir, 'cube.sums', cube.sums)
+    _save(out_dir, 'cube.counts', cube.counts)
+    keys, offsets, arrays = series_store.packed()
+    _save(out_dir, 'series.offsets', offsets)
+    for name, array in arrays.items():
+        _save(out_dir, 'series.' + name, array)
+    pyramid_meta, arrays = pyramid.arrays()
+    for name, array in arrays.items():
+        _save(out_dir, 'pyramid.' + name, array)
+
+    meta = {
+        'format': FORMAT, 'rows': len(full_data), 'regions': regions, 'day0': str(cube.day0),
+        'series_regions': list(series_store.regions), 'series_keys': [[k[0], k[1]] for k in keys],
+        'pyramid': pyramid_meta,
+    }
+    with open(os.path.join(out_dir, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+
+class SharedDataset:
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        if self.meta.get('format') != FORMAT:
+            raise ValueError(f"{path}: unsupported shared dataset format {self.meta.get('format')}")
+        self.regions = self.meta['regions']
+        self._full_data = self._cube = self._series_store = self._pyramid = None
+
+    @property
+    def full_data(self):
+        # same layout as taxi_store.load_taxi_count(); pandas copies the int16 region codes
+        if self._full_data is None:
+            index = pd.DatetimeIndex(_load(self.path, 'rows.filename'), name='filename', copy=False)
+            region = pd.Categorical.from_codes(_load(self.path, 'rows.region'), categories=self.regions)
+            self._full_data = pd.DataFrame({'region': region, 'taxi_count': _load(self.path, 'rows.taxi_count')},
+                                           index=index, copy=False)
+        return self._full_data
+
+    @property
+    def cube(self):
+        if self._cube is None:
+            self._cube = CountCube(self.regions, np.datetime64(self.meta['day0'], 'D'),
+                                   _load(self.path, 'cube.sums'), _load(self.path, 'cube.counts'))
+        return self._cube
+
+    @property
+    def series_store(self):
+        if self._series_store is None:
+            arrays = {name: _load(self.path, 'series.' + name) for name in ('times', 'codes', 'counts', 'cs', 'cs2')}
+            keys = [(r, int(h)) for r, h in self.meta['series_keys']]
+            self._series_store = SeriesStore.from_packed(self.meta['series_regions'], keys,
+                                                         _load(self.path, 'series.offsets'), arrays)
+        return self._series_store
+
+    @property
+    def pyramid(self):
+        if self._pyramid is None:
+            meta = self.meta['pyramid']
+            arrays = {f'{level}.{stat}': _load(self.path, f'pyramid.{level}.{stat}')
+                      for level in meta['levels'] for stat in ('sum', 'count', 'min', 'max')}
+            self._pyramid = TimePyramid.from_arrays(meta, arrays)
+        return self._pyramid
+
+
+def attach(version, shared_dir=SHARED_DIR, load=taxi_store.load_taxi_count, keep_old=False):
+    """
+    SharedDataset for `version`, building it from load() first if no process
+    has yet. Older versions are removed after a build unless keep_old; processes
+    still mapping them keep their pages until they detach.
+    """
+    path = version_dir(version, shared_dir)
+    if os.path.exists(os.path.join(path, 'meta.json')):
+        return SharedDataset(path)
+
+    os.makedirs(shared_dir, exist_ok=True)
+    with open(os.path.join(shared_dir, f'.{os.path.basename(path)}.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)  # one builder per version and host, the others wait and attach
+        try:
+            if not os.path.exists(os.path.join(path, 'meta.json')):
+                tmp_path = f'{path}.tmp-{os.getpid()}'
+                shutil.rmtree(tmp_path, ignore_errors=True)
+                write(tmp_path, load())
+                os.replace(tmp_path, path)
+                if not keep_old:
+                    # other versions and their leftovers; partial datasets of this version may still be in use
+                    stem = os.path.basename(path).split('.')[0].split('-')[0]
+                    for name in os.listdir(shared_dir):
+                        if not name.startswith(('.', stem)):
+                            shutil.rmtree(os.path.join(shared_dir, name), ignore_errors=True)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+    return SharedDataset(path)
+
+
+def attach_years(version, years, shared_dir=SHARED_DIR):
+    """
+    SharedDataset of only the given years of `version`, kept next to the full
+    dataset. Building one or two years takes a fraction of the full build.
+    """
+    years = sorted(set(int(y) for y in years))
+    return attach(f"{version}-{'-'.join(map(str, years))}", shared_dir,
+                  load=lambda: taxi_store.load_taxi_count(years=years), keep_old=True)
+
+
+_builder = ThreadPoolExecutor(max_workers=1, thread_name_prefix='shared-dataset')
+
+
+def attach_in_background(version, shared_dir=SHARED_DIR):
+    """Future of attach(version), built on a background thread unless it exists already."""
+    path = version_dir(version, shared_dir)
+    if os.path.exists(os.path.join(path, 'meta.json')):
+        done = Future()
+        done.set_result(SharedDataset(path))
+        return done
+    return _builder.submit(attach, version, shared_dir)
+
+
+if __name__ == "__main__":
+    version = taxi_store.dataset_version()
+    t0 = time.perf_counter()
+    shared = attach(version)
+    print(f"{shared.path}: {shared.meta['rows']} rows, {time.perf_counter() - t0:.2f}s")
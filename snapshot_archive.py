@@ -0,0 +1,146 @@
+"""
+Day-packed binary archive of raw taxi-availability snapshots.
+
+One file per day, {out_dir}/{year}/{YYYYMMDD}.snap, laid out as
+
+    header      32 bytes: b'TAXISNAP', uint32 version, uint32 coordinate
+                itemsize (4 or 8), uint64 n_snapshots, uint64 n_points
+    timestamps  int64[n_snapshots]        yyyymmddHHMMSS, ascending
+    offsets     int64[n_snapshots + 1]    row offsets into coords
+    coords      float32/64[n_points, 2]   lon, lat
+
+SnapshotArchive memory-maps the file, so snapshot(i) is a zero-copy view.
+
+    python snapshot_archive.py data data   # pack data/{year}/*.json into day files
+"""
+import glob
+import json
+import os
+import struct
+from collections import defaultdict
+
+import numpy as np
+from tqdm import tqdm
+
+from district_index import snapshot_coordinates
+
+MAGIC = b'TAXISNAP'
+VERSION = 1
+HEADER = struct.Struct('<8sIIQQ')
+SUFFIX = '.snap'
+
+
+def day_path(out_dir, day):
+    # day: 'YYYYMMDD'
+    return os.path.join(out_dir, day[:4], day + SUFFIX)
+
+
+class SnapshotArchive:
+    def __init__(self, path):
+        self.path = path
+        self.raw = np.memmap(path, dtype=np.uint8, mode='r')
+        magic, version, itemsize, n_snap, n_points = HEADER.unpack(bytes(self.raw[:HEADER.size]))
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a taxi snapshot archive")
+        pos = HEADER.size
+        self.timestamps = self.raw[pos:pos + 8 * n_snap].view(np.int64)
+        pos += 8 * n_snap
+        self.offsets = self.raw[pos:pos + 8 * (n_snap + 1)].view(np.int64)
+        pos += 8 * (n_snap + 1)
+        dtype = np.float32 if itemsize == 4 else np.float64
+        self.coords = self.raw[pos:pos + itemsize * 2 * n_points].view(dtype).reshape(n_points, 2)
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield int(self.timestamps[i]), self.snapshot(i)
+
+    def snapshot(self, i):
+        """[n, 2] lon/lat view of the i-th snapshot."""
+        return self.coords[self.offsets[i]:self.offsets[i + 1]]
+
+    def find(self, dt_int):
+        i = int(np.searchsorted(self.timestamps, int(dt_int)))
+        if i < len(self) and self.timestamps[i] == int(dt_int):
+            return i
+        raise KeyError(dt_int)
+
+
+def write_archive(path, snapshots, dtype=np.float64):
+    """
+    Write {dt_int: (lon, lat)} to path, merged with whatever the file already
+    holds (new snapshots win on equal timestamps).
+    """
+    merged = {}
+    if os.path.exists(path):
+        old = SnapshotArchive(path)
+        dtype = old.coords.dtype
+        for ts, xy in old:
+            merged[ts] = (xy[:, 0].copy(), xy[:, 1].copy())
+        del old
+    merged.update({int(k): v for k, v in snapshots.items()})
+
+    stamps = np.array(sorted(merged), dtype=np.int64)
+    sizes = np.array([len(merged[s][0]) for s in stamps], dtype=np.int64)
+    offsets = np.zeros(len(stamps) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(sizes)
+    coords = np.empty((offsets[-1], 2), dtype=dtype)
+    for s, lo, hi in zip(stamps, offsets[:-1], offsets[1:]):
+        coords[lo:hi, 0], coords[lo:hi, 1] = merged[s]
+
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, coords.itemsize, len(stamps), len(coords)))
+        f.write(stamps.tobytes())
+        f.write(offsets.tobytes())
+        f.write(coords.tobytes())
+    os.replace(tmp, path)
+    return path
+
+
+def list_archives(raw_dir):
+    return sorted(glob.glob(os.path.join(raw_dir, '[0-9][0-9][0-9][0-9]', '*' + SUFFIX)))
+
+
+def convert_json_tree(raw_dir='data', out_dir='data', dtype=np.float64, remove=False):
+    """
+    Pack every {raw_dir}/{year}/{dt_int}.json into day archives under out_dir.
+    Unreadable files are reported and left in place. Returns the archives written.
+    """
+    days = defaultdict(list)
+    for path in glob.glob(os.path.join(raw_dir, '[0-9][0-9][0-9][0-9]', '*.json')):
+        stem = os.path.basename(path)[:-5]
+        if stem.isdigit():
+            days[stem[:8]].append((stem, path))
+
+    written = []
+    for day in tqdm(sorted(days)):
+        snapshots, packed = {}, []
+        for stem, path in days[day]:
+            try:
+                with open(path) as f:
+                    snapshots[stem] = snapshot_coordinates(json.load(f))
+                packed.append(path)
+            except Exception as e:
+                print(path, e)
+        written.append(write_archive(day_path(out_dir, day), snapshots, dtype))
+        if remove:
+            for path in packed:
+                os.remove(path)
+    return written
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Pack raw json snapshots into day archives")
+    parser.add_argument('raw_dir')
+    parser.add_argument('out_dir')
+    parser.add_argument('--float32', action='store_true', help="store coordinates as float32")
+    parser.add_argument('--remove', action='store_true', help="delete json files once packed")
+    args = parser.parse_args()
+
+    convert_json_tree(args.raw_dir, args.out_dir, np.float32 if args.float32 else np.float64, args.remove)
@@ -13,23 +13,33 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import instrumentation  # first: the process's first-render clock starts at its import
 import datetime as dt
 from datetime import datetime, timedelta
 import streamlit as st
 import pandas as pd
 import numpy as np
-import plotly.graph_objects as go
-import plotly.express as px
-import pydeck as pdk
-from streamlit_folium import folium_static
-import folium
-import geopandas as gpd
 import json
-from shapely.geometry.polygon import Polygon
-from shapely.geometry.multipolygon import MultiPolygon
+import os
+from contextlib import nullcontext
+import taxi_store
+import coverage_index
+import shared_dataset
+from instrumentation import cached, stage
+from monthly_rollup import MonthlyRollup
+from result_cache import ResultCache
+from queries import impact_ranking, impact_matrix
+from downsample import downsample_frame
+from position_bins import PositionBins, bins_state
+from count_cube import CountCube, get_time_delta, windows
+from query_service import QueryClient, parse_periods
+# plotly, pydeck and folium are imported by the parts of the page that use them, so the
+# header and search parameters render before those imports and the data loads
 
 # SETTING PAGE CONFIG TO WIDE MODE
 st.set_page_config(layout="wide")
+instrumentation.begin_rerun()  # per-stage timings of this rerun, see instrumentation.py
+debug = instrumentation.debug_enabled(st)
 
 # LOADING DATA
 MIN_DATE_TIME = datetime(2016, 9, 16, 13, 0, 0)
@@ -37,6 +47,13 @@ MIN_COVID_DATE_TIME = datetime(2020, 4, 1, 0, 0, 0)
 MAX_DATE_TIME = datetime(2021, 10, 16, 13, 0, 0)
 COUNTRY_GEO = 'data/region1.geojson'
 EXCLUDED_DISTRICTS = ['CHANGI BAY', 'LIM CHU KANG', 'SIMPANG']
+# when set, the page's queries are answered by a running query_service.py and no data is loaded in-process
+QUERY_URL = os.environ.get('CIM_QUERY_URL')
+# when set, new snapshots are polled from this feed and added to the loaded data as they arrive, see live.py
+LIVE_URL = os.environ.get('CIM_LIVE_URL')
+LIVE_INTERVAL = float(os.environ.get('CIM_LIVE_INTERVAL', 60))  # seconds between polls
+# points per trace of the district charts, about the pixel width of a half-page chart, see downsample.py
+CHART_WIDTH = 800
 
 
 # st.sidebar.header("Filter by time")
@@ -47,156 +64,298 @@ def date_to_datetime(t):
     return datetime(t.year, t.month, t.day)
 
 
-@st.cache(persist=True, allow_output_mutation=True, suppress_st_warning=True)
-def load_taxi_count():
+# STREAMLIT CODE BELOW #
+
+# LAYING OUT THE TOP SECTION OF THE APP
+# title_container = st.container()
+# with title_container:
+st.title("Cities in Motion")
+# st.subheader(
+# """
+# Tracking how demand for taxis has changed over the years in Singapore.
+# """)
+st.write(
+    """    
+    Discover how Covid has changed taxi demand in Singapore. 
+    """)
+
+# st.subheader("Summary (Islandwide)")
+
+with st.expander("Search Parameters", expanded=True):
+    row21, row22, row23, row24, row25 = st.columns((1, 1, 1, 1, 1))
+    with row21:
+        # Delta of (Baseline date + hour + for the next time unit - baseline date + hour)
+        baseline_date_start = st.date_input("Pre-Covid Date", value=MIN_DATE_TIME, min_value=MIN_DATE_TIME,
+                                            max_value=MIN_COVID_DATE_TIME)
+    with row22:
+        analysis_date_start = st.date_input("Post-Covid Date", value=MIN_COVID_DATE_TIME,
+                                            min_value=MIN_COVID_DATE_TIME,
+                                            max_value=dt.date.today() if LIVE_URL else MAX_DATE_TIME)
+    with row23:
+        hour_of_day = st.number_input("Time of Day (0-23 hrs)", value=20, min_value=0, max_value=23)
+    with row24:
+        time_period = st.number_input("For the next", value=10, min_value=1)
+    with row25:
+        # frequency_list = ("Hours", "Days", "Weeks", "Months", "Years")
+        frequency_list = ["Hours", "Days", "Weeks"]
+        time_frequency = st.selectbox("Time Unit", frequency_list, index=frequency_list.index("Days"))
+
+# LOADING DATA
+@cached(st.cache, allow_output_mutation=True, suppress_st_warning=True)
+def load_query_client(url):
+    # one pooled HTTP session per process
+    return QueryClient(url)
+
+
+query_client = load_query_client(QUERY_URL) if QUERY_URL else None
+# changes whenever the parquet store is rewritten (or the query service moves to new data); every loader
+# below and the result cache are keyed on it
+dataset_version = query_client.version() if query_client is not None else taxi_store.dataset_version()
+
+
+@cached(st.cache, allow_output_mutation=True, suppress_st_warning=True)
+def start_full_dataset(version):
+    # the full shared dataset, built on a background thread by the first process on a new host
+    return shared_dataset.attach_in_background(version)
+
+
+def window_years(date_start, cap):
+    # years of the (baseline or analysis) window starting on date_start, as count_cube.filter caps it
+    first = date_to_datetime(date_start) + timedelta(hours=int(hour_of_day))
+    last = min(first + get_time_delta(time_period, time_frequency), cap)
+    return set(range(first.year, max(last.year, first.year) + 1))
+
+
+full_dataset = start_full_dataset(dataset_version) if query_client is None else None
+# until the full dataset is ready, draw the page from just the years the selected windows touch
+data_years = None if full_dataset is None or full_dataset.done() else tuple(sorted(
+    window_years(baseline_date_start, MIN_COVID_DATE_TIME) | window_years(analysis_date_start, datetime(2021, 10, 1))))
+data_version = dataset_version if data_years is None else f"{dataset_version}-{'-'.join(map(str, data_years))}"
+
+
+def query_version():
+    # this rerun's data_version, put in the key of every memoized query when it runs: sessions share the
+    # result cache while some draw from a partial dataset or an older live update
+    return data_version
+
+
+@cached(st.cache, allow_output_mutation=True, suppress_st_warning=True)
+def load_shared_dataset(version, years=None):
+    # rows, cube and series store memory-mapped read-only and shared by every session and server
+    # process on the host, built from the parquet store by the first one, see shared_dataset.py
+    if years is None:
+        return start_full_dataset(version).result()
+    return shared_dataset.attach_years(version, years)
+
+
+@cached(st.cache, allow_output_mutation=True, suppress_st_warning=True)
+def load_taxi_count(version, years=None):
     # processed_fname = f'gs://dva-sg-team105/processed_summary/processed_taxi_count.all.csv'
-    year_dfs = [pd.read_csv(f'./data/analysis/processed_taxi_count.{year}.csv', index_col=0) for year in
-                range(2016, 2022)]
-    _df = pd.concat(year_dfs, axis=0)
+    # year-partitioned parquet store, see taxi_store.py (excluded periods are dropped there, see coverage_index.py)
+    return load_shared_dataset(version, years).full_data
 
-    # preprocessing
-    _df = _df.reset_index().set_index('filename')
-    idx = set(_df.index)
-    idx_to_dt_map = {x: datetime.strptime(str(x), "%Y%m%d%H%M%S") for x in idx}
 
-    # drop noisy data
-    idx_to_drop = [i for i in idx if (i < 20160916130000)
-                   or ((i >= 20171016110000) & (i <= 20171129090000))]
-    _df.drop(idx_to_drop, axis=0, inplace=True)
+# none of the in-process data is loaded when a query service answers the queries
+full_data = load_taxi_count(dataset_version, data_years) if query_client is None else None
+districts = sorted(set(query_client.regions() if query_client is not None else
+                       taxi_store.region_names(full_data.region)) - set(EXCLUDED_DISTRICTS))
+if data_years is not None:
+    st.info(f"Showing {', '.join(map(str, data_years))} while the other years load; "
+            "the charts over time fill in on the next change.")
 
-    _df.index = _df.index.map(idx_to_dt_map)
 
-    return _df
+@cached(st.cache, allow_output_mutation=True, suppress_st_warning=True)
+def load_position_bins(state):
+    # hourly taxi totals per grid cell, binned from the raw snapshots by position_bins.py; state is
+    # bins_state() of the bins directory, so days binned since the last load are picked up
+    return PositionBins()
 
 
-full_data = load_taxi_count()
-districts = sorted(list(set(full_data.region) - set(EXCLUDED_DISTRICTS)))
+position_bins = load_position_bins(bins_state())
 
 
-@st.cache(persist=True, allow_output_mutation=True, suppress_st_warning=True)
-def load_taxi_locations():
-    # fname = f'gs://dva-sg-team105/processed/2021/taxi_region.20211001000000.csv'
-    fname = './data/processed/2021/taxi_region.20211001000000.csv'  # not available
+@cached(st.cache, allow_output_mutation=True, suppress_st_warning=True)
+def load_coverage(version, years=None):
+    # snapshot availability and exclusions per 5-minute slot, see coverage_index.py; ingest keeps it current,
+    # a store converted from the csv files alone gets it rebuilt once here (not when the store is the query service's)
+    if os.path.exists(coverage_index.COVERAGE) or query_client is not None:
+        return coverage_index.Coverage.load()
+    coverage = coverage_index.from_store(years=years)
+    if years is None:
+        coverage.save()
+    return coverage
 
-    df = pd.read_csv(fname, index_col=0)
-    st.write(df)
-    # add geometry
-    df['geometry'] = df['geometry'].apply(wkt.loads)
-    gdf = gpd.GeoDataFrame(df, crs='epsg:4326')
-    return gdf
 
+snapshot_coverage = load_coverage(dataset_version, data_years)
 
-# taxi_locations = load_taxi_locations()
 
-@st.cache(persist=True, allow_output_mutation=True, suppress_st_warning=True)
-def load_country_gdf():
-    fname = COUNTRY_GEO
+def coverage_note(window):
+    # the window's snapshots at hour_of_day (one per day) by state, and its gaps, from the coverage index;
+    # window is a (from, to) pair of count_cube.windows(), both ends included as in filter_data
+    window_from, last = window
+    summary = snapshot_coverage.summary(window_from, last, step='1D')
+    note = f"{summary['usable']} of {summary['expected']} hours with data"
+    if summary['excluded']:
+        note += f", {summary['excluded']} excluded"
+    gaps = snapshot_coverage.gaps(window_from, last, step='1D')
+    if gaps:
+        note += "; missing " + ", ".join(
+            f"{a:%Y-%m-%d}" if n == 1 else f"{a:%Y-%m-%d} to {b:%Y-%m-%d}" for a, b, n in gaps[:5])
+        if len(gaps) > 5:
+            note += f" and {len(gaps) - 5} more"
+    return note
 
-    with open(fname, "rb") as f:
-        country_json = json.load(f)
-    country_gdf = gpd.GeoDataFrame.from_features(country_json)
-    country_gdf["geometry"] = [MultiPolygon(feature) if type(feature) != Polygon else feature for feature in
-                               country_gdf["geometry"]]
-    # TUAS, SOUTHERN ISLANDS, WESTERN WATER CATCHMENT and other districts are GeometryCollection geometries in the source file. They don't play well with GeoJsonTooltip. Casting them all to
-    # MultiPolygon to ensure the GeoJson tooltip works. For more info, see: https://github.com/python-visualization/folium/issues/929
-    country_gdf["lat"] = country_gdf.centroid.x
-    country_gdf['long'] = country_gdf.centroid.y
-    return country_gdf
+@cached(st.cache, allow_output_mutation=True, suppress_st_warning=True)
+def load_geometry_cache():
+    # simplified district polygons serialized once per tolerance level
+    from geometry_cache import GeometryCache
 
+    return GeometryCache.from_geojson(COUNTRY_GEO)
 
-country_gdf = load_country_gdf()
 
+@cached(st.cache, allow_output_mutation=True, suppress_st_warning=True)
+def load_count_cube(version, years=None):
+    # region x day x hour cube, built once so filter_data never rescans full_data
+    return load_shared_dataset(version, years).cube
 
-@st.cache(persist=True, allow_output_mutation=True, suppress_st_warning=True)
-def filter_data(full_data, baseline_date_start, analysis_date_start, hour_of_day, time_period, time_frequency):
-    def get_time_delta(time_period, time_frequency):
-        p = int(time_period)
-        if time_frequency.lower() == 'hours':
-            return timedelta(hours=p)
-        elif time_frequency.lower() == 'days':
-            return timedelta(days=p)
-        elif time_frequency.lower() == 'weeks':
-            return timedelta(weeks=p)
 
-    baseline_from = date_to_datetime(baseline_date_start) + timedelta(hours=int(hour_of_day))
-    baseline_to = baseline_from + get_time_delta(time_period, time_frequency)
-    if baseline_to >= datetime(2020, 4, 1):
-        baseline_to = datetime(2020, 4, 1)
+count_cube = load_count_cube(dataset_version, data_years) if query_client is None else None
 
-    # st.write(baseline_from, baseline_to)  # debug
 
-    analysis_from = date_to_datetime(analysis_date_start) + timedelta(hours=int(hour_of_day))
-    analysis_to = analysis_from + get_time_delta(time_period, time_frequency)
-    if analysis_to >= datetime(2021, 10, 1):
-        analysis_to = datetime(2021, 10, 1)
-
-    # st.write(analysis_from, analysis_to)  # debug
-
-    baseline_data = full_data.loc[baseline_from:baseline_to].copy()
-    baseline_data["hour"] = baseline_data.index.hour
-    baseline_data["hour"] = baseline_data["hour"].astype(int)
-    baseline_data = baseline_data[baseline_data["hour"] == int(hour_of_day)]
-    baseline_data.drop('hour', axis=1, inplace=True)
-    baseline_data = baseline_data.groupby('region').mean().round().reset_index()  # take mean across all hourly data
-    # st.write(baseline_data)  # debug
-
-    analysis_data = full_data.loc[analysis_from:analysis_to].copy()
-    analysis_data["hour"] = analysis_data.index.hour
-    analysis_data["hour"] = analysis_data["hour"].astype(int)
-    analysis_data = analysis_data[analysis_data["hour"] == int(hour_of_day)]
-    analysis_data.drop('hour', axis=1, inplace=True)
-    analysis_data = analysis_data.groupby('region').mean().round().reset_index()  # take mean across all hourly data
-    # st.write(analysis_data)  # debug
+@cached(st.cache, allow_output_mutation=True, suppress_st_warning=True)
+def load_result_cache():
+    # one process-wide cache of query results, keyed by their parameters, see result_cache.py
+    return ResultCache()
 
+
+results = load_result_cache()
+
+
+@results.memoize(ignore=('full_data',), version=query_version)
+def filter_data(full_data, baseline_date_start, analysis_date_start, hour_of_day, time_period, time_frequency):
+    # full_data is kept in the signature for callers; the windows are answered from count_cube
+    if query_client is not None:
+        return query_client.compare(baseline_date_start, analysis_date_start, hour_of_day, time_period,
+                                    time_frequency)
+    with data_lock:
+        baseline_data, analysis_data = count_cube.filter(baseline_date_start, analysis_date_start, hour_of_day,
+                                                         time_period, time_frequency)
     return baseline_data, analysis_data
 
 
-@st.cache(persist=True, allow_output_mutation=True, suppress_st_warning=True)
-def taxigraph(dataset, region, hour, startdate, enddate):
+@results.memoize(version=query_version)
+def impact_matrix_table(baseline_date_start, analysis_date_start, time_periods, time_frequency):
+    # impact ranking of every hour of the day for each window length, in one pass over count_cube
+    if query_client is not None:
+        return query_client.impact_matrix(baseline_date_start, analysis_date_start, time_periods, time_frequency)
+    with data_lock:
+        return impact_matrix(count_cube, baseline_date_start, analysis_date_start, time_periods, time_frequency)
+
+
+@cached(st.cache, allow_output_mutation=True, suppress_st_warning=True)
+def load_series_store(version, years=None):
+    # per-(region, hour) series with running sums, see series_store.py
+    return load_shared_dataset(version, years).series_store
+
+
+series_store = load_series_store(dataset_version, data_years) if query_client is None else None
+
+
+@results.memoize(ignore=('dataset',), version=query_version)
+def taxigraph(dataset, region, hour, startdate, enddate, width=None):
     """
-    dataset: full_data = load_taxi_count()
+    dataset: full_data = load_taxi_count() (unused, rows come from series_store)
     region: expects string eg. 'ANG MO KIO'
     hour: hour of the day, integer [0:23]
     startdate: 'Pre-Covid Period Starts On' date
     enddate: 'Covid Period Starts On' date
+    width: downsample to about this many points per trace (LTTB), None for every row
     """
+    if query_client is not None:
+        return query_client.series(region, hour, startdate, enddate, window=90, width=width)
+    with data_lock:
+        data = series_store.rolling(region, hour, startdate, enddate, window=90)
+    if width is None:
+        return data
+    return downsample_frame(data, 'filename', ['taxi_count', 'rolling_average'], width)
 
-    def date_to_datetime(t):
-        return datetime(t.year, t.month, t.day)
 
-    basedata = full_data.copy()
+@cached(st.cache, allow_output_mutation=True, suppress_st_warning=True)
+def load_monthly_rollup(version, years=None):
+    # (region, month, hour) totals backing the animated bar chart, see monthly_rollup.py;
+    # shares count_cube, so appending to the rollup keeps filter_data current too
+    return MonthlyRollup(load_count_cube(version, years))
 
-    basedata = basedata.loc[str(startdate):str(enddate)]  # date
-    basedata = basedata[basedata.index.hour == hour]  # hour
-    if region != "All":
-        basedata = basedata.loc[basedata.region == region]  # region
 
-    basedata = basedata.reset_index()
-    basedata['rolling_average'] = basedata.taxi_count.rolling(90).mean()
-    return basedata
+monthly_rollup = load_monthly_rollup(dataset_version, data_years) if query_client is None else None
 
 
-def create_folium_choropleth(taxi_count_df, country_geo, country_gdf, max_count):
+@cached(st.cache, allow_output_mutation=True, suppress_st_warning=True)
+def start_live_feed(version):
+    # one poller per process, appending to the cube, rollup, series store and coverage every session reads;
+    # st.cache keys on the argument tuple, so the loaders are called exactly as the page calls them
+    from live import LiveFeed
+
+    return LiveFeed(load_monthly_rollup(version, None), load_series_store(version, None), url=LIVE_URL,
+                    coverage=load_coverage(version, None)).start(LIVE_INTERVAL)
+
+
+# live updates only go to the full, in-process data; a query service has its own copy
+live_feed = start_live_feed(dataset_version) if LIVE_URL and data_years is None and query_client is None else None
+if live_feed is not None and not (live_feed.rollup is monthly_rollup and live_feed.series_store is series_store
+                                  and live_feed.coverage is snapshot_coverage):
+    raise RuntimeError("the live feed must append to the objects the page reads")
+data_lock = live_feed.lock if live_feed is not None else nullcontext()
+if live_feed is not None:
+    data_version = f"{data_version}-{live_feed.version}"
+    if live_feed.latest is not None:
+        MAX_DATE_TIME = max(MAX_DATE_TIME, live_feed.latest)
+results.set_version(dataset_version)  # a new store drops every result; partial and live versions are per key
+
+
+@results.memoize(version=query_version)
+def animation_figure(hour_of_day, baseline_date_start):
+    # one figure per (hour, start date), frames come straight from the monthly rollup
+    import plotly.express as px
+
+    if query_client is not None:
+        all_districts_data = query_client.animation(hour_of_day, baseline_date_start, MAX_DATE_TIME)
+    else:
+        with data_lock:
+            all_districts_data = monthly_rollup.frame(hour_of_day, baseline_date_start, MAX_DATE_TIME)
+    max_taxi_count = all_districts_data.taxi_count.max()
+
+    return px.bar(all_districts_data, x='District', y='taxi_count', color='District', animation_frame="Date", \
+                  animation_group="District", \
+                  hover_name='District', range_y=[0, max_taxi_count], range_x=[0, 30],
+                  title=f"Districts with the largest taxi demand at {hour_of_day}:00 over time") \
+        .update_xaxes(categoryorder="total descending")
+
+
+def create_folium_choropleth(taxi_count_df, country_geo, max_count, stage_info=None):
+    # stage_info: optional instrumentation stage to record rows and payload bytes on
+    import folium
+    from streamlit_folium import folium_static
+
+    geometry_cache = load_geometry_cache()
+    stage_info = {} if stage_info is None else stage_info
     # center on Singapore
     m = folium.Map(location=[1.3572, 103.8207], zoom_start=11)
 
     max_count_rounded = int((max_count // 100) + 2) * 100  # like math.ceil
     bins = list(range(0, max_count_rounded, max_count_rounded // 10))
 
-    # change country_gdf such that taxi count appears on tooltip
-    data_on_date = taxi_count_df.copy()  # deepcopy
-    country_gdf_on_date = country_gdf.copy()  # deepcopy
-    districts_on_date = sorted(list(set(data_on_date.region.tolist())))
-    name_to_namecount_map = {
-        d: d + " Taxis: {:.0f}".format(data_on_date.loc[data_on_date.region == d, 'taxi_count'].values[0]) for d in
-        districts_on_date}
-    data_on_date['region'] = data_on_date.region.map(name_to_namecount_map)
-    data_on_date.dropna(subset=['region'], inplace=True)
-    country_gdf_on_date['name'] = country_gdf_on_date.name.map(name_to_namecount_map)
-    country_gdf_on_date.dropna(subset=['name'], inplace=True)
+    # taxi count appears on tooltip via the name property; geometries come pre-serialized from geometry_cache
+    counts = dict(zip(taxi_count_df.region.astype(str), taxi_count_df.taxi_count))
+    name_to_namecount_map = {d: d + " Taxis: {:.0f}".format(counts[d]) for d in sorted(counts)}
+    data_on_date = pd.DataFrame({'region': [name_to_namecount_map[d] for d in counts],
+                                 'taxi_count': list(counts.values())})
+    geo_json = geometry_cache.feature_collection({d: {'name': n} for d, n in name_to_namecount_map.items()})
+    stage_info['rows'] = len(data_on_date)
+    stage_info['bytes'] = len(geo_json)
 
     choropleth = folium.Choropleth(
-        geo_data=country_gdf_on_date.to_json(),
+        geo_data=geo_json,
         # name="choropleth",
         data=data_on_date,
         columns=["region", "taxi_count"],
@@ -218,9 +377,28 @@ def create_folium_choropleth(taxi_count_df, country_geo, country_gdf, max_count)
     folium_static(m, width=750)
 
 
+def plotly_chart(fig, name):
+    # st.plotly_chart as its own stage; the figure's payload size is only measured in debug mode
+    with stage(name) as s:
+        if debug:
+            s['bytes'] = len(fig.to_json())
+        st.plotly_chart(fig, use_container_width=True)
+
+
 # CREATING FUNCTION FOR MAPS
 
+@results.memoize(version=query_version)
+def taxi_density(window, hour_of_day):
+    # mean taxis per grid cell at hour_of_day over the window, summed from the precomputed bins; window is
+    # a (from, to) pair of count_cube.windows(), capped like filter_data at Covid and the end of the data
+    window_from, window_to = window
+    return position_bins.density(window_from, window_to, hour_of_day)
+
+
 def map(data, lat, lon, zoom):
+    # data: lon, lat and weight (mean taxis) per grid cell; hexagons add up the weights of their cells
+    import pydeck as pdk
+
     st.write(pdk.Deck(
         map_style="mapbox://styles/mapbox/light-v9",
         initial_view_state={
@@ -234,7 +412,11 @@ def map(data, lat, lon, zoom):
                 "HexagonLayer",
                 data=data,
                 get_position=["lon", "lat"],
-                radius=100,
+                get_elevation_weight="weight",
+                get_color_weight="weight",
+                elevation_aggregation="SUM",
+                color_aggregation="SUM",
+                radius=300,
                 elevation_scale=4,
                 elevation_range=[0, 1000],
                 pickable=True,
@@ -244,42 +426,21 @@ def map(data, lat, lon, zoom):
     ))
 
 
-# STREAMLIT CODE BELOW #
-
-# LAYING OUT THE TOP SECTION OF THE APP
-# title_container = st.container()
-# with title_container:
-st.title("Cities in Motion")
-# st.subheader(
-# """
-# Tracking how demand for taxis has changed over the years in Singapore.
-# """)
-st.write(
-    """    
-    Discover how Covid has changed taxi demand in Singapore. 
-    """)
-
-# st.subheader("Summary (Islandwide)")
-
-with st.expander("Search Parameters", expanded=True):
-    row21, row22, row23, row24, row25 = st.columns((1, 1, 1, 1, 1))
-    with row21:
-        # Delta of (Baseline date + hour + for the next time unit - baseline date + hour)
-        baseline_date_start = st.date_input("Pre-Covid Date", value=MIN_DATE_TIME, min_value=MIN_DATE_TIME,
-                                            max_value=MIN_COVID_DATE_TIME)
-    with row22:
-        analysis_date_start = st.date_input("Post-Covid Date", value=MIN_COVID_DATE_TIME,
-                                            min_value=MIN_COVID_DATE_TIME, max_value=MAX_DATE_TIME)
-    with row23:
-        hour_of_day = st.number_input("Time of Day (0-23 hrs)", value=20, min_value=0, max_value=23)
-    with row24:
-        time_period = st.number_input("For the next", value=10, min_value=1)
-    with row25:
-        # frequency_list = ("Hours", "Days", "Weeks", "Months", "Years")
-        frequency_list = ["Hours", "Days", "Weeks"]
-        time_frequency = st.selectbox("Time Unit", frequency_list, index=frequency_list.index("Days"))
+if live_feed is not None:
+    if live_feed.latest is None:
+        st.caption("Live: waiting for the first snapshot")
+    else:
+        st.caption(f"Live: {live_feed.snapshots} new snapshots, the latest at {live_feed.latest:%Y-%m-%d %H:%M}")
+        with st.expander("Live now", expanded=False):
+            with data_lock:
+                now = live_feed.stats.deviation(live_feed.latest_frame)
+            st.write("Taxis per district in the latest snapshot, against all snapshots so far at the same hour")
+            st.dataframe(now.sort_values('z', key=abs, ascending=False).round(2).rename(
+                columns={'region': 'District', 'taxi_count': 'Now', 'mean': 'Mean', 'std': 'Std', 'z': 'z-score'})
+                .set_index('District'))
 
 # FILTERING DATA BY INPUTS
+# timed and counted as a stage by results.memoize
 baseline_data, analysis_data = filter_data(full_data, baseline_date_start, analysis_date_start, hour_of_day,
                                            time_period, time_frequency)
 
@@ -292,13 +453,20 @@ else:
 # # st.write(baseline_data.taxi_count.max())
 # # st.write(analysis_data.taxi_count.max())
 
+# the windows filter_data averaged over, capped like it at the start of Covid and the end of the data
+baseline_window, analysis_window = windows(baseline_date_start, analysis_date_start, hour_of_day, time_period,
+                                           time_frequency, CountCube.analysis_end if count_cube is None else
+                                           count_cube.analysis_end)
+
 row41, row42 = st.columns((1, 1))
 with row41:
     baseline_from = date_to_datetime(baseline_date_start) + timedelta(hours=int(hour_of_day))
     if (baseline_from >= MIN_DATE_TIME) and (baseline_from <= MIN_COVID_DATE_TIME):
         _date = datetime.strftime(baseline_date_start, "%Y-%m-%d")
         st.markdown(f"##### Pre-Covid: Taxi Demand on {_date}")
-        create_folium_choropleth(baseline_data, COUNTRY_GEO, country_gdf, max_count)
+        with stage('choropleth_baseline') as s:
+            create_folium_choropleth(baseline_data, COUNTRY_GEO, max_count, s)
+        st.caption(coverage_note(baseline_window))
     else:
         # invalid input
         st.write("Pre-Covid start date must be between 2016-09-16 13:00 and 2020-04-01 00:00")
@@ -307,140 +475,153 @@ with row42:
     if (analysis_from >= MIN_COVID_DATE_TIME) and (analysis_from <= MAX_DATE_TIME):
         _analysis_date = datetime.strftime(analysis_date_start, "%Y-%m-%d")
         st.markdown(f'##### Post-Covid: Taxi Demand on {_analysis_date}')
-        create_folium_choropleth(analysis_data, COUNTRY_GEO, country_gdf, max_count)
+        with stage('choropleth_analysis') as s:
+            create_folium_choropleth(analysis_data, COUNTRY_GEO, max_count, s)
+        st.caption(coverage_note(analysis_window))
     else:
         # invalid input
         st.write("Pre-Covid start date must be between 2020-04-01 00:00 and 2021-10-01 00:00")
 
-combined_data = pd.merge(baseline_data, analysis_data, on=['region'], how='outer').rename(
-    columns={'region': 'District', 'taxi_count_x': 'Pre-Covid', 'taxi_count_y': 'Post Covid'})
-combined_data["Delta"] = abs(combined_data["Post Covid"] - combined_data["Pre-Covid"])
-combined_data = combined_data.sort_values(by=['Delta'], ascending=False)
-# country_gdf
-# combined_data = pd.merge(combined_data, country_gdf[["name", "lat", "long"]], left_on=['District'], right_on=['name'], how='outer').drop(["name"], axis=1)
-
-combined_data_head = combined_data.head(15)
-combined_data_tail = combined_data.tail(15)
-
-melted_combined_data_head = combined_data_head.melt(id_vars=['District'], value_vars=['Pre-Covid', 'Post Covid'],
-                                                    var_name='Period', value_name='Taxi Count')
-melted_combined_data_tail = combined_data_tail.melt(id_vars=['District'], value_vars=['Pre-Covid', 'Post Covid'],
-                                                    var_name='Period', value_name='Taxi Count')
-
-summary_graph_plotly_head = px.bar(melted_combined_data_head, x='District', y='Taxi Count', color='Period',
-                                   barmode='group', width=400, height=400, title="Most Impacted Districts")
-summary_graph_plotly_head.update_layout(
-    xaxis = go.layout.XAxis(
-        tickangle = 45)
-)
-
-summary_graph_plotly_tail = px.bar(melted_combined_data_tail, x='District', y='Taxi Count', color='Period',
-                                   barmode='group', width=400, height=400, title="Least Impacted Districts")
-summary_graph_plotly_tail.update_layout(
-    xaxis = go.layout.XAxis(
-        tickangle = 45)
-)
+def impact_bar_chart(districts, title):
+    # pre- and post-Covid counts side by side for some rows of the impact ranking
+    import plotly.express as px
+    import plotly.graph_objects as go
 
-st.markdown("***")
-st.markdown(f'### Impact of Covid by District')
-st.write('The districts that saw the most and least change in taxi demand ')
+    melted = districts.melt(id_vars=['District'], value_vars=['Pre-Covid', 'Post Covid'], var_name='Period',
+                            value_name='Taxi Count')
+    fig = px.bar(melted, x='District', y='Taxi Count', color='Period', barmode='group', width=400, height=400,
+                 title=title)
+    fig.update_layout(
+        xaxis = go.layout.XAxis(
+            tickangle = 45)
+    )
+    return fig
 
-row51, row52 = st.columns((1, 1))
-with row51:
-    st.plotly_chart(summary_graph_plotly_head, use_container_width=True)
-with row52:
-    st.plotly_chart(summary_graph_plotly_tail, use_container_width=True)
 
-row61, row62 = st.columns((1, 1))
-# with row61:
-# ----------------------------ANIMATED GRAPH----------------------------
-all_districts_data = taxigraph(full_data, "All", hour_of_day, baseline_date_start, MAX_DATE_TIME)
-all_districts_data["date"] = all_districts_data["filename"].apply(lambda x: pd.to_datetime(x))
-all_districts_data = all_districts_data.drop(columns=["rolling_average"])
-# all_districts_data["date_str"] = all_districts_data["filename"].apply(lambda x:datetime.strftime(x, "%Y-%m-%d"))
-all_districts_data = all_districts_data.groupby([all_districts_data.region.rename("District"), \
-                                                 all_districts_data.date.dt.year.rename("year"),
-                                                 all_districts_data.date.dt.month.rename("month")]).agg(
-    {'taxi_count': "sum"}).reset_index()
-all_districts_data["Date"] = all_districts_data["year"].astype(str) + "-" + all_districts_data["month"].astype(str)
-all_districts_data = all_districts_data.drop(columns=["year", "month"])
-max_taxi_count = all_districts_data.taxi_count.max()
-
-fig3 = px.bar(all_districts_data, x='District', y='taxi_count', color='District', animation_frame="Date", \
-              animation_group="District", \
-              hover_name='District', range_y=[0, max_taxi_count], range_x=[0, 30],
-              title=f"Districts with the largest taxi demand at {hour_of_day}:00 over time") \
-    .update_xaxes(categoryorder="total descending")
-st.plotly_chart(fig3, use_container_width=True)
-# ----------------------------
+def impact_heatmap(heat):
+    import plotly.express as px
 
-st.markdown("***")
-st.subheader("Change in Taxi Demand over Time")
-st.write('Compare districts to see how taxi demand has changed over time')
+    return px.imshow(heat, labels={'x': 'Hour of day', 'y': 'District', 'color': 'Delta'}, aspect='auto',
+                     title="Change per hour of day, most impacted districts")
 
-row61, row62 = st.columns((1, 1))
-with row61:
-    selected_district_1 = st.selectbox("Select District 1:", list(combined_data.District.unique()))
 
-    district_1_data = taxigraph(full_data, selected_district_1, hour_of_day, baseline_date_start, MAX_DATE_TIME)
-    fig1 = px.line(district_1_data, x='filename', y=['taxi_count', 'rolling_average'],
-                   labels={"filename": "Time", "value": "Taxi Count"},
-                   title=f'Taxi Demand in {selected_district_1} at {hour_of_day}:00 hours')
+def district_chart(district_data, district):
+    # the district's counts and rolling average at hour_of_day, with the Covid events marked
+    import plotly.express as px
 
-    fig1.update_xaxes(showgrid=False).update_yaxes(showgrid=False) # turn on gridlines if desired
+    fig = px.line(district_data, x='filename', y=['taxi_count', 'rolling_average'],
+                  labels={"filename": "Time", "value": "Taxi Count"},
+                  title=f'Taxi Demand in {district} at {hour_of_day}:00 hours')
+
+    fig.update_xaxes(showgrid=False).update_yaxes(showgrid=False)  # turn on gridlines if desired
 
     # add these event lines, specified by x-position
     lines = {'a': '2020-02-17', 'b': '2020-04-03', 'c': '2020-06-02'}
     for k in lines.keys():
-        fig1.add_shape(type='line',
+        fig.add_shape(type='line',
                       yref="y",
                       xref="x",
                       x0=lines[k],
                       y0=-10,
                       x1=lines[k],
-                      y1=district_1_data.taxi_count.max()*1.05,
+                      y1=district_data.taxi_count.max() * 1.05,
                       line=dict(color='grey', width=1))
-        fig1.add_annotation(
+        fig.add_annotation(
             x=lines[k],
             y=1.06,
             yref='paper',
             showarrow=False,
             text=k)
+    return fig
 
-    st.plotly_chart(fig1, use_container_width=True)
 
-with row62:
-    selected_district_2 = st.selectbox("Select District 2:", list(combined_data.District.unique()))
-    district_2_data = taxigraph(full_data, selected_district_2, hour_of_day, baseline_date_start, MAX_DATE_TIME)
-    fig2 = px.line(district_2_data, x='filename', y=['taxi_count', 'rolling_average'],
-                   labels={"filename": "Time", "value": "Taxi Count"},
-                   title=f'Taxi Demand in {selected_district_2} at {hour_of_day}:00 hours')
+with stage('impact_ranking') as s:
+    combined_data = impact_ranking(baseline_data, analysis_data)
+    summary_graph_plotly_head = impact_bar_chart(combined_data.head(15), "Most Impacted Districts")
+    summary_graph_plotly_tail = impact_bar_chart(combined_data.tail(15), "Least Impacted Districts")
+    s['rows'] = len(combined_data)
 
-    fig2.update_xaxes(showgrid=False).update_yaxes(showgrid=False)  # turn on gridlines if desired
+st.markdown("***")
+st.markdown(f'### Impact of Covid by District')
+st.write('The districts that saw the most and least change in taxi demand ')
 
-    # add these event lines, specified by x-position
-    lines = {'a': '2020-02-17', 'b': '2020-04-03', 'c': '2020-06-02'}
-    for k in lines.keys():
-        fig2.add_shape(type='line',
-                       yref="y",
-                       xref="x",
-                       x0=lines[k],
-                       y0=-10,
-                       x1=lines[k],
-                       y1=district_2_data.taxi_count.max() * 1.05,
-                       line=dict(color='grey', width=1))
-        fig2.add_annotation(
-            x=lines[k],
-            y=1.06,
-            yref='paper',
-            showarrow=False,
-            text=k)
+row51, row52 = st.columns((1, 1))
+with row51:
+    plotly_chart(summary_graph_plotly_head, 'summary_graph_plotly_head')
+with row52:
+    plotly_chart(summary_graph_plotly_tail, 'summary_graph_plotly_tail')
+
+with st.expander("All hours and window lengths"):
+    periods_text = st.text_input(f"Window lengths in {time_frequency.lower()}, e.g. 1, 7, 30 or 1-14",
+                                 value=f"1, 7, {int(time_period)}")
+    try:
+        time_periods = tuple(sorted(set(parse_periods(periods_text))))
+    except ValueError as e:
+        st.write(str(e))
+        time_periods = (int(time_period),)
+    matrix = impact_matrix_table(baseline_date_start, analysis_date_start, time_periods, time_frequency)
+    selected_period = st.selectbox(f"Window length ({time_frequency.lower()})", time_periods,
+                                   index=len(time_periods) - 1)
+    with stage('impact_matrix_heatmap') as s:
+        period_matrix = matrix[matrix.period == selected_period]
+        top = period_matrix.groupby('District').Delta.mean().nlargest(15).index
+        heat = period_matrix[period_matrix.District.isin(top)].pivot(index='District', columns='hour', values='Delta')
+        heat = heat.reindex(top)
+        s['rows'] = len(period_matrix)
+    plotly_chart(impact_heatmap(heat), 'impact_matrix_heatmap')
+    st.download_button("Download the full table (csv)", matrix.to_csv(index=False),
+                       file_name=f"impact_{baseline_date_start}_{analysis_date_start}_{time_frequency.lower()}.csv",
+                       mime='text/csv')
+
+row61, row62 = st.columns((1, 1))
+# with row61:
+# ----------------------------ANIMATED GRAPH----------------------------
+fig3 = animation_figure(hour_of_day, baseline_date_start)  # timed as a stage by results.memoize
+plotly_chart(fig3, 'fig3')
+# ----------------------------
+
+st.markdown("***")
+st.subheader("Change in Taxi Demand over Time")
+st.write('Compare districts to see how taxi demand has changed over time')
+
+row61, row62 = st.columns((1, 1))
+with row61:
+    selected_district_1 = st.selectbox("Select District 1:", list(combined_data.District.unique()))
 
-    st.plotly_chart(fig2, use_container_width=True)
+    district_1_data = taxigraph(full_data, selected_district_1, hour_of_day, baseline_date_start, MAX_DATE_TIME,
+                                width=CHART_WIDTH)
+    fig1 = district_chart(district_1_data, selected_district_1)
+    plotly_chart(fig1, 'fig1')
+
+with row62:
+    selected_district_2 = st.selectbox("Select District 2:", list(combined_data.District.unique()))
+    district_2_data = taxigraph(full_data, selected_district_2, hour_of_day, baseline_date_start, MAX_DATE_TIME,
+                                width=CHART_WIDTH)
+    fig2 = district_chart(district_2_data, selected_district_2)
+    plotly_chart(fig2, 'fig2')
 
 st.write(
     """    **Events:**  
     **a**:  Stay-Home-Notice imposed on Travellers (17feb2020)  
     **b**:  Start of Circuit Breaker (3apr2020)  
     **c**:  End of Circuit Breaker (2jun2020)  
-    """)
\ No newline at end of file
+    """)
+
+if len(position_bins):
+    st.markdown("***")
+    st.subheader("Where the Taxis Are")
+    st.write(f'Average number of available taxis around {hour_of_day}:00 in each period')
+    row71, row72 = st.columns((1, 1))
+    with row71:
+        st.markdown("##### Pre-Covid")
+        with stage('map_baseline'):
+            map(taxi_density(baseline_window, hour_of_day), 1.3572, 103.8207, 10)
+    with row72:
+        st.markdown("##### Post-Covid")
+        with stage('map_analysis'):
+            map(taxi_density(analysis_window, hour_of_day), 1.3572, 103.8207, 10)
+
+rerun_record = instrumentation.end_rerun()
+if debug:
+    instrumentation.debug_panel(st, rerun_record)
+    st.write("Result cache", results.stats())
@@ -0,0 +1,150 @@
+"""
+Local stand-in for the data.gov.sg taxi-availability endpoint.
+
+Serves GET /v1/transport/taxi-availability?date_time=YYYY-MM-DDTHH:MM:SS with
+a response shaped like the real API. Positions are synthetic but
+deterministic per timestamp, or with --replay replayed from downloaded
+snapshots: a request for any time gets the archived snapshot at the same time
+of week, so a live poller (live.py) sees realistic data for "now". A fraction
+of requests can be made to fail with 429/503 to exercise client retries.
+
+    python stub_server.py --port 8000
+    python data_download.py 2019-01-01 2019-01-02 --url http://localhost:8000/v1/transport/taxi-availability
+    python stub_server.py --port 8000 --replay data
+"""
+import json
+import threading
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs, unquote
+
+import numpy as np
+import pandas as pd
+
+PATH = '/v1/transport/taxi-availability'
+# rough bounding box of mainland Singapore
+LON_RANGE = (103.62, 104.0)
+LAT_RANGE = (1.24, 1.46)
+
+
+def feature_collection(date_time, lon, lat):
+    # response body of the real API for the given positions
+    return {
+        "type": "FeatureCollection",
+        "crs": {"type": "link", "properties": {"href": "http://spatialreference.org/ref/epsg/4326/ogcwkt/",
+                                               "type": "ogcwkt"}},
+        "features": [{
+            "type": "Feature",
+            "geometry": {"type": "MultiPoint", "coordinates": np.column_stack([lon, lat]).tolist()},
+            "properties": {"timestamp": f"{date_time}+08:00", "taxi_count": len(lon),
+                           "api_info": {"status": "healthy"}},
+        }],
+    }
+
+
+def synthetic_snapshot(date_time, n_taxis=5000):
+    seed = zlib.crc32(date_time.encode())
+    rng = np.random.default_rng(seed)
+    n = int(n_taxis * rng.uniform(0.8, 1.2))
+    lon = np.round(rng.uniform(*LON_RANGE, n), 6)
+    lat = np.round(rng.uniform(*LAT_RANGE, n), 6)
+    return feature_collection(date_time, lon, lat)
+
+
+def replay_snapshot_fn(raw_dir='data'):
+    """
+    snapshot_fn serving the snapshots downloaded under raw_dir (json files or
+    day archives): a request is moved back by whole weeks into the archived
+    range and answered with the latest snapshot at or before that time.
+    """
+    from ingest import list_snapshots
+    from snapshot_archive import SnapshotArchive, SUFFIX
+
+    paths = list_snapshots(raw_dir)
+    if not paths:
+        raise ValueError(f"no snapshots under {raw_dir}")
+    keys = sorted(paths)
+    times = pd.to_datetime(keys, format='%Y%m%d%H%M%S').values
+    week = np.timedelta64(7, 'D')
+
+    def snapshot(date_time):
+        t = np.datetime64(pd.Timestamp(date_time).to_datetime64(), 'ns')
+        if t > times[-1]:
+            t -= -(-(t - times[-1]) // week) * week
+        i = max(int(np.searchsorted(times, t, side='right')) - 1, 0)
+        path = paths[keys[i]]
+        if path.endswith(SUFFIX):
+            archive = SnapshotArchive(path)
+            xy = archive.snapshot(archive.find(keys[i]))
+            return feature_collection(date_time, xy[:, 0], xy[:, 1])
+        with open(path) as f:
+            data = json.load(f)
+        for feature in data['features']:
+            feature['properties']['timestamp'] = f"{date_time}+08:00"
+        return data
+
+    return snapshot
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    # set on the server instance: snapshot_fn, fail_rate, rng, requests
+    def do_GET(self):
+        server = self.server
+        url = urlparse(self.path)
+        if url.path != PATH:
+            self.send_error(404)
+            return
+        with server.lock:
+            server.requests += 1
+            fail = server.fail_rate and server.rng.random() < server.fail_rate
+        if fail:
+            self.send_response(429 if server.rng.random() < 0.5 else 503)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        date_time = unquote(parse_qs(url.query).get('date_time', [''])[0])
+        body = json.dumps(server.snapshot_fn(date_time)).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port=0, snapshot_fn=synthetic_snapshot, fail_rate=0.0, seed=0):
+    """
+    Start the stand-in server on a background thread. Returns the server;
+    its base URL is `endpoint(server)`, stop it with server.shutdown().
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', port), StubHandler)
+    server.daemon_threads = True
+    server.snapshot_fn = snapshot_fn
+    server.fail_rate = fail_rate
+    server.rng = np.random.default_rng(seed)
+    server.lock = threading.Lock()
+    server.requests = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def endpoint(server):
+    host, port = server.server_address[:2]
+    return f"http://{host}:{port}{PATH}"
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Stand-in taxi-availability API")
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--fail-rate', type=float, default=0.0)
+    parser.add_argument('--replay', metavar='RAW_DIR', help="serve the snapshots downloaded under RAW_DIR")
+    args = parser.parse_args()
+
+    snapshot_fn = replay_snapshot_fn(args.replay) if args.replay else synthetic_snapshot
+    srv = serve(args.port, snapshot_fn=snapshot_fn, fail_rate=args.fail_rate)
+    print(f"serving on {endpoint(srv)}")
+    threading.Event().wait()
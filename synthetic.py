@@ -0,0 +1,83 @@
+"""
+Synthetic taxi data for benchmarks and local experiments.
+
+synthetic_counts() produces a frame shaped like load_taxi_count() for the
+districts of region1.geojson: a per-district level, a daily and weekly cycle,
+a drop from the April 2020 circuit breaker onwards and Poisson noise.
+synthetic_snapshots() produces raw taxi positions spread over the districts
+roughly in proportion to their demand.
+"""
+import json
+
+import numpy as np
+import pandas as pd
+
+from district_index import COUNTRY_GEO
+
+COVID_START = np.datetime64('2020-04-01')
+
+
+def district_names(fname=COUNTRY_GEO):
+    with open(fname, "rb") as f:
+        return [feat['properties']['name'] for feat in json.load(f)['features']]
+
+
+def synthetic_counts(start='2016-09-16', years=1, freq='h', regions=None, seed=0):
+    """
+    Counts for every district and snapshot in pd.date_range(start, +years, freq),
+    index 'filename' (datetime), columns region (categorical) and taxi_count (int16).
+    """
+    rng = np.random.default_rng(seed)
+    regions = sorted(regions or district_names())
+    times = pd.date_range(start=start, end=pd.Timestamp(start) + pd.DateOffset(years=years), freq=freq,
+                          inclusive='left')
+    t = times.values
+
+    level = rng.lognormal(mean=4.0, sigma=0.8, size=len(regions))
+    hour = (t - t.astype('datetime64[D]')) / np.timedelta64(1, 'h')
+    weekday = (t.astype('datetime64[D]').astype(np.int64) + 3) % 7
+    daily = 1 + 0.5 * np.sin((hour - 8) / 24 * 2 * np.pi)
+    weekly = np.where(weekday >= 5, 0.85, 1.0)
+    covid = np.where(t >= COVID_START, 0.6, 1.0)
+    shape = (daily * weekly * covid).astype(np.float32)
+
+    lam = level[None, :].astype(np.float32) * shape[:, None]
+    counts = rng.poisson(lam).astype(np.int16)
+
+    codes = np.tile(np.arange(len(regions), dtype=np.int16), len(times))
+    return pd.DataFrame({
+        'region': pd.Categorical.from_codes(codes, categories=regions),
+        'taxi_count': counts.ravel(),
+    }, index=pd.DatetimeIndex(np.repeat(t, len(regions)), name='filename'))
+
+
+def synthetic_snapshots(n_snapshots, n_taxis=5000, district_index=None, seed=0):
+    """
+    n_snapshots (lon, lat) float64 array pairs. With a DistrictIndex, about 98%
+    of the taxis fall inside a district; the rest are spread over its bounding box.
+    """
+    rng = np.random.default_rng(seed)
+    if district_index is None:
+        from district_index import DistrictIndex
+        district_index = DistrictIndex.from_geojson()
+    idx = district_index
+    x1 = idx.x0 + idx.nx * idx.cell_size
+    y1 = idx.y0 + idx.ny * idx.cell_size
+
+    # candidate positions: uniform over the bbox, kept in proportion to a district weight
+    n_pool = 4 * n_taxis
+    lon = rng.uniform(idx.x0, x1, n_pool)
+    lat = rng.uniform(idx.y0, y1, n_pool)
+    codes = idx.label(lon, lat)
+    weight = rng.lognormal(0, 0.8, len(idx.names))
+    p = np.where(codes >= 0, weight[np.maximum(codes, 0)], 0.02 * weight.mean())
+    p /= p.sum()
+
+    out = []
+    for _ in range(n_snapshots):
+        n = int(n_taxis * rng.uniform(0.9, 1.1))
+        pick = rng.choice(n_pool, size=n, p=p)
+        jitter = rng.normal(0, 0.0005, (2, n))
+        out.append((lon[pick] + jitter[0], lat[pick] + jitter[1]))
+    return out
+
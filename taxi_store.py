@@ -0,0 +1,209 @@
+"""
+Year-partitioned Parquet store for the processed taxi counts.
+
+Layout: data/analysis/taxi_count/year=YYYY/part-*.parquet, one row per
+(snapshot, region) with columns
+    filename    timestamp[s]          snapshot time
+    region      dictionary<int16>     district name
+    taxi_count  int16
+
+Run `python taxi_store.py` to convert the processed_taxi_count.{year}.csv
+files into the store. load_taxi_count() converts any missing year on the fly.
+
+A year's CSV goes to its own part-csv.parquet and ingest.py writes
+part-ingest-NNNNNN.parquet files named after its checkpoint generation, so
+neither overwrites the other. Where both cover a snapshot, loads keep the
+ingested rows.
+"""
+import os
+import glob
+import hashlib
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+import coverage_index
+
+CSV_DIR = './data/analysis'
+CSV_PART = 'csv'  # part name of a year converted from its processed csv
+STORE_DIR = './data/analysis/taxi_count'
+YEARS = range(2016, 2022)
+
+SCHEMA = pa.schema([
+    ('filename', pa.timestamp('s')),
+    ('region', pa.dictionary(pa.int16(), pa.string())),
+    ('taxi_count', pa.int16()),
+])
+
+def _categorical(region):
+    return region if isinstance(region.dtype, pd.CategoricalDtype) else region.astype('category')
+
+
+def region_names(region):
+    """
+    Sorted distinct district names of a region column. Categorical columns (as
+    loaded from the store) are read from their categories instead of row by row.
+    """
+    region = _categorical(region)
+    used = np.unique(region.cat.codes.values)
+    return sorted(str(r) for r in region.cat.categories[used[used >= 0]])
+
+
+def region_codes(region, regions):
+    """int64 index of each row's district into `regions`, -1 for names not in it."""
+    region = _categorical(region)
+    lookup = np.append(pd.Index(list(regions)).get_indexer(region.cat.categories.astype(str)), -1)
+    return lookup[region.cat.codes.values.astype(np.int64)]
+
+
+def partition_dir(year, store_dir=STORE_DIR):
+    return os.path.join(store_dir, f'year={year}')
+
+
+def available_years(store_dir=STORE_DIR):
+    paths = glob.glob(os.path.join(store_dir, 'year=*'))
+    return sorted(int(os.path.basename(p).split('=')[1]) for p in paths)
+
+
+def frame_to_table(df):
+    # df: columns region, taxi_count, filename (int yyyymmddHHMMSS or datetime)
+    filename = df['filename']
+    if not np.issubdtype(filename.dtype, np.datetime64):
+        filename = pd.to_datetime(filename.astype('int64').astype(str), format="%Y%m%d%H%M%S")
+    region = df['region'].astype('category')
+    return pa.Table.from_pydict({
+        'filename': pa.array(filename.values.astype('datetime64[s]'), type=pa.timestamp('s')),
+        'region': pa.DictionaryArray.from_arrays(
+            pa.array(region.cat.codes.values.astype('int16')),
+            pa.array(region.cat.categories.astype(str).tolist(), type=pa.string())),
+        'taxi_count': pa.array(df['taxi_count'].values.astype('int16')),
+    }, schema=SCHEMA)
+
+
+def part_path(year, part, store_dir=STORE_DIR):
+    # part: a number (part-NNNN) or a name (part-{name})
+    name = f'{part:04d}' if isinstance(part, (int, np.integer)) else part
+    return os.path.join(partition_dir(year, store_dir), f'part-{name}.parquet')
+
+
+def write_partition(df, year, store_dir=STORE_DIR, part=None):
+    """
+    Write df as one part file of the given year's partition, replacing a part
+    of the same number or name. With part=None the next free part number is
+    used, so repeated calls append to the partition. Returns the path written.
+    """
+    out_dir = partition_dir(year, store_dir)
+    os.makedirs(out_dir, exist_ok=True)
+    if part is None:
+        names = (os.path.basename(p)[len('part-'):-len('.parquet')]
+                 for p in glob.glob(os.path.join(out_dir, 'part-*.parquet')))
+        part = max((int(n) for n in names if n.isdigit()), default=-1) + 1
+    path = part_path(year, part, store_dir)
+    table = frame_to_table(df).sort_by([('filename', 'ascending')])
+    tmp_path = path + '.tmp'
+    pq.write_table(table, tmp_path, compression='zstd')
+    os.replace(tmp_path, path)
+    return path
+
+
+def convert_csv(year, csv_dir=CSV_DIR, store_dir=STORE_DIR, coverage_file=coverage_index.COVERAGE):
+    fname = os.path.join(csv_dir, f'processed_taxi_count.{year}.csv')
+    df = pd.read_csv(fname, index_col=0).reset_index()
+    # only the csv's own part is replaced; parts written by ingest.py stay
+    path = write_partition(df, year, store_dir, part=CSV_PART)
+    if coverage_file:
+        cov = coverage_index.Coverage.load(coverage_file)
+        cov.mark_counts(df['filename'].values, df['taxi_count'].values)
+        cov.save(coverage_file)
+    return path
+
+
+def convert_all(csv_dir=CSV_DIR, store_dir=STORE_DIR, years=YEARS):
+    written = []
+    for year in years:
+        if os.path.exists(os.path.join(csv_dir, f'processed_taxi_count.{year}.csv')):
+            written.append(convert_csv(year, csv_dir, store_dir))
+    return written
+
+
+def _ensure_years(years, csv_dir, store_dir):
+    # a year is converted whenever its csv has no part yet, also when ingest.py has written some of it
+    for year in years:
+        if (not os.path.exists(part_path(year, CSV_PART, store_dir))
+                and os.path.exists(os.path.join(csv_dir, f'processed_taxi_count.{year}.csv'))):
+            convert_csv(year, csv_dir, store_dir)
+
+
+def dataset_version(years=YEARS, csv_dir=CSV_DIR, store_dir=STORE_DIR, coverage_file=coverage_index.COVERAGE):
+    """
+    Short hash of the part files (name, size, mtime) of the given years, of
+    the coverage index files and of exclusions.json. It changes whenever a
+    partition is written, the index is rebuilt or the rules are edited, so
+    caches keyed on it go stale when new data lands. Missing years are converted first, like
+    load_taxi_count() would, so the version is the same before and after a load.
+    """
+    _ensure_years(years, csv_dir, store_dir)
+    h = hashlib.sha1()
+    for year in years:
+        for path in sorted(glob.glob(os.path.join(partition_dir(year, store_dir), 'part-*.parquet'))):
+            st = os.stat(path)
+            h.update(f'{os.path.relpath(path, store_dir)}:{st.st_size}:{st.st_mtime_ns};'.encode())
+    for path in (coverage_file, coverage_index.totals_path(coverage_file)) if coverage_file else ():
+        # loads drop the rows the index flags, so rebuilding it is a new version too
+        if os.path.exists(path):
+            st = os.stat(path)
+            h.update(f'{os.path.basename(path)}:{st.st_size}:{st.st_mtime_ns};'.encode())
+    if os.path.exists(coverage_index.RULES):
+        # loads drop what the rules exclude, so editing them is a new version too
+        with open(coverage_index.RULES, 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()[:12]
+
+
+def load_taxi_count(start=None, end=None, years=YEARS, csv_dir=CSV_DIR, store_dir=STORE_DIR, drop_noisy=True):
+    """
+    Load processed counts indexed by snapshot time ('filename'), with columns
+    region (categorical) and taxi_count (int16). Only the year partitions
+    overlapping [start, end] are read. With drop_noisy, snapshots excluded by
+    exclusions.json or flagged anomalous in the coverage index are left out.
+    """
+    years = [y for y in years
+             if (start is None or y >= pd.Timestamp(start).year) and (end is None or y <= pd.Timestamp(end).year)]
+    _ensure_years(years, csv_dir, store_dir)
+    paths, mixed = [], False
+    for year in years:
+        # part-csv sorts before part-ingest-*, so ingested rows come last and win below
+        year_paths = sorted(glob.glob(os.path.join(partition_dir(year, store_dir), 'part-*.parquet')))
+        mixed |= len(year_paths) > 1 and part_path(year, CSV_PART, store_dir) in year_paths
+        paths += year_paths
+    if not paths:
+        return pd.DataFrame({'region': pd.Categorical([]), 'taxi_count': np.array([], dtype='int16')},
+                            index=pd.DatetimeIndex([], name='filename'))
+
+    dataset = ds.dataset(paths, schema=SCHEMA, format='parquet')
+    expr = None
+    if start is not None:
+        expr = ds.field('filename') >= pa.scalar(pd.Timestamp(start).to_pydatetime(), type=pa.timestamp('s'))
+    if end is not None:
+        e = ds.field('filename') <= pa.scalar(pd.Timestamp(end).to_pydatetime(), type=pa.timestamp('s'))
+        expr = e if expr is None else expr & e
+    table = dataset.to_table(filter=expr).unify_dictionaries()
+    table = table.combine_chunks()
+
+    df = table.to_pandas().set_index('filename')
+    df.index = df.index.astype('datetime64[ns]')
+    if mixed:
+        # snapshots both in a csv and ingested from the raw files: one row per (snapshot, region)
+        key = df.index.values.astype(np.int64) * 1024 + df.region.cat.codes.values
+        df = df[~pd.Series(key).duplicated(keep='last').values].sort_index(kind='stable')
+    if drop_noisy:
+        df = df[~coverage_index.Coverage.load().drop_mask(df.index.values)]
+    return df
+
+
+if __name__ == "__main__":
+    for p in convert_all():
+        print(p)
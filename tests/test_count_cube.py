@@ -0,0 +1,43 @@
+from datetime import date, datetime, timedelta
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import synthetic
+from count_cube import CountCube, date_to_datetime, get_time_delta
+
+
+@pytest.fixture(scope='module')
+def full_data():
+    df = synthetic.synthetic_counts(start='2019-10-01', years=2, regions=['ANG MO KIO', 'BEDOK', 'BISHAN'])
+    # hours with no snapshot for some districts, as in the real data
+    return df[np.random.default_rng(0).random(len(df)) > 0.1]
+
+
+def original_filter_data(full_data, baseline_date_start, analysis_date_start, hour_of_day, time_period,
+                         time_frequency):
+    # streamlit.filter_data as it was before the cube, on the csv-loaded frame (region as strings)
+    full_data = full_data.assign(region=full_data.region.astype(str))
+    out = []
+    for date_start, cap in ((baseline_date_start, datetime(2020, 4, 1)), (analysis_date_start, datetime(2021, 10, 1))):
+        window_from = date_to_datetime(date_start) + timedelta(hours=int(hour_of_day))
+        window_to = min(window_from + get_time_delta(time_period, time_frequency), cap)
+        data = full_data.loc[window_from:window_to].copy()
+        data["hour"] = data.index.hour.astype(int)
+        data = data[data["hour"] == int(hour_of_day)].drop('hour', axis=1)
+        out.append(data.groupby('region').mean().round().reset_index())
+    return out
+
+
+@pytest.mark.parametrize('baseline, analysis, hour, period, unit', [
+    (date(2019, 11, 3), date(2020, 6, 1), 20, 10, 'Days'),
+    (date(2020, 3, 20), date(2021, 9, 20), 0, 4, 'Weeks'),  # both windows run past their cap
+    (date(2019, 10, 1), date(2021, 1, 1), 23, 30, 'Hours'),
+    (date(2019, 12, 25), date(2020, 4, 1), 7, 1, 'Days'),
+])
+def test_filter_matches_the_original_filter_data(full_data, baseline, analysis, hour, period, unit):
+    cube = CountCube.from_frame(full_data)
+    for got, want in zip(cube.filter(baseline, analysis, hour, period, unit),
+                         original_filter_data(full_data, baseline, analysis, hour, period, unit)):
+        pd.testing.assert_frame_equal(got.astype({'region': str}), want, check_dtype=False)
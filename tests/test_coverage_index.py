@@ -0,0 +1,43 @@
+import json
+
+import numpy as np
+import pandas as pd
+
+import coverage_index
+import taxi_store
+from coverage_index import ANOMALOUS, Coverage
+
+
+def write_rules(path, min_taxis):
+    with open(path, 'w') as f:
+        json.dump({'exclude': [], 'anomaly': {'min_taxis': min_taxis}}, f)
+    return str(path)
+
+
+def test_anomaly_rule_follows_the_rules_file_without_a_rebuild(tmp_path):
+    fname, rules = str(tmp_path / 'coverage.npy'), tmp_path / 'exclusions.json'
+    times = pd.date_range('2019-01-01', periods=4, freq='5min').values
+    cov = Coverage(rules=coverage_index.load_rules(write_rules(rules, 0)))
+    cov.mark_counts(np.repeat(times, 2), np.array([50, 50, 5, 5, 100, 100, 1, 1]))
+    cov.save(fname)
+    assert not (Coverage.load(fname, str(rules)).at(times) & ANOMALOUS).any()
+
+    write_rules(rules, 20)
+    flagged = Coverage.load(fname, str(rules)).at(times) & ANOMALOUS > 0
+    np.testing.assert_array_equal(flagged, [False, True, False, True])
+
+    write_rules(rules, 0)
+    assert not (Coverage.load(fname, str(rules)).at(times) & ANOMALOUS).any()
+
+
+def test_rebuilding_the_coverage_index_is_a_new_dataset_version(tmp_path):
+    store, fname = str(tmp_path / 'store'), str(tmp_path / 'coverage.npy')
+    version = lambda: taxi_store.dataset_version([2019], str(tmp_path), store, coverage_file=fname)
+    Coverage().save(fname)
+    before = version()
+    assert version() == before
+
+    cov = Coverage.load(fname)
+    cov.mark_counts(pd.date_range('2019-01-01', periods=3, freq='5min').values, np.array([1, 2, 3]))
+    cov.save(fname)
+    assert version() != before
@@ -0,0 +1,102 @@
+import json
+import os
+import time
+
+import numpy as np
+import pytest
+import requests
+
+import data_download
+import stub_server
+from district_index import snapshot_coordinates
+from snapshot_archive import SnapshotArchive, list_archives
+
+START, END = '2019-01-01 00:00', '2019-01-01 00:55'  # 12 snapshots
+
+
+@pytest.fixture
+def server():
+    srv = stub_server.serve(port=0)
+    yield srv
+    srv.shutdown()
+
+
+def test_resume_skips_finished_snapshots(server, tmp_path):
+    url = stub_server.endpoint(server)
+    assert data_download.download_data(START, END, n_workers=4, out_dir=str(tmp_path), base_url=url) == []
+    assert server.requests == 12
+    assert len(os.listdir(tmp_path / '2019')) == 12
+
+    assert data_download.download_data(START, END, n_workers=4, out_dir=str(tmp_path), base_url=url) == []
+    assert server.requests == 12
+
+
+def test_fetch_retries_retryable_statuses():
+    srv = stub_server.serve(port=0, fail_rate=0.5, seed=1)
+    try:
+        session = data_download.make_session(1)
+        url = stub_server.endpoint(srv) + '?date_time=2019-01-01T00%3A00%3A00'
+        for _ in range(10):
+            data = data_download.fetch(session, url, retries=20, backoff=0.001)
+            assert data['features'][0]['properties']['taxi_count'] > 0
+        assert srv.requests > 10  # some of them were 429/503 and retried
+    finally:
+        srv.shutdown()
+
+
+def test_fetch_gives_up_after_retries():
+    srv = stub_server.serve(port=0, fail_rate=1.0)
+    try:
+        with pytest.raises(requests.HTTPError):
+            data_download.fetch(data_download.make_session(1), stub_server.endpoint(srv), retries=2, backoff=0.001)
+        assert srv.requests == 3
+    finally:
+        srv.shutdown()
+
+
+def test_failed_snapshots_are_retried_on_the_next_run(tmp_path):
+    srv = stub_server.serve(port=0, fail_rate=1.0)
+    try:
+        url = stub_server.endpoint(srv)
+        failed = data_download.download_data(START, END, out_dir=str(tmp_path), base_url=url, retries=0)
+        assert len(failed) == 12
+        srv.fail_rate = 0.0
+        assert data_download.download_data(START, END, out_dir=str(tmp_path), base_url=url, retries=0) == []
+        assert len(os.listdir(tmp_path / '2019')) == 12
+    finally:
+        srv.shutdown()
+
+
+def test_rate_limiter_throttles():
+    limiter = data_download.RateLimiter(rate=20, burst=1)
+    t0 = time.monotonic()
+    for _ in range(11):
+        limiter.wait()
+    # the first token is there at the start, the other ten take 1/20 s each
+    assert time.monotonic() - t0 >= 0.45
+
+
+def test_rate_limited_download(server, tmp_path):
+    t0 = time.monotonic()
+    data_download.download_data(START, END, n_workers=4, out_dir=str(tmp_path), base_url=stub_server.endpoint(server),
+                                rate=5)
+    # a full bucket of 5 requests goes at once, the other 7 wait for tokens at 5 per second
+    assert time.monotonic() - t0 >= 7 / 5 - 0.05
+
+
+def test_archive_matches_json_tree(server, tmp_path):
+    url = stub_server.endpoint(server)
+    data_download.download_data(START, END, n_workers=4, out_dir=str(tmp_path / 'json'), base_url=url)
+    data_download.download_data(START, END, n_workers=4, out_dir=str(tmp_path / 'snap'), base_url=url, archive=True)
+
+    archives = list_archives(str(tmp_path / 'snap'))
+    assert len(archives) == 1
+    archive = SnapshotArchive(archives[0])
+    json_files = sorted(os.listdir(tmp_path / 'json' / '2019'))
+    assert [f'{t}.json' for t in archive.timestamps] == json_files
+    for i, name in enumerate(json_files):
+        with open(tmp_path / 'json' / '2019' / name) as f:
+            lon, lat = snapshot_coordinates(json.load(f))
+        xy = archive.snapshot(i)
+        np.testing.assert_array_equal(xy[:, 0], lon)
+        np.testing.assert_array_equal(xy[:, 1], lat)
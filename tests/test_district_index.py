@@ -0,0 +1,28 @@
+import json
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+
+import synthetic
+from district_index import COUNTRY_GEO, DistrictIndex
+
+
+def test_labels_match_sjoin_within():
+    with open(COUNTRY_GEO) as f:
+        country_gdf = gpd.GeoDataFrame.from_features(json.load(f))
+    index = DistrictIndex.from_geojson()
+    (lon, lat), = synthetic.synthetic_snapshots(1, 5000, index, seed=3)
+    # points on district boundaries (polygon vertices) and well outside every district too
+    vertices = shapely.get_coordinates(country_gdf.geometry.boundary.iloc[:20])[::50]
+    lon = np.r_[lon, vertices[:, 0], 103.0, 105.0]
+    lat = np.r_[lat, vertices[:, 1], 1.35, 1.0]
+
+    points = gpd.GeoDataFrame(geometry=gpd.points_from_xy(lon, lat))
+    joined = gpd.sjoin(points, country_gdf, how='left', predicate="within")
+    assert joined.index.is_unique
+    codes = index.label(lon, lat)
+    got = pd.Series(np.where(codes >= 0, index.names[np.maximum(codes, 0)], None), dtype=object)
+    pd.testing.assert_series_equal(got, joined.name.astype(object).where(joined.name.notna(), None),
+                                   check_names=False)
@@ -0,0 +1,13 @@
+import json
+
+from shapely.geometry import MultiPolygon, Polygon, box
+
+from geometry_cache import GeometryCache, geometry_json
+
+
+def test_empty_geometries_serialize():
+    assert json.loads(geometry_json(Polygon())) == {'type': 'Polygon', 'coordinates': []}
+    assert json.loads(geometry_json(MultiPolygon())) == {'type': 'MultiPolygon', 'coordinates': []}
+    cache = GeometryCache(['A', 'B'], [box(103.8, 1.3, 103.81, 1.31), Polygon()], tolerances=(0.0,))
+    assert json.loads(cache.geometry[0.0]['B'])['coordinates'] == []
+    assert json.loads(cache.geometry[0.0]['A'])['coordinates'][0][0] == [103.81, 1.3]
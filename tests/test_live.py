@@ -0,0 +1,101 @@
+from datetime import timedelta
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import shared_dataset
+import synthetic
+from count_cube import CountCube
+from district_index import DistrictIndex
+from live import STEP, LiveFeed, RunningStats, snapshot_frame
+from monthly_rollup import MonthlyRollup
+from series_store import SeriesStore
+from time_pyramid import TimePyramid
+
+
+@pytest.fixture(scope='module')
+def index():
+    return DistrictIndex.from_geojson()
+
+
+@pytest.fixture(scope='module')
+def history(index):
+    return synthetic.synthetic_counts(start='2020-10-01', years=1, regions=list(index.names))
+
+
+@pytest.fixture
+def shared(tmp_path, history):
+    shared_dataset.write(str(tmp_path / 'shared'), history)
+    return shared_dataset.SharedDataset(str(tmp_path / 'shared'))
+
+
+def live_snapshots(history, index, n=30):
+    slots = [history.index[-1].to_pydatetime() + (i + 1) * STEP for i in range(n)]
+    return slots, synthetic.synthetic_snapshots(n, 300, index, seed=1)
+
+
+def test_live_updates_match_a_rebuild(shared, history, index):
+    feed = LiveFeed(MonthlyRollup(shared.cube), shared.series_store, pyramid=shared.pyramid)
+    heads = {key: s.head['counts'] for key, s in feed.series_store.series.items()}
+    slots, snapshots = live_snapshots(history, index)
+    for lo in range(0, len(slots), 7):
+        feed.apply(slots[lo:lo + 7], snapshots[lo:lo + 7])
+
+    codes, offsets = index.label_snapshots(snapshots)
+    new = snapshot_frame(np.array(slots, dtype='datetime64[ns]'), index.count(codes, offsets), index.names)
+    full = pd.concat([history, new])
+    store, cube, pyramid = SeriesStore.from_frame(full), CountCube.from_frame(full), TimePyramid.from_frame(full)
+
+    # the mapped series were appended to, not copied
+    for key, s in feed.series_store.series.items():
+        if key in heads:
+            assert s.head['counts'] is heads[key]
+    end = full.index[-1].to_pydatetime()
+    for region in ('All', 'BEDOK', 'JURONG WEST'):
+        for hour in (23, 0):
+            pd.testing.assert_frame_equal(feed.series_store.rolling(region, hour, '2021-08-01', end, std=True),
+                                          store.rolling(region, hour, '2021-08-01', end, std=True))
+    for a, b in zip(feed.cube.filter(end.date(), end.date() - timedelta(days=1), 23, 2, 'Days'),
+                    cube.filter(end.date(), end.date() - timedelta(days=1), 23, 2, 'Days')):
+        pd.testing.assert_frame_equal(a, b)
+    day = pd.Timestamp(end.date())
+    pd.testing.assert_frame_equal(feed.pyramid.query(day - pd.Timedelta('7D'), day + pd.Timedelta('1D'), 'h'),
+                                  pyramid.query(day - pd.Timedelta('7D'), day + pd.Timedelta('1D'), 'h'))
+
+    rebuilt = RunningStats.from_series_store(store)
+    np.testing.assert_array_equal(feed.stats.n, rebuilt.n)
+    np.testing.assert_allclose(feed.stats.mean, rebuilt.mean)
+    np.testing.assert_allclose(feed.stats.std(), rebuilt.std())
+
+
+def test_running_stats_match_pandas(history):
+    split = history.index < pd.Timestamp('2021-05-01')
+    stats = RunningStats.from_series_store(SeriesStore.from_frame(history[split]))
+    for chunk in np.array_split(np.flatnonzero(~split), 5):
+        stats.update(history.iloc[chunk])
+
+    grouped = history.groupby([history.region.astype(str), history.index.hour], observed=True).taxi_count
+    for (region, hour), mean in grouped.mean().items():
+        i = stats.region_index[region]
+        assert stats.mean[i, hour] == pytest.approx(mean)
+    for (region, hour), std in grouped.std().items():
+        assert stats.std()[stats.region_index[region], hour] == pytest.approx(std)
+
+
+def test_live_appends_reach_the_page_objects(shared, history, index):
+    # the dashboard's rollup, series store and coverage, as the page loads them once per process
+    import coverage_index
+
+    rollup, store, coverage = MonthlyRollup(shared.cube), shared.series_store, coverage_index.Coverage()
+    feed = LiveFeed(rollup, store, coverage=coverage)
+    slots, snapshots = live_snapshots(history, index)
+    start, end = history.index[0].to_pydatetime(), slots[-1]
+    before = rollup.frame(0, start, end)
+    assert coverage.summary(slots[0], slots[-1], step='5min')['present'] == 0
+
+    feed.apply(slots, snapshots)
+    after = rollup.frame(0, start, end)
+    assert '2021-10' in set(after.Date) and '2021-10' not in set(before.Date)
+    assert store.rolling('All', 1, slots[0], end).filename.max() == pd.Timestamp(slots[-1])
+    assert coverage.summary(slots[0], slots[-1], step='5min')['present'] == len(slots)
@@ -0,0 +1,38 @@
+from datetime import date, datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import synthetic
+from count_cube import CountCube
+from monthly_rollup import MonthlyRollup
+
+
+@pytest.fixture(scope='module')
+def full_data():
+    df = synthetic.synthetic_counts(start='2019-01-01', years=2, regions=['ANG MO KIO', 'BEDOK', 'BISHAN'])
+    return df[np.random.default_rng(2).random(len(df)) > 0.1]
+
+
+def original_animation_data(full_data, hour_of_day, startdate, enddate):
+    # the animated bar chart's frames as streamlit.py built them from taxigraph("All") before the rollup
+    data = full_data.loc[str(startdate):str(enddate)]
+    data = data[data.index.hour == hour_of_day].assign(region=lambda d: d.region.astype(str)).reset_index()
+    data["date"] = pd.to_datetime(data["filename"])
+    data = data.groupby([data.region.rename("District"), data.date.dt.year.rename("year"),
+                         data.date.dt.month.rename("month")]).agg({'taxi_count': "sum"}).reset_index()
+    data["Date"] = data["year"].astype(str) + "-" + data["month"].astype(str)
+    return data.drop(columns=["year", "month"])
+
+
+@pytest.mark.parametrize('hour, startdate, enddate', [
+    (20, date(2019, 1, 1), datetime(2021, 10, 16, 13)),
+    (8, date(2019, 3, 17), datetime(2020, 7, 9, 8)),  # partial months at both ends, the last one inclusive
+])
+def test_frame_matches_the_monthly_groupby(full_data, hour, startdate, enddate):
+    got = MonthlyRollup(CountCube.from_frame(full_data)).frame(hour, startdate, enddate)
+    want = original_animation_data(full_data, hour, startdate, enddate)
+    key = lambda df: df.assign(month=pd.to_datetime(df.Date, format='%Y-%m')).sort_values(
+        ['District', 'month']).reset_index(drop=True)[['District', 'taxi_count', 'Date']]
+    pd.testing.assert_frame_equal(key(got).astype({'District': str}), key(want), check_dtype=False)
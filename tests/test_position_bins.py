@@ -0,0 +1,42 @@
+import json
+
+import numpy as np
+import pandas as pd
+
+import position_bins
+import stub_server
+
+
+def write_snapshots(raw_dir, times):
+    out = raw_dir / '2019'
+    out.mkdir(parents=True, exist_ok=True)
+    for t in times:
+        with open(out / f"{t:%Y%m%d%H%M%S}.json", 'w') as f:
+            json.dump(stub_server.synthetic_snapshot(t.strftime('%Y-%m-%dT%H:%M:%S'), n_taxis=200), f)
+
+
+def test_build_rebins_a_day_with_new_snapshots(tmp_path):
+    raw_dir, bins_dir = tmp_path / 'raw', str(tmp_path / 'bins')
+    times = pd.date_range('2019-01-01 10:00', periods=6, freq='5min')
+    write_snapshots(raw_dir, times[:4])
+    assert len(position_bins.build(str(raw_dir), bins_dir)) == 1
+    assert position_bins.build(str(raw_dir), bins_dir) == []
+    state = position_bins.bins_state(bins_dir)
+
+    # the rest of the day arrives later: the day file is built again from all of it
+    write_snapshots(raw_dir, times[4:])
+    written = position_bins.build(str(raw_dir), bins_dir)
+    assert position_bins.bins_state(bins_dir) != state  # the dashboard loads the bins again
+    assert written == [position_bins.day_path(bins_dir, '20190101')]
+    day = position_bins.read_day(written[0])
+    assert int(day['listed']) == 6 and day['snapshots'].sum() == 6
+    _, n_snapshots = position_bins.PositionBins(bins_dir).totals('2019-01-01', '2019-01-01 23:00')
+    assert n_snapshots == 6
+    assert position_bins.build(str(raw_dir), bins_dir) == []
+
+
+def test_day_files_without_listed_fall_back_to_binned_snapshots(tmp_path):
+    path = str(tmp_path / '20190101.npz')
+    bins = position_bins.bin_snapshots([20190101100000, 20190101100500], [(np.array([103.8]), np.array([1.35]))] * 2)
+    position_bins.write_day(path, bins)
+    assert position_bins.listed_snapshots(path) == 2
@@ -0,0 +1,76 @@
+import pytest
+import requests
+
+import query_service
+import synthetic
+from count_cube import CountCube
+from queries import Queries
+from series_store import SeriesStore
+
+
+@pytest.fixture(scope='module')
+def base_url():
+    full_data = synthetic.synthetic_counts(start='2019-01-01', years=2, regions=['ANG MO KIO', 'BEDOK'])
+    server = query_service.serve(Queries(CountCube.from_frame(full_data), SeriesStore.from_frame(full_data)))
+    yield query_service.endpoint(server)
+    server.shutdown()
+
+
+WINDOW = {'baseline': '2019-01-07', 'analysis': '2020-06-01', 'hour': 20, 'period': 10, 'unit': 'Days'}
+
+
+def test_compare(base_url):
+    baseline, analysis = query_service.QueryClient(base_url).compare(
+        *[query_service.parse_when(WINDOW[k]) for k in ('baseline', 'analysis')], 20, 10, 'Days')
+    assert sorted(baseline.region) == ['ANG MO KIO', 'BEDOK']
+    assert len(analysis) == 2
+
+
+@pytest.mark.parametrize('params', [{'period': 10 ** 12}, {'hour': 24}, {'baseline': 'yesterday'}, {'unit': 'Years'}])
+def test_bad_params_are_400(base_url, params):
+    resp = requests.get(f"{base_url}/compare", params={**WINDOW, **params})
+    assert resp.status_code == 400
+    assert resp.json()['error']
+
+
+@pytest.mark.parametrize('body', [{'queries': 5}, {'queries': [5]}, [1, 2], 'x'])
+def test_malformed_batch_is_400(base_url, body):
+    resp = requests.post(f"{base_url}/batch", json=body)
+    assert resp.status_code == 400
+
+
+def test_batch_isolates_failing_queries(base_url):
+    client = query_service.QueryClient(base_url)
+    results = client.batch([('compare', WINDOW), ('compare', {**WINDOW, 'period': 10 ** 12}),
+                            ('nope', {}), ('impact', {**WINDOW, 'hour': 'x'})])
+    assert len(results[0]) == 2
+    assert all(isinstance(r, ValueError) for r in results[1:])
+    resp = requests.post(f"{base_url}/batch", json={'queries': [{'query': 'compare', 'params': [1]}]})
+    assert resp.status_code == 200 and 'error' in resp.json()['results'][0]
+
+
+def test_animation_and_regions(base_url):
+    client = query_service.QueryClient(base_url)
+    assert client.regions() == ['ANG MO KIO', 'BEDOK']
+    frames = client.animation(20, query_service.parse_when('2019-01-07'), query_service.parse_when('2020-12-31'))
+    assert list(frames.columns) == ['District', 'taxi_count', 'Date'] and '2020-12' in set(frames.Date)
+
+
+def test_new_dataset_version_is_served_without_a_restart():
+    old = synthetic.synthetic_counts(start='2019-01-01', years=1, regions=['BEDOK'])
+    new = synthetic.synthetic_counts(start='2019-01-01', years=1, regions=['BEDOK', 'BISHAN'])
+    server = query_service.serve(Queries(CountCube.from_frame(old), SeriesStore.from_frame(old)), version='v1')
+    try:
+        client = query_service.QueryClient(query_service.endpoint(server))
+        when = [query_service.parse_when(WINDOW[k]) for k in ('baseline', 'analysis')]
+        assert client.version() == 'v1' and len(client.compare(*when, 20, 10, 'Days')[0]) == 1
+
+        current = {'version': 'v1'}
+        load = lambda version: Queries(CountCube.from_frame(new), SeriesStore.from_frame(new))
+        assert not query_service.reload_if_changed(server, lambda: current['version'], load)
+        current['version'] = 'v2'
+        assert query_service.reload_if_changed(server, lambda: current['version'], load)
+        # the cached answer of the old version is not served again
+        assert client.version() == 'v2' and len(client.compare(*when, 20, 10, 'Days')[0]) == 2
+    finally:
+        server.shutdown()
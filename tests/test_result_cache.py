@@ -0,0 +1,50 @@
+from result_cache import ResultCache
+
+
+def test_per_call_versions_do_not_share_results():
+    # two sessions on one cache, one drawing from a partial dataset: neither gets the other's result
+    cache = ResultCache(spill_dir=None, version='store')
+    current = {'version': 'store-2019'}
+    calls = []
+
+    @cache.memoize(version=lambda: current['version'])
+    def mean_count(hour):
+        calls.append(current['version'])
+        return f"{current['version']}:{hour}"
+
+    assert mean_count(20) == 'store-2019:20'
+    current['version'] = 'store'
+    assert mean_count(20) == 'store:20'
+    current['version'] = 'store-2019'
+    assert mean_count(20) == 'store-2019:20'
+    assert calls == ['store-2019', 'store']
+    assert cache.version == 'store'
+
+
+def test_set_version_drops_entries():
+    cache = ResultCache(spill_dir=None, version='a')
+    key = cache.key('q', {'hour': 1})
+    cache.put(key, 1)
+    cache.set_version('b')
+    assert cache.get(key) == (False, None)
+    assert cache.key('q', {'hour': 1}) != key
+
+
+def test_spilled_results_survive_a_restart_on_the_same_version(tmp_path):
+    spill_dir = str(tmp_path / 'spill')
+    cache = ResultCache(max_bytes=1, spill_dir=spill_dir)
+    cache.set_version('v1')
+    keys = [cache.key('q', {'hour': h}) for h in range(3)]
+    for h, key in enumerate(keys):
+        cache.put(key, 'x' * 100 + str(h))
+    assert cache.spill_bytes > 0
+
+    # a new process, created as the dashboard creates it, then set to the same version
+    restarted = ResultCache(max_bytes=1, spill_dir=spill_dir)
+    restarted.set_version('v1')
+    assert restarted.get(keys[0]) == (True, 'x' * 100 + '0')
+
+    # a new version drops them
+    other = ResultCache(max_bytes=1, spill_dir=spill_dir)
+    other.set_version('v2')
+    assert other.spill_bytes == 0 and not list((tmp_path / 'spill').glob('*.pkl.z'))
@@ -0,0 +1,40 @@
+from datetime import date
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import synthetic
+from series_store import SeriesStore
+
+
+@pytest.fixture(scope='module')
+def full_data():
+    df = synthetic.synthetic_counts(start='2019-01-01', years=2, regions=['ANG MO KIO', 'BEDOK', 'BISHAN'])
+    return df[np.random.default_rng(1).random(len(df)) > 0.1]
+
+
+def original_taxigraph(full_data, region, hour, startdate, enddate):
+    # streamlit.taxigraph as it was before the series store
+    basedata = full_data.loc[str(startdate):str(enddate)]
+    basedata = basedata[basedata.index.hour == hour]
+    if region != "All":
+        basedata = basedata.loc[basedata.region == region]
+    basedata = basedata.reset_index()
+    basedata['rolling_average'] = basedata.taxi_count.rolling(90).mean()
+    return basedata
+
+
+@pytest.mark.parametrize('region, hour, startdate, enddate', [
+    ('BEDOK', 20, date(2019, 1, 1), date(2020, 12, 31)),
+    ('All', 0, date(2019, 3, 15), date(2020, 6, 1)),
+    ('BISHAN', 7, date(2020, 11, 1), date(2020, 12, 31)),  # fewer than 90 rows: no rolling mean
+])
+def test_rolling_matches_the_original_taxigraph(full_data, region, hour, startdate, enddate):
+    got = SeriesStore.from_frame(full_data).rolling(region, hour, startdate, enddate)
+    want = original_taxigraph(full_data, region, hour, startdate, enddate)
+    assert len(got) == len(want)
+    np.testing.assert_array_equal(got.filename.values, want.filename.values)
+    np.testing.assert_array_equal(got.region.astype(str), want.region.astype(str))
+    np.testing.assert_array_equal(got.taxi_count, want.taxi_count)
+    np.testing.assert_allclose(got.rolling_average, want.rolling_average)
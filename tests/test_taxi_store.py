@@ -0,0 +1,125 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import ingest
+import stub_server
+import taxi_store
+
+
+def counts_frame(times, regions=('BEDOK', 'BISHAN'), count=10):
+    rows = [(int(t.strftime('%Y%m%d%H%M%S')), r, count) for t in times for r in regions]
+    return pd.DataFrame(rows, columns=['filename', 'region', 'taxi_count'])
+
+
+def write_csv(csv_dir, year, df):
+    df.set_index('filename').to_csv(os.path.join(csv_dir, f'processed_taxi_count.{year}.csv'))
+
+
+def load(tmp_path):
+    return taxi_store.load_taxi_count(csv_dir=str(tmp_path), store_dir=str(tmp_path / 'store'), years=[2019],
+                                      drop_noisy=False)
+
+
+def test_csv_conversion_keeps_ingested_parts(tmp_path):
+    store = str(tmp_path / 'store')
+    write_csv(tmp_path, 2019, counts_frame(pd.date_range('2019-01-01', periods=24, freq='h')))
+    taxi_store.convert_csv(2019, str(tmp_path), store, coverage_file=None)
+    ingested = counts_frame(pd.date_range('2019-02-01', periods=12, freq='5min'))
+    taxi_store.write_partition(ingested, 2019, store, part='ingest-000000')
+
+    taxi_store.convert_all(str(tmp_path), store, years=[2019])
+    assert len(load(tmp_path)) == 2 * 24 + 2 * 12
+
+
+def test_partly_ingested_year_gets_its_csv(tmp_path):
+    store = str(tmp_path / 'store')
+    write_csv(tmp_path, 2019, counts_frame(pd.date_range('2019-01-01', periods=24, freq='h')))
+    # the first three hours were also ingested from the raw snapshots, with other counts
+    taxi_store.write_partition(counts_frame(pd.date_range('2019-01-01', periods=3, freq='h'), count=7), 2019, store,
+                               part='ingest-000000')
+    df = load(tmp_path)
+    assert len(df) == 2 * 24
+    assert not df.reset_index().duplicated(['filename', 'region']).any()
+    assert (df.loc[:'2019-01-01 02:00'].taxi_count == 7).all()
+    assert (df.loc['2019-01-01 03:00':].taxi_count == 10).all()
+
+
+def test_numbered_parts_append(tmp_path):
+    store = str(tmp_path / 'store')
+    df = counts_frame(pd.date_range('2019-01-01', periods=2, freq='h'))
+    taxi_store.write_partition(df, 2019, store, part=taxi_store.CSV_PART)
+    paths = [taxi_store.write_partition(df, 2019, store) for _ in range(2)]
+    assert [os.path.basename(p) for p in paths] == ['part-0000.parquet', 'part-0001.parquet']
+
+
+@pytest.fixture
+def raw_dir(tmp_path):
+    out = tmp_path / 'raw' / '2019'
+    out.mkdir(parents=True)
+    for t in pd.date_range('2019-01-01', periods=6, freq='5min'):
+        with open(out / f"{t:%Y%m%d%H%M%S}.json", 'w') as f:
+            json.dump(stub_server.synthetic_snapshot(t.strftime('%Y-%m-%dT%H:%M:%S')), f)
+    return str(tmp_path / 'raw')
+
+
+def test_ingest_rerun_after_a_crash_adds_no_duplicates(tmp_path, raw_dir, monkeypatch):
+    kwargs = dict(store_dir=str(tmp_path / 'store'), checkpoint=str(tmp_path / 'ckpt.json'), n_workers=1,
+                  chunk_size=2, batch_rows=1, coverage_file=str(tmp_path / 'coverage.npy'))
+    save = ingest.Checkpoint.save
+    calls = []
+
+    def crash_on_second_save(self):
+        calls.append(1)
+        if len(calls) == 2:
+            raise RuntimeError("crash")
+        save(self)
+
+    # batch_rows=1 flushes after every chunk: the first batch is saved, the second written but not saved
+    monkeypatch.setattr(ingest.Checkpoint, 'save', crash_on_second_save)
+    with pytest.raises(RuntimeError):
+        ingest.run(raw_dir, **kwargs)
+    monkeypatch.setattr(ingest.Checkpoint, 'save', save)
+    assert ingest.run(raw_dir, **kwargs) == {}
+
+    df = load(tmp_path)
+    clean = tmp_path / 'clean'
+    ingest.run(raw_dir, **dict(kwargs, store_dir=str(clean / 'store'), checkpoint=str(clean / 'ckpt.json'),
+                               coverage_file=str(clean / 'coverage.npy')))
+    ref = load(clean)
+    assert len(df.index.unique()) == 6
+    pd.testing.assert_frame_equal(df.reset_index().sort_values(['filename', 'region']).reset_index(drop=True),
+                                  ref.reset_index().sort_values(['filename', 'region']).reset_index(drop=True),
+                                  check_categorical=False)
+
+
+def test_checkpoint_saves_append_only_the_new_batch(tmp_path):
+    fname = str(tmp_path / 'ckpt.json')
+    # a checkpoint saved whole by an earlier version, without a trailing newline
+    with open(fname, 'w') as f:
+        json.dump({'done': ['20190101000000'], 'empty': [], 'failed': {'20190101000500': 'ValueError: x'},
+                   'generation': 3}, f)
+    ckpt = ingest.Checkpoint(fname)
+    assert ckpt.done == {'20190101000000'} and ckpt.generation == 3
+
+    ckpt.add(done=['20190101000500'], empty=['20190101001000'])
+    ckpt.generation += 1
+    ckpt.save()
+    size = os.path.getsize(fname)
+    ckpt.add(done=['20190101001500'])
+    ckpt.generation += 1
+    ckpt.save()
+    with open(fname) as f:
+        lines = f.read().splitlines()
+    assert len(lines) == 3 and json.loads(lines[-1])['done'] == ['20190101001500']
+    assert os.path.getsize(fname) - size == len(lines[-1]) + 1
+
+    # a save cut short by a crash is skipped on load
+    with open(fname, 'a') as f:
+        f.write('{"done": ["20190101002000"], "gen')
+    loaded = ingest.Checkpoint(fname)
+    assert loaded.done == {'20190101000000', '20190101000500', '20190101001500'}
+    assert loaded.failed == {} and loaded.empty == {'20190101001000'} and loaded.generation == 5
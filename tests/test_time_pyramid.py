@@ -0,0 +1,71 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import synthetic
+from time_pyramid import STATS, TimePyramid
+
+
+@pytest.fixture(scope='module')
+def full_data():
+    return synthetic.synthetic_counts(start='2019-01-01', years=1, freq='h', regions=['ANG MO KIO', 'BEDOK', 'BISHAN'])
+
+
+def read_only(pyramid):
+    # as loaded from a shared dataset: appends must not write to the levels
+    for level in pyramid.levels.values():
+        for a in level.values():
+            a.flags.writeable = False
+    return pyramid
+
+
+@pytest.mark.parametrize('step', ['h', '3h', 'D', 'W'])
+def test_append_matches_a_rebuild(full_data, step):
+    split = full_data.index < pd.Timestamp('2019-08-14 13:00')
+    pyramid = read_only(TimePyramid.from_frame(full_data[split]))
+    rest = full_data[~split]
+    for chunk in np.array_split(np.arange(len(rest)), 7):
+        pyramid.append(rest.iloc[chunk])
+    rebuilt = TimePyramid.from_frame(full_data)
+
+    for name in pyramid.levels:
+        for stat in STATS:
+            n = rebuilt.n_buckets(name)
+            np.testing.assert_array_equal(pyramid.level(name)[stat][:, :n], rebuilt.level(name)[stat])
+    pd.testing.assert_frame_equal(pyramid.query('2019-07-01', '2019-12-30', step),
+                                  rebuilt.query('2019-07-01', '2019-12-30', step))
+
+
+def test_append_new_region_and_finer_snapshots(full_data):
+    pyramid = read_only(TimePyramid.from_frame(full_data))
+    t = full_data.index[-1] + pd.Timedelta('5min')
+    frame = pd.DataFrame({'region': pd.Categorical(['BEDOK', 'CHANGI']), 'taxi_count': np.array([7, 3], dtype=np.int16)},
+                         index=pd.DatetimeIndex([t, t], name='filename'))
+    pyramid.append(frame)
+    out = pyramid.query(t.floor('D'), t.floor('D') + pd.Timedelta('1D'), 'D', regions=['CHANGI', 'ANG MO KIO'])
+    assert out.set_index('region')['count'].to_dict() == {'ANG MO KIO': 24, 'CHANGI': 1}
+    last = pyramid.query(t.floor('h'), t.floor('h') + pd.Timedelta('1h'), 'h', regions=['BEDOK'])
+    assert last['count'].item() == 2 and last['min'].item() <= 7 <= last['max'].item()
+
+
+def test_five_minute_level_keeps_a_recent_window():
+    full = synthetic.synthetic_counts(start='2019-01-01', years=1, freq='5min', regions=['BEDOK', 'BISHAN'])
+    full = full[full.index < pd.Timestamp('2019-03-01')]
+    retain = {'5min': np.timedelta64(3, 'D')}
+    split = full.index < pd.Timestamp('2019-02-20 13:05')
+    pyramid = read_only(TimePyramid.from_frame(full[split], retain=retain))
+    rest = full[~split]
+    for chunk in np.array_split(np.arange(len(rest)), 40):
+        pyramid.append(rest.iloc[chunk], slack=np.timedelta64(1, 'D'))
+    rebuilt = TimePyramid.from_frame(full, retain=retain)
+
+    # bounded to the window plus a slack, while the hourly level keeps everything
+    held = pyramid.n_buckets('5min') - pyramid.offsets['5min']
+    assert 3 * 288 <= held <= 4 * 288 + 288
+    assert rebuilt.level('5min')['sum'].shape[1] == 3 * 288 and rebuilt.offsets['h'] == 0
+    pd.testing.assert_frame_equal(pyramid.query('2019-02-27', '2019-03-01', '5min'),
+                                  rebuilt.query('2019-02-27', '2019-03-01', '5min'))
+    pd.testing.assert_frame_equal(pyramid.query('2019-01-07', '2019-03-01', 'h'),
+                                  rebuilt.query('2019-01-07', '2019-03-01', 'h'))
+    with pytest.raises(ValueError):
+        rebuilt.query('2019-02-01', '2019-02-02', '5min')
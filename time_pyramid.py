@@ -0,0 +1,291 @@
+"""
+Multi-resolution taxi counts: 5-minute, hourly, daily and weekly levels.
+
+Every level is a dense [region, bucket] grid of the sum, number, minimum and
+maximum of the snapshot counts falling in each bucket (16 bytes a cell). All levels share one
+origin, the Monday on or before the first snapshot, so a bucket of one level
+is exactly `factor` buckets of the next finer one and the coarser levels are
+reductions of the finest. The finest level is the data's own resolution:
+5-minute when snapshots fall between full hours (raw ingest), else hourly (the
+processed CSVs). Levels in `retain` only hold their most recent buckets: the
+5-minute level keeps 8 weeks (~14 MB for 55 districts) rather than the ~550 MB
+six years of it would take, while the hourly level (~46 MB) and coarser keep
+all of it. Those are built from the rows directly instead of reduced.
+
+query() answers a [start, end) range at a requested step from the coarsest
+level whose buckets divide the step and line up with the range, so a weekly
+view reads a week's buckets rather than 2016 five-minute ones.
+
+append() adds new rows (live.py) by updating only the buckets they fall in,
+on every level. The levels built or loaded, possibly memory-mapped from a
+shared dataset, are never written to: the buckets from the first one an
+append touches onward move into a small private tail per level, and the
+oldest buckets of a bounded level are dropped as new ones arrive.
+
+    pyramid = TimePyramid.from_frame(full_data)
+    pyramid.query('2020-01-06', '2020-03-02', step='W', regions=['BEDOK'])
+"""
+import numpy as np
+import pandas as pd
+
+from taxi_store import region_codes, region_names
+
+# level -> bucket size; each level is `factor` buckets of the previous one
+LEVELS = {'5min': np.timedelta64(5, 'm'), 'h': np.timedelta64(60, 'm'), 'D': np.timedelta64(1440, 'm'),
+          'W': np.timedelta64(10080, 'm')}
+NAMES = list(LEVELS)
+STATS = ('sum', 'count', 'min', 'max')
+EMPTY_MIN = np.iinfo(np.int16).max  # min/max of empty buckets, neutral under reduction
+EMPTY_MAX = np.iinfo(np.int16).min
+SLACK = np.timedelta64(7, 'D')  # time a level's tail grows by when an append runs past it
+RETAIN = {'5min': np.timedelta64(8 * 7, 'D')}  # level -> most recent time it holds; other levels hold everything
+
+
+def _empty(shape):
+    return {'sum': np.zeros(shape, dtype=np.int64), 'count': np.zeros(shape, dtype=np.uint32),
+            'min': np.full(shape, EMPTY_MIN, dtype=np.int16), 'max': np.full(shape, EMPTY_MAX, dtype=np.int16)}
+
+
+def bin_counts(rows, buckets, values, n_regions, n):
+    """A level {stat: [region, bucket]} of n buckets from the rows' (region row, bucket, count)."""
+    flat = rows * n + buckets
+    level = _empty((n_regions, n))
+    level['sum'].ravel()[:] = np.bincount(flat, weights=values, minlength=n_regions * n).astype(np.int64)
+    level['count'].ravel()[:] = np.bincount(flat, minlength=n_regions * n)
+    # min and max by bucket from one sort, rather than two unbuffered ufunc.at passes
+    order = np.argsort(flat, kind='stable')
+    flat, values = flat[order], values[order].astype(np.int16)
+    starts = np.flatnonzero(np.r_[True, flat[1:] != flat[:-1]]) if len(flat) else np.empty(0, dtype=np.int64)
+    if len(starts):
+        level['min'].ravel()[flat[starts]] = np.minimum.reduceat(values, starts)
+        level['max'].ravel()[flat[starts]] = np.maximum.reduceat(values, starts)
+    return level
+
+
+def reduce_buckets(level, factor):
+    """
+    Group the buckets of a level {stat: [region, bucket]} `factor` at a time;
+    a trailing partial group is padded with empties.
+    """
+    n = level['sum'].shape[1]
+    groups = -(-n // factor)
+    out = {}
+    for stat, ufunc in (('sum', np.add), ('count', np.add), ('min', np.minimum), ('max', np.maximum)):
+        a = level[stat]
+        if groups * factor != n:
+            pad = _empty((a.shape[0], groups * factor - n))[stat]
+            a = np.concatenate([a, pad], axis=1)
+        out[stat] = ufunc.reduce(a.reshape(a.shape[0], groups, factor), axis=2)
+    return out
+
+
+class TimePyramid:
+    def __init__(self, regions, t0, base, levels, offsets=None, retain=None):
+        self.regions = np.asarray(regions, dtype=object)
+        self.region_index = {r: i for i, r in enumerate(self.regions)}
+        self.t0 = np.datetime64(t0, 'm')
+        self.base = base  # finest level name
+        self.levels = levels  # name -> {stat: [region, bucket] array}, read-only once anything is appended
+        self.offsets = {name: 0 for name in levels} if offsets is None else dict(offsets)  # name -> first bucket held
+        self.retain = dict(RETAIN if retain is None else retain)
+        self._tails = {}  # name -> {stat: [region, capacity] array}, the buckets after the level's, see append()
+        self._n_tail = {}  # name -> buckets of the tail in use
+
+    @classmethod
+    def from_frame(cls, full_data, base=None, retain=None):
+        times = full_data.index.values.astype('datetime64[m]')
+        if base is None:
+            base = 'h' if len(times) == 0 or not (times.astype('datetime64[h]') != times).any() else '5min'
+        regions = np.array(region_names(full_data.region), dtype=object)
+        first = times.min() if len(times) else np.datetime64('2016-01-04T00:00', 'm')
+        day = first.astype('datetime64[D]')
+        t0 = (day - (day.astype(np.int64) + 3) % 7).astype('datetime64[m]')  # Monday on or before
+        retain = dict(RETAIN if retain is None else retain)
+        rows = region_codes(full_data.region, regions)
+        values = full_data.taxi_count.values
+
+        levels, offsets = {}, {}
+        names = NAMES[NAMES.index(base):]
+        for finer, name in zip([None] + names, names):
+            size = LEVELS[name]
+            n = int((times.max() - t0) // size) + 1 if len(times) else 0
+            lo = max(n - int(retain[name] // size), 0) if name in retain else 0
+            if finer is not None and offsets[finer] == 0 and lo == 0:
+                levels[name] = reduce_buckets(levels[finer], int(size // LEVELS[finer]))
+            else:
+                buckets = ((times - t0) // size).astype(np.int64) - lo
+                keep = buckets >= 0
+                levels[name] = bin_counts(rows[keep], buckets[keep], values[keep], len(regions), n - lo)
+            offsets[name] = lo
+        return cls(regions, t0, base, levels, offsets, retain)
+
+    def n_buckets(self, name):
+        """Bucket after the last one of a level (counted from t0)."""
+        return self.offsets[name] + self.levels[name]['sum'].shape[1] + self._n_tail.get(name, 0)
+
+    def _buckets(self, name, stat, rows, lo, hi):
+        # [rows, lo:hi] of a level's stat, from its array and its tail (hi <= n_buckets(name)); empty before its offset
+        head = self.levels[name][stat]
+        off, n_head = self.offsets[name], head.shape[1]
+        out = _empty((len(rows), max(hi - lo, 0)))[stat]
+        known = rows < head.shape[0]  # regions added by append() have no row there
+        h_lo, h_hi = max(lo, off), min(hi, off + n_head)
+        if h_hi > h_lo:
+            out[known, h_lo - lo:h_hi - lo] = head[rows[known], h_lo - off:h_hi - off]
+        if hi > off + n_head and name in self._tails:
+            t_lo = max(lo, off + n_head)
+            out[:, t_lo - lo:] = self._tails[name][stat][rows, t_lo - off - n_head:hi - off - n_head]
+        return out
+
+    def level(self, name):
+        """A level as {stat: [region, bucket] array} from bucket offsets[name] on, with its appended buckets."""
+        if name not in self._tails and self.levels[name]['sum'].shape[0] == len(self.regions):
+            return self.levels[name]
+        rows = np.arange(len(self.regions))
+        return {stat: self._buckets(name, stat, rows, self.offsets[name], self.n_buckets(name)) for stat in STATS}
+
+    def _tail(self, name, lo, hi, slack):
+        """
+        The tail of a level, covering buckets [lo, hi), and the bucket it starts
+        at. Buckets from lo on are moved out of the level's array (a view of the
+        rest stays), and the tail grows by `slack` of buckets when hi runs past it.
+        """
+        head = self.levels[name]
+        off, n_head = self.offsets[name], head['sum'].shape[1]
+        lo, hi = lo - off, hi - off
+        n_tail = self._n_tail.get(name, 0)
+        tail = self._tails.get(name) or _empty((len(self.regions), 0))
+        if lo < n_head:
+            moved = _empty((len(self.regions), n_head - lo))
+            for stat in STATS:
+                moved[stat][:head[stat].shape[0]] = head[stat][:, lo:]
+            tail = {stat: np.concatenate([moved[stat], tail[stat][:, :n_tail]], axis=1) for stat in STATS}
+            self.levels[name] = {stat: a[:, :lo] for stat, a in head.items()}
+            n_tail += n_head - lo
+            n_head = lo
+        if hi - n_head > tail['sum'].shape[1]:
+            extra = hi - n_head - tail['sum'].shape[1] + max(int(slack // LEVELS[name]), 1)
+            pad = _empty((len(self.regions), extra))
+            tail = {stat: np.concatenate([tail[stat], pad[stat]], axis=1) for stat in STATS}
+        self._tails[name] = tail
+        self._n_tail[name] = max(n_tail, hi - n_head)
+        return tail, off + n_head
+
+    def _trim(self, name, slack):
+        # drop the buckets of a bounded level older than its retain: from its array by
+        # slicing, from its tail (a copy) only once a slack's worth is due
+        if name not in self.retain:
+            return
+        excess = self.n_buckets(name) - self.offsets[name] - int(self.retain[name] // LEVELS[name])
+        head = self.levels[name]
+        drop = min(max(excess, 0), head['sum'].shape[1])
+        if drop:
+            self.levels[name] = {stat: a[:, drop:] for stat, a in head.items()}
+            self.offsets[name] += drop
+            excess -= drop
+        if excess >= max(int(slack // LEVELS[name]), 1) and name in self._tails:
+            self._tails[name] = {stat: a[:, excess:].copy() for stat, a in self._tails[name].items()}
+            self._n_tail[name] -= excess
+            self.offsets[name] += excess
+
+    def append(self, frame, slack=SLACK):
+        """
+        Add new rows (same layout as full_data) to every level. Only the
+        buckets the rows fall in are updated, so an append costs O(new rows)
+        plus, now and then, growing the tails. Rows before t0 are not supported;
+        rows before what a bounded level holds are left out of that level.
+        """
+        if not len(frame):
+            return
+        times = frame.index.values.astype('datetime64[m]')
+        if times.min() < self.t0:
+            raise ValueError(f"rows before the pyramid's origin {self.t0}")
+        new = [r for r in region_names(frame.region) if r not in self.region_index]
+        if new:
+            self.regions = np.array(list(self.regions) + new, dtype=object)
+            self.region_index = {r: i for i, r in enumerate(self.regions)}
+            for name, tail in self._tails.items():
+                self._tails[name] = {stat: np.concatenate([a, _empty((len(new), a.shape[1]))[stat]])
+                                     for stat, a in tail.items()}
+        rows = region_codes(frame.region, self.regions)
+        values = frame.taxi_count.values.astype(np.int16)
+        for name in self.levels:
+            buckets = ((times - self.t0) // LEVELS[name]).astype(np.int64)
+            keep = buckets >= self.offsets[name]
+            if not keep.any():
+                continue
+            buckets, r, v = buckets[keep], rows[keep], values[keep]
+            tail, first = self._tail(name, int(buckets.min()), int(buckets.max()) + 1, slack)
+            flat = r * tail['sum'].shape[1] + buckets - first
+            np.add.at(tail['sum'].reshape(-1), flat, v.astype(np.int64))
+            np.add.at(tail['count'].reshape(-1), flat, 1)
+            np.minimum.at(tail['min'].reshape(-1), flat, v)
+            np.maximum.at(tail['max'].reshape(-1), flat, v)
+            self._trim(name, slack)
+
+    def level_for(self, start, end, step):
+        """Coarsest level whose buckets divide `step` and line up with start and end."""
+        start, end, step = np.datetime64(start, 'm'), np.datetime64(end, 'm'), np.timedelta64(step, 'm')
+        for name in reversed(NAMES[NAMES.index(self.base):]):
+            size = LEVELS[name]
+            if step % size == 0 and (start - self.t0) % size == 0 and (end - self.t0) % size == 0:
+                return name
+        raise ValueError(f"no level of {self.base} or coarser fits step {step} from {start} to {end}")
+
+    def query(self, start, end, step='h', regions=None):
+        """
+        Stats of every `step` bucket in [start, end) as a frame with columns
+        time (bucket start), region, sum, count, mean, min and max; buckets
+        without snapshots are left out. step is a timedelta or a string such
+        as '5min', 'h', '3h', 'D' or 'W'; weekly buckets start on Mondays.
+        A range starting before what the level holds (see RETAIN) is a ValueError.
+        """
+        if isinstance(step, str) and not step[0].isdigit():
+            step = '1' + step
+        step = pd.Timedelta(step).to_timedelta64().astype('timedelta64[m]')
+        start = np.datetime64(pd.Timestamp(start).to_datetime64(), 'm')
+        end = np.datetime64(pd.Timestamp(end).to_datetime64(), 'm')
+        name = self.level_for(start, end, step)
+        size = LEVELS[name]
+        factor = int(step // size)
+
+        rows = np.arange(len(self.regions)) if regions is None else \
+            np.array([self.region_index[r] for r in regions if r in self.region_index], dtype=np.int64)
+        first = int((start - self.t0) // size)
+        last = max(int((end - self.t0) // size), first)
+        # skip whole steps before the data, keeping the grouping aligned to start
+        lo = first + max(-first, 0) // factor * factor
+        if self.offsets[name] and lo < self.offsets[name]:
+            raise ValueError(f"{name} buckets are only kept from {self.t0 + self.offsets[name] * size}")
+        hi = min(last, self.n_buckets(name))
+        lead = max(-lo, 0)
+        part = {stat: self._buckets(name, stat, rows, lo + lead, max(hi, lo + lead)) for stat in STATS}
+        if lead:
+            part = {stat: np.concatenate([_empty((len(rows), lead))[stat], a], axis=1) for stat, a in part.items()}
+        out = reduce_buckets(part, factor) if factor > 1 else part
+
+        r, b = np.nonzero(out['count'] > 0)
+        bucket0 = self.t0 + lo * size
+        return pd.DataFrame({
+            'time': (bucket0 + b * step).astype('datetime64[ns]'),
+            'region': self.regions[rows[r]],
+            'sum': out['sum'][r, b],
+            'count': out['count'][r, b],
+            'mean': out['sum'][r, b] / out['count'][r, b],
+            'min': out['min'][r, b],
+            'max': out['max'][r, b],
+        })
+
+    def arrays(self):
+        # {f'{level}.{stat}': array} and the metadata to rebuild the pyramid with from_arrays()
+        meta = {'regions': [str(r) for r in self.regions], 't0': str(self.t0), 'base': self.base,
+                'levels': list(self.levels), 'offsets': self.offsets,
+                'retain': {name: int(t // np.timedelta64(1, 'm')) for name, t in self.retain.items()}}
+        return meta, {f'{name}.{stat}': a for name in self.levels for stat, a in self.level(name).items()}
+
+    @classmethod
+    def from_arrays(cls, meta, arrays):
+        levels = {name: {stat: arrays[f'{name}.{stat}'] for stat in STATS} for name in meta['levels']}
+        retain = meta.get('retain')
+        return cls(meta['regions'], meta['t0'], meta['base'], levels, meta.get('offsets'),
+                   None if retain is None else {name: np.timedelta64(m, 'm') for name, m in retain.items()})
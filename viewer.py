@@ -4,6 +4,7 @@ import folium
 import geopandas as gpd
 import json
 from shapely import wkt
+import taxi_store
 import streamlit as st
 from streamlit_folium import folium_static
 import pandas as pd
@@ -12,22 +13,8 @@ import matplotlib.pyplot as plt
 
 def load_taxi_count():
     # processed_fname = f'gs://dva-sg-team105/processed_summary/processed_taxi_count.all.csv'
-    year_dfs = [pd.read_csv(f'./data/analysis/processed_taxi_count.{year}.csv', index_col=0) for year in range(2016, 2022)]
-    _df = pd.concat(year_dfs, axis=0)        
-    
-    # preprocessing
-    _df = _df.reset_index().set_index('filename')
-    idx = set(_df.index)
-    idx_to_dt_map = {x:datetime.strptime(str(x), "%Y%m%d%H%M%S") for x in idx}
-
-    # drop noisy data
-    idx_to_drop = [i for i in idx if (i < 20160916130000) 
-                   or ((i >= 20171016110000) & (i <= 20171129090000))]
-    _df.drop(idx_to_drop, axis=0, inplace=True)
-
-    _df.index = _df.index.map(idx_to_dt_map)
-
-    return _df
+    # year-partitioned parquet store, see taxi_store.py (noisy periods are dropped there)
+    return taxi_store.load_taxi_count()
 
 
 def load_taxi_locations():